@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+请求准入控制 - 通讯录系统
+- ConcurrencyLimiter: 一类路由同时执行的请求数上限，超出的请求有限排队，排不上直接拒绝
+- MemoryTokenBucket / SQLiteTokenBucket: 按客户端的令牌桶限流；
+  后者把桶状态放在一个SQLite文件里，同一台机器上的多个worker进程共享
+"""
+
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# 内存令牌桶最多记录的客户端数，超出后淘汰最久没访问的
+MAX_TRACKED_CLIENTS = 10000
+# 共享令牌桶每处理这么多次请求清理一次长时间不活跃的客户端
+PURGE_EVERY = 1000
+
+
+class ConcurrencyLimiter:
+    """计数信号量 + 有界等待队列
+
+    acquire() 成功返回 True，需要配对调用 release()；
+    等待的请求已满或等待超时返回 False
+    """
+
+    def __init__(self, limit, max_waiting=0, timeout=0.0):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        # 请求耗时的指数滑动平均，用来估算 Retry-After
+        self._average_duration = 1.0
+        self.rejected = 0
+
+    def acquire(self):
+        with self._condition:
+            if self._active < self.limit:
+                self._active += 1
+                return True
+            if self._waiting >= self.max_waiting or self.timeout <= 0:
+                self.rejected += 1
+                return False
+
+            self._waiting += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self._active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._condition.wait(remaining)
+                self._active += 1
+                return True
+            finally:
+                self._waiting -= 1
+
+    def release(self, duration=None):
+        with self._condition:
+            self._active -= 1
+            if duration is not None:
+                self._average_duration += 0.2 * (duration
+                                                 - self._average_duration)
+            self._condition.notify()
+
+    def retry_after(self):
+        """估计多少秒后可能有空位"""
+        with self._condition:
+            rounds = (self._waiting + 1) / max(self.limit, 1)
+            return max(1, math.ceil(self._average_duration * rounds))
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'active': self._active,
+                'waiting': self._waiting,
+                'rejected': self.rejected
+            }
+
+
+class MemoryTokenBucket:
+    """进程内的令牌桶：每个客户端每秒补充 rate 个令牌，最多攒 burst 个"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # client -> (tokens, updated)
+
+    def take(self, client):
+        """取一个令牌，返回 (是否允许, 建议等待秒数)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens, allowed, wait = _refill_and_take(
+                tokens, now - updated, self.rate, self.burst)
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > MAX_TRACKED_CLIENTS:
+                self._buckets.popitem(last=False)
+        return allowed, wait
+
+
+class SQLiteTokenBucket:
+    """桶状态存在SQLite文件中的令牌桶，多个进程共用同一个文件即共享限流额度
+
+    状态丢了只会让限流暂时放宽，所以关闭同步写盘换取速度
+    """
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._local = threading.local()
+        self._takes = 0
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                client TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        ''')
+
+    def take(self, client):
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated FROM buckets WHERE client = ?',
+                (client,)
+            ).fetchone()
+            tokens, updated = row if row else (self.burst, now)
+            tokens, allowed, wait = _refill_and_take(
+                tokens, now - updated, self.rate, self.burst)
+            conn.execute(
+                'INSERT OR REPLACE INTO buckets (client, tokens, updated) '
+                'VALUES (?, ?, ?)',
+                (client, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        self._takes += 1
+        if self._takes % PURGE_EVERY == 0:
+            self.purge()
+        return allowed, wait
+
+    def purge(self, idle_seconds=3600):
+        """删除长时间没有请求的客户端"""
+        self._connect().execute('DELETE FROM buckets WHERE updated < ?',
+                                (time.time() - idle_seconds,))
+
+    def _connect(self):
+        # 每个线程一个连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+
+def _refill_and_take(tokens, elapsed, rate, burst):
+    """补充令牌后尝试取一个，返回 (剩余令牌, 是否允许, 建议等待秒数)"""
+    tokens = min(burst, tokens + max(elapsed, 0) * rate)
+    if tokens >= 1:
+        return tokens - 1, True, 0
+    return tokens, False, max(1, math.ceil((1 - tokens) / rate))
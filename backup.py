@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+在线备份与恢复 - 通讯录系统
+用 SQLite 的 backup API 分批复制数据页，批次之间休眠让出IO，服务运行中也能安全备份
+
+    python backup.py --db contacts.db backup [--compress]
+    python backup.py --db contacts.db list
+    python backup.py --db contacts.db restore \\
+        contacts_20261019_020000_123_1a2b3c4d.db.gz
+    python backup.py --db contacts.db restore --at "2026-10-19 02:00:00"
+"""
+
+import argparse
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+DEFAULT_DB = 'contacts.db'
+DEFAULT_BACKUP_DIR = 'backups'
+# 每批复制的页数和批次之间的休眠（秒），控制备份对请求延迟的影响
+DEFAULT_PAGES_PER_STEP = 256
+DEFAULT_STEP_SLEEP = 0.01
+# 保留最近多少份快照
+DEFAULT_KEEP = 7
+
+SNAPSHOT_PREFIX = 'contacts_'
+SNAPSHOT_TIME_FORMAT = '%Y%m%d_%H%M%S'
+# contacts_<时间>_<毫秒>_<随机后缀>.db[.gz]，同一秒内的两次备份也不会重名；
+# 兼容没有毫秒和后缀的旧文件名
+SNAPSHOT_NAME_PATTERN = re.compile(
+    re.escape(SNAPSHOT_PREFIX) + r'(\d{8}_\d{6})(?:_(\d{3})_[0-9a-f]{8})?\.')
+
+
+def snapshot(source_path, target_path, pages=-1, sleep=0.0, progress=None):
+    """用 backup API 把数据库复制到 target_path（先写临时文件再原子改名）
+
+    pages 为每批复制的页数（-1 表示一次复制完），progress(remaining, total)
+    在每批之后调用。复制过程中源库有写入时 SQLite 会自动重新开始。
+    """
+    tmp_path = f"{target_path}.tmp"
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        def on_progress(status, remaining, total):
+            if progress:
+                progress(remaining, total)
+            if sleep and remaining:
+                time.sleep(sleep)
+
+        source.backup(target, pages=pages, progress=on_progress)
+        # 快照是独立文件，不需要WAL
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, target_path)
+
+
+def compress_file(path):
+    """gzip 压缩文件并删除原文件，返回压缩后的路径"""
+    gz_path = f"{path}.gz"
+    tmp_path = f"{gz_path}.tmp"
+    with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp_path, gz_path)
+    os.remove(path)
+    return gz_path
+
+
+def snapshot_name(now=None):
+    """新快照的文件名（不含压缩后缀）"""
+    now = now or datetime.now()
+    return (f"{SNAPSHOT_PREFIX}{now.strftime(SNAPSHOT_TIME_FORMAT)}"
+            f"_{now.microsecond // 1000:03d}_{uuid.uuid4().hex[:8]}.db")
+
+
+def snapshot_time(filename):
+    """从快照文件名解析时间，不是快照文件时返回 None"""
+    match = SNAPSHOT_NAME_PATTERN.match(filename)
+    if match is None:
+        return None
+    stamp, millis = match.groups()
+    try:
+        taken_at = datetime.strptime(stamp, SNAPSHOT_TIME_FORMAT)
+    except ValueError:
+        return None
+    return taken_at.replace(microsecond=int(millis or 0) * 1000)
+
+
+def list_snapshots(backup_dir):
+    """[(时间, 文件名, 字节数), ...]，按时间从新到旧"""
+    if not os.path.isdir(backup_dir):
+        return []
+    snapshots = []
+    for filename in os.listdir(backup_dir):
+        taken_at = snapshot_time(filename)
+        if taken_at is None or filename.endswith('.tmp'):
+            continue
+        size = os.path.getsize(os.path.join(backup_dir, filename))
+        snapshots.append((taken_at, filename, size))
+    snapshots.sort(reverse=True)
+    return snapshots
+
+
+def restore(db_path, snapshot_path, pages=-1, sleep=0.0):
+    """把快照恢复到数据库
+
+    同样通过 backup API 写回，正在运行的服务的其它连接会看到恢复后的数据，
+    不需要停服务或替换文件。恢复后自增id和变更日志序号不会回退，
+    跟随节点下次拉取日志时会被要求重新下载快照（见 _restart_sequences）。
+    """
+    if snapshot_path.endswith('.gz'):
+        fd, plain_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            with gzip.open(snapshot_path, 'rb') as src, \
+                    open(plain_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            return restore(db_path, plain_path, pages, sleep)
+        finally:
+            os.remove(plain_path)
+
+    source = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+    target = sqlite3.connect(db_path, timeout=30)
+    try:
+        version = _change_version(target)
+        sequences = _sequences(target)
+        source.backup(
+            target, pages=pages,
+            progress=lambda status, remaining, total:
+                time.sleep(sleep) if sleep and remaining else None
+        )
+        with target:
+            # 恢复后数据变更版本不能回退，否则按版本缓存的导出文件可能被误用
+            if version is not None and _change_version(target) is not None:
+                target.execute(
+                    'UPDATE change_version SET version = '
+                    'MAX(version, ?) + 1 WHERE id = 1', (version,))
+            _restart_sequences(target, sequences)
+    finally:
+        target.close()
+        source.close()
+
+
+class BackupManager:
+    """一个数据库文件的备份：后台执行、轮换保留、状态查询"""
+
+    def __init__(self, db_path, backup_dir,
+                 pages_per_step=DEFAULT_PAGES_PER_STEP,
+                 step_sleep=DEFAULT_STEP_SLEEP, keep=DEFAULT_KEEP,
+                 compress=False):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.keep = keep
+        self.compress = compress
+
+        self._lock = threading.Lock()
+        self._status = {
+            'state': 'idle',  # idle / running / failed
+            'started_time': None,
+            'finished_time': None,
+            'remaining_pages': None,
+            'total_pages': None,
+            'last_snapshot': None,
+            'error': None
+        }
+
+    def status(self):
+        with self._lock:
+            status = dict(self._status)
+        status['snapshots'] = [
+            {'name': name, 'size': size,
+             'time': taken_at.strftime('%Y-%m-%d %H:%M:%S')}
+            for taken_at, name, size in list_snapshots(self.backup_dir)
+        ]
+        return status
+
+    def start(self):
+        """在后台线程开始一次备份，已有备份在进行时返回 False"""
+        if not self._begin():
+            return False
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    def run(self):
+        """在当前线程执行一次备份，返回快照文件名（已有备份在进行时返回 None）"""
+        if not self._begin():
+            return None
+        return self._run()
+
+    def _begin(self):
+        with self._lock:
+            if self._status['state'] == 'running':
+                return False
+            self._status.update({
+                'state': 'running',
+                'started_time': _now(),
+                'finished_time': None,
+                'remaining_pages': None,
+                'total_pages': None,
+                'error': None
+            })
+            return True
+
+    def _run(self):
+        try:
+            os.makedirs(self.backup_dir, exist_ok=True)
+            path = os.path.join(self.backup_dir, snapshot_name())
+            snapshot(self.db_path, path, self.pages_per_step,
+                     self.step_sleep, self._on_progress)
+            if self.compress:
+                path = compress_file(path)
+            self._rotate()
+
+            with self._lock:
+                self._status.update({
+                    'state': 'idle',
+                    'finished_time': _now(),
+                    'last_snapshot': os.path.basename(path)
+                })
+            return os.path.basename(path)
+
+        except Exception as e:
+            with self._lock:
+                self._status.update({
+                    'state': 'failed',
+                    'finished_time': _now(),
+                    'error': str(e)
+                })
+            print(f"❌ 备份失败: {e}")
+            return None
+
+    def _on_progress(self, remaining, total):
+        with self._lock:
+            self._status['remaining_pages'] = remaining
+            self._status['total_pages'] = total
+
+    def _rotate(self):
+        for _, name, _ in list_snapshots(self.backup_dir)[self.keep:]:
+            os.remove(os.path.join(self.backup_dir, name))
+
+
+class BackupScheduler:
+    """每隔 interval 秒对 targets() 返回的所有 BackupManager 做一次备份"""
+
+    def __init__(self, interval, targets):
+        self.interval = interval
+        self.targets = targets
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            for manager in self.targets():
+                manager.run()
+
+
+def _change_version(conn):
+    try:
+        row = conn.execute(
+            'SELECT version FROM change_version WHERE id = 1').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def _sequences(conn):
+    """{表名: AUTOINCREMENT 计数器}"""
+    try:
+        return dict(conn.execute('SELECT name, seq FROM sqlite_sequence'))
+    except sqlite3.OperationalError:
+        return {}
+
+
+def _restart_sequences(conn, before):
+    """恢复后把自增计数器推回恢复前的位置，并让变更日志从一个新的位置重新开始
+
+    快照里的计数器比恢复前的小，不处理的话新写入会复用已经发出去的联系人id和
+    日志序号，已经应用过这些序号的跟随节点会跳过或错误地应用新的变更。
+    恢复前的日志全部清掉、序号再跳过一个，所有跟随节点的拉取位置都早于
+    最早保留的日志，主库返回410，跟随节点重新下载快照
+    """
+    tables = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    after = _sequences(conn)
+    for name, seq in before.items():
+        if name not in tables or name == 'changelog':
+            continue
+        if seq > after.get(name, 0):
+            conn.execute('DELETE FROM sqlite_sequence WHERE name = ?', (name,))
+            conn.execute(
+                'INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                (name, seq))
+    if 'changelog' in tables:
+        seq = max(before.get('changelog', 0), after.get('changelog', 0)) + 1
+        conn.execute('DELETE FROM changelog')
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'changelog'")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) "
+                     "VALUES ('changelog', ?)", (seq,))
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+# ========== 命令行 ==========
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="通讯录系统在线备份与恢复")
+    parser.add_argument('--db', default=DEFAULT_DB,
+                        help=f"数据库文件（默认 {DEFAULT_DB}）")
+    parser.add_argument('--dir', default=DEFAULT_BACKUP_DIR,
+                        help=f"快照目录（默认 {DEFAULT_BACKUP_DIR}）")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('backup', help="立即备份一次")
+    run.add_argument('--compress', action='store_true', help="gzip压缩快照")
+    run.add_argument('--keep', type=int, default=DEFAULT_KEEP,
+                     help="保留最近多少份快照")
+    run.add_argument('--pages', type=int, default=DEFAULT_PAGES_PER_STEP,
+                     help="每批复制的页数")
+    run.add_argument('--sleep', type=float, default=DEFAULT_STEP_SLEEP,
+                     help="批次之间休眠的秒数")
+
+    commands.add_parser('list', help="列出快照")
+
+    back = commands.add_parser('restore', help="从快照恢复")
+    back.add_argument('snapshot', nargs='?', help="快照文件名")
+    back.add_argument('--at', help="恢复到该时间点之前最近的快照，"
+                                   "格式 'YYYY-MM-DD HH:MM:SS'")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'backup':
+        manager = BackupManager(args.db, args.dir, args.pages, args.sleep,
+                                args.keep, args.compress)
+        name = manager.run()
+        if name is None:
+            return 1
+        print(f"✅ 备份完成: {os.path.join(args.dir, name)}")
+
+    elif args.command == 'list':
+        snapshots = list_snapshots(args.dir)
+        if not snapshots:
+            print("⚠️  没有快照")
+        for taken_at, name, size in snapshots:
+            print(f"  {taken_at:%Y-%m-%d %H:%M:%S}  {name}  {size:,} 字节")
+
+    else:
+        name = args.snapshot
+        if args.at:
+            point = datetime.strptime(args.at, '%Y-%m-%d %H:%M:%S')
+            # list 只显示到秒，按秒比较
+            candidates = [n for t, n, _ in list_snapshots(args.dir)
+                          if t.replace(microsecond=0) <= point]
+            if not candidates:
+                print(f"❌ 没有 {args.at} 之前的快照")
+                return 1
+            name = candidates[0]
+        if not name:
+            print("❌ 请指定快照文件名或 --at 时间点")
+            return 1
+        path = name if os.path.exists(name) else os.path.join(args.dir, name)
+        if not os.path.exists(path):
+            print(f"❌ 快照不存在: {path}")
+            return 1
+        restore(args.db, path)
+        print(f"✅ 已从 {path} 恢复到 {args.db}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+常驻内存联系人索引 - 通讯录系统
+读请求直接由内存索引返回，不再执行SQL、转换行、拼装字典
+"""
+
+import threading
+from contextlib import contextmanager
+
+from db import ChangeWatcher
+from storage import ContactRepository, MemoryRepository, SQLiteRepository
+
+
+class WriteTracker:
+    """记录索引对应的主库 change_version
+
+    本进程的写事务拿到写锁后（begin）和提交前（commit）各读一次版本，
+    这两个时刻其它连接都提交不了：开始时版本对不上说明之前有别人写过，
+    提交前读到的版本就是提交后索引应对应的版本，之后别人再写都会让版本变大
+    """
+
+    def __init__(self):
+        self.version = None
+        # 本次写操作期间发现了别人的写入，写完需要整体重建
+        self.stale = False
+
+    def begin(self, conn):
+        if _change_version(conn) != self.version:
+            self.stale = True
+
+    def commit(self, conn):
+        self.version = _change_version(conn)
+
+
+class HotIndexRepository(ContactRepository):
+    """挂在 SQLite 前面的常驻内存索引
+
+    - 读操作（列表、收藏、搜索、统计、导出）全部由 MemoryRepository 返回
+    - 写操作先写 SQLite 主库，成功后按主库里的最新数据原地更新索引
+    - 其它进程的写入由 ChangeWatcher 发现，发现后整体重建索引；
+      为了让读请求不执行SQL，这个检查最多每 check_interval 秒做一次
+    - 自己的写入同样会改变 data_version，所以发现变化后再比较主库的 change_version
+      和索引对应的版本（WriteTracker 在写锁内记录），只有别人写过才重建
+    - 分组不进索引：分组的读写和按分组的查询直接走主库，
+      成员表的主键范围扫描只碰分组里的联系人
+    """
+
+    def __init__(self, database, check_interval=1.0):
+        self.tracker = WriteTracker()
+        self.backing = SQLiteRepository(database, fresh=True,
+                                        observer=self.tracker)
+        self.index = MemoryRepository()
+        self.watcher = ChangeWatcher(database.path, check_interval)
+        self._lock = threading.RLock()
+        # 本进程写入或重建索引的次数，即 local_version()
+        self._generation = 0
+
+    def warm(self):
+        """立即建立索引（启动时预热）"""
+        with self._lock:
+            self.watcher.acknowledge()
+            self._load()
+
+    def close(self):
+        self.watcher.close()
+
+    # ========== 读操作：只读内存 ==========
+
+    def list_contacts(self, query=None):
+        if query is not None and query.group_id is not None:
+            return self.backing.list_contacts(query)
+        return self._current().list_contacts(query)
+
+    def get_contact(self, contact_id):
+        return self._current().get_contact(contact_id)
+
+    def list_favorites(self):
+        return self._current().list_favorites()
+
+    def search(self, keyword):
+        return self._current().search(keyword)
+
+    def find_by_method_value(self, value):
+        return self._current().find_by_method_value(value)
+
+    def find_by_method_values(self, values):
+        return self._current().find_by_method_values(values)
+
+    def stats(self, group_id=None):
+        if group_id is not None:
+            return self.backing.stats(group_id)
+        return self._current().stats()
+
+    def sections(self):
+        # 分组人数由主库的 contact_sections 表增量维护，读它比扫描索引便宜
+        return self.backing.sections()
+
+    def analytics(self, days, weeks, today=None):
+        # 同 sections，读触发器维护的汇总表
+        return self.backing.analytics(days, weeks, today)
+
+    def export_rows(self, query=None):
+        if query is not None and query.group_id is not None:
+            return self.backing.export_rows(query)
+        return self._current().export_rows(query)
+
+    def contacts_after(self, contact_id):
+        return self._current().contacts_after(contact_id)
+
+    def change_version(self):
+        # 先读主库版本再强制检查外部写入，之后从索引读到的数据不会比版本旧
+        with self._lock:
+            version = self.backing.change_version()
+            self._refresh(force=True)
+            return version
+
+    def local_version(self):
+        # 只读一个整数：不查主库、不等锁，合并读请求时每个请求都会调用
+        return self._generation
+
+    def list_groups(self):
+        return self.backing.list_groups()
+
+    # ========== 写操作：先写主库，再原地更新索引 ==========
+
+    def add_contact(self, name, methods, is_favorite=False):
+        with self._writing():
+            contact_id = self.backing.add_contact(name, methods, is_favorite)
+            self._sync(contact_id)
+            return contact_id
+
+    def update_contact(self, contact_id, name, methods):
+        with self._writing():
+            updated = self.backing.update_contact(contact_id, name, methods)
+            self._sync(contact_id)
+            return updated
+
+    def delete_contact(self, contact_id):
+        with self._writing():
+            deleted = self.backing.delete_contact(contact_id)
+            self.index.remove(contact_id)
+            return deleted
+
+    def restore_contact(self, contact_id):
+        with self._writing():
+            restored = self.backing.restore_contact(contact_id)
+            self._sync(contact_id)
+            return restored
+
+    def purge_deleted(self, deleted_before, limit=500):
+        # 被清理的联系人早已不在索引里，只需记下主库版本
+        with self._writing():
+            return self.backing.purge_deleted(deleted_before, limit)
+
+    def toggle_favorite(self, contact_id):
+        with self._writing():
+            result = self.backing.toggle_favorite(contact_id)
+            self._sync(contact_id)
+            return result
+
+    def import_contacts(self, records):
+        with self._writing():
+            # AUTOINCREMENT 保证新导入的id都大于已有的最大id
+            last_id = self.index.max_id()
+            result = self.backing.import_contacts(records)
+            for contact in self.backing.contacts_after(last_id):
+                self.index.upsert(contact)
+            return result
+
+    # 分组写入不改变索引里的联系人，只需记下主库版本
+
+    def create_group(self, name):
+        with self._writing():
+            return self.backing.create_group(name)
+
+    def delete_group(self, group_id):
+        with self._writing():
+            return self.backing.delete_group(group_id)
+
+    def add_group_members(self, group_id, contact_ids):
+        with self._writing():
+            return self.backing.add_group_members(group_id, contact_ids)
+
+    def remove_group_members(self, group_id, contact_ids):
+        with self._writing():
+            return self.backing.remove_group_members(group_id, contact_ids)
+
+    # ========== 辅助方法 ==========
+
+    def _current(self):
+        """返回与主库一致的索引，必要时重建"""
+        with self._lock:
+            self._refresh()
+            return self.index
+
+    def _refresh(self, force=False):
+        """data_version 变了且主库版本与索引对应的版本不同时重建"""
+        if not self.watcher.changed(force):
+            return
+        # 先记 data_version 再读版本：之后的写入都会被下次检查发现
+        self.watcher.acknowledge()
+        if self.backing.change_version() != self.tracker.version:
+            self._load()
+
+    @contextmanager
+    def _writing(self):
+        """写操作前确认索引是最新的；写入期间发现别人的写入时写完整体重建
+
+        自己的写入由 WriteTracker 记下版本，不会触发重建
+        """
+        with self._lock:
+            self._refresh(force=True)
+            self.tracker.stale = False
+            try:
+                yield
+            except Exception:
+                # 写入失败时不确定主库和索引的状态，下次读取时重建
+                self.tracker.version = None
+                self.watcher.invalidate()
+                raise
+            finally:
+                self._generation += 1
+            if self.tracker.stale:
+                self._load()
+
+    def _sync(self, contact_id):
+        contact = self.backing.get_contact(contact_id)
+        if contact is None:
+            self.index.remove(contact_id)
+        else:
+            self.index.upsert(contact)
+
+    def _load(self):
+        # 先记版本再读数据：读取期间若有外部写入，下次检查会再重建一次
+        self.tracker.version = self.backing.change_version()
+        self.tracker.stale = False
+        self._generation += 1
+        try:
+            self.index.load(self.backing.list_contacts())
+        except Exception:
+            self.tracker.version = None
+            self.watcher.invalidate()
+            raise
+
+
+def _change_version(conn):
+    return conn.execute(
+        'SELECT version FROM change_version WHERE id = 1').fetchone()[0]
+
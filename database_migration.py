@@ -2,343 +2,689 @@
 """
 数据库迁移脚本 - 通讯录系统
 将旧版本数据库迁移到新版本（支持书签、多联系方式）
+
+非交互运行，适合CI和大数据量：
+    python database_migration.py migrate --db contacts.db --chunk-size 5000
+    python database_migration.py create --sample-data
+    python database_migration.py verify
+    python database_migration.py compact --db contacts.db --runs 5
+
+迁移按旧表rowid分块进行，每块在一个事务里复制并记录进度（检查点），
+中断后再次运行 migrate 会从上一个检查点继续。
+
+compact 把已迁移的数据库重建为紧凑结构（schema_migrations 版本8），
+并输出重建前后的文件大小和典型查询耗时对比。
 """
 
-import sqlite3
+import argparse
 import os
-import shutil
-from datetime import datetime
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
 
-def migrate_database():
-    """迁移数据库到新结构"""
+import schema_migrations
+from backup import snapshot
+from db import Database
+from maintenance import full_vacuum
+from schema_migrations import CREATE_CONTACT_METHODS_SQL, CREATE_CONTACTS_SQL
+from storage import SQLiteRepository
+
+DEFAULT_DB = 'contacts.db'
+DEFAULT_CHUNK_SIZE = 5000
+
+# 迁移期间旧表改名为这个名字
+LEGACY_TABLE = 'contacts_legacy'
+# 迁移进度表（检查点）
+PROGRESS_TABLE = 'migration_progress'
+PROGRESS_NAME = 'legacy_contacts'
+
+def migrate_database(db_path=DEFAULT_DB, chunk_size=DEFAULT_CHUNK_SIZE,
+                     mode='sql', backup=True, drop_legacy=False):
+    """迁移数据库到新结构
+
+    mode:
+    - sql: 每块用 INSERT ... SELECT 在SQLite内部复制，最快
+    - stream: 每块读到Python里用 executemany 写入，
+      旧字段里用 ; 或 , 分隔的多个电话/邮箱会拆成多条联系方式
+    返回是否成功（已经是新结构也算成功）
+    """
     print("=" * 50)
     print("🔄 通讯录系统数据库迁移工具")
     print("=" * 50)
-    
-    old_db_path = 'contacts.db'
-    
-    # 检查旧数据库是否存在
-    if not os.path.exists(old_db_path):
-        print("❌ 未找到旧的数据库文件 contacts.db")
+
+    if not os.path.exists(db_path):
+        print(f"❌ 未找到旧的数据库文件 {db_path}")
         print("✅ 将创建新的数据库结构...")
-        create_new_database()
-        return
-    
-    # 备份旧数据库
-    backup_name = f"contacts_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    try:
-        shutil.copy2(old_db_path, backup_name)
-        print(f"📁 已备份旧数据库: {backup_name}")
-    except Exception as e:
-        print(f"❌ 备份数据库失败: {e}")
-        return
-    
+        return create_new_database(db_path)
+
+    conn = sqlite3.connect(db_path)
     try:
-        # 连接到旧数据库
-        old_conn = sqlite3.connect(old_db_path)
-        old_cursor = old_conn.cursor()
-        
-        # 检查旧表结构
-        old_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='contacts'")
-        if not old_cursor.fetchone():
-            print("⚠️ 旧数据库中没有contacts表，将创建新结构")
-            old_conn.close()
-            create_new_database()
-            return
-        
-        # 获取旧表结构
-        old_cursor.execute("PRAGMA table_info(contacts)")
-        old_columns = old_cursor.fetchall()
-        
-        print("📊 旧表结构分析:")
-        column_names = []
-        for col in old_columns:
-            col_name = col[1]
-            col_type = col[2]
-            column_names.append(col_name)
-            print(f"   - {col_name} ({col_type})")
-        
-        # 检查是否是新结构（已经有is_favorite字段）
-        if 'is_favorite' in column_names:
-            print("✅ 数据库已经是新结构，无需迁移")
-            old_conn.close()
-            return
-        
-        # 获取旧数据
-        print("\n📥 正在读取旧数据...")
-        old_cursor.execute('SELECT * FROM contacts')
-        old_contacts = old_cursor.fetchall()
-        
-        # 根据列名创建映射
-        name_index = column_names.index('name') if 'name' in column_names else None
-        phone_index = column_names.index('phone') if 'phone' in column_names else None
-        email_index = column_names.index('email') if 'email' in column_names else None
-        id_index = column_names.index('id') if 'id' in column_names else 0
-        
-        if name_index is None:
-            print("❌ 旧表缺少必需的name字段")
-            old_conn.close()
-            return
-        
-        print(f"✅ 找到 {len(old_contacts)} 个联系人")
-        old_conn.close()
-        
-        # 创建新数据库
-        print("\n🏗️ 创建新数据库结构...")
-        new_conn = sqlite3.connect('contacts.db')
-        new_cursor = new_conn.cursor()
-        
-        # 创建新表结构
-        new_cursor.execute('''
-            CREATE TABLE IF NOT EXISTS contacts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                is_favorite BOOLEAN DEFAULT 0,
-                created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        new_cursor.execute('''
-            CREATE TABLE IF NOT EXISTS contact_methods (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                contact_id INTEGER NOT NULL,
-                method_type TEXT NOT NULL,
-                method_value TEXT NOT NULL,
-                FOREIGN KEY (contact_id) REFERENCES contacts(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # 迁移数据
-        print("\n🚚 正在迁移数据...")
-        migrated_count = 0
-        error_count = 0
-        
-        for old_contact in old_contacts:
-            try:
-                # 提取数据
-                contact_id = old_contact[id_index] if len(old_contact) > id_index else None
-                name = old_contact[name_index] if len(old_contact) > name_index else ""
-                
-                # 插入新联系人表（不指定id，让SQLite自动生成）
-                new_cursor.execute('INSERT INTO contacts (name) VALUES (?)', (name,))
-                new_contact_id = new_cursor.lastrowid
-                
-                # 迁移电话
-                if phone_index is not None and len(old_contact) > phone_index:
-                    phone = old_contact[phone_index]
-                    if phone and str(phone).strip():
-                        new_cursor.execute(
-                            'INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                            (new_contact_id, 'phone', str(phone).strip())
-                        )
-                
-                # 迁移邮箱
-                if email_index is not None and len(old_contact) > email_index:
-                    email = old_contact[email_index]
-                    if email and str(email).strip():
-                        new_cursor.execute(
-                            'INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                            (new_contact_id, 'email', str(email).strip())
-                        )
-                
-                migrated_count += 1
-                
-                # 显示进度
-                if migrated_count % 10 == 0:
-                    print(f"  已迁移 {migrated_count} 个联系人...")
-                    
-            except Exception as e:
-                error_count += 1
-                print(f"  ⚠️ 迁移联系人失败 (ID: {contact_id}): {e}")
-        
-        new_conn.commit()
-        new_conn.close()
-        
+        progress = _load_progress(conn)
+
+        if progress and progress['status'] == 'running':
+            print(f"⏯️  发现未完成的迁移，从 rowid {progress['last_rowid']} 继续"
+                  f"（已迁移 {progress['migrated']} 个联系人）")
+        else:
+            columns = _table_columns(conn, 'contacts')
+            if not columns:
+                print("⚠️ 旧数据库中没有contacts表，将创建新结构")
+                _upgrade_schema(db_path)
+                return True
+
+            print("📊 旧表结构分析:")
+            for col_name, col_type in columns:
+                print(f"   - {col_name} ({col_type})")
+
+            # 检查是否是新结构（已经有is_favorite字段）
+            if 'is_favorite' in [name for name, _ in columns]:
+                print("✅ 数据库已经是新结构，无需迁移")
+                _upgrade_schema(db_path)
+                return True
+
+            if 'name' not in [name for name, _ in columns]:
+                print("❌ 旧表缺少必需的name字段")
+                return False
+
+            if backup:
+                backup_name = _backup(db_path)
+                if backup_name is None:
+                    return False
+
+            progress = _start_migration(conn)
+
+        # 在备份之后再切换WAL，保证备份的是一个完整的单文件
+        _tune_for_bulk_load(conn)
+        legacy_columns = [name for name, _ in _table_columns(conn,
+                                                               LEGACY_TABLE)]
+        copy_chunk = _copy_chunk_sql if mode == 'sql' else _copy_chunk_stream
+
+        total = conn.execute(
+            f'SELECT COUNT(*) FROM {LEGACY_TABLE} WHERE rowid > ?',
+            (progress['last_rowid'],)
+        ).fetchone()[0] + progress['migrated']
+        print(f"\n🚚 正在迁移数据（共 {total} 个联系人，每块 {chunk_size} 个，"
+              f"模式: {mode}）...")
+
+        last_rowid = progress['last_rowid']
+        migrated = progress['migrated']
+        started = time.monotonic()
+        migrated_this_run = 0
+        last_report = started
+
+        while True:
+            copied, last_rowid = copy_chunk(conn, legacy_columns,
+                                            last_rowid, chunk_size)
+            if copied == 0:
+                break
+
+            migrated += copied
+            migrated_this_run += copied
+            _save_progress(conn, last_rowid, migrated, 'running')
+            conn.commit()  # 检查点：本块数据和进度一起提交
+
+            now = time.monotonic()
+            if now - last_report >= 1 or migrated == total:
+                elapsed = now - started
+                rate = migrated_this_run / elapsed if elapsed else 0
+                percent = migrated / total * 100 if total else 100
+                print(f"  已迁移 {migrated}/{total} 个联系人 "
+                      f"({percent:.1f}%, {rate:,.0f} 个/秒)")
+                last_report = now
+
+        if drop_legacy:
+            conn.execute(f'DROP TABLE {LEGACY_TABLE}')
+            print(f"🗑️  已删除旧表 {LEGACY_TABLE}")
+        _save_progress(conn, last_rowid, migrated, 'done')
+        conn.commit()
+
+        # 数据搬完后再建索引和应用后续版本，比边写边维护索引快得多
+        print("\n🏗️ 应用表结构版本迁移...")
+        _upgrade_schema(db_path)
+
+        elapsed = time.monotonic() - started
+        rate = migrated_this_run / elapsed if elapsed else 0
         print("\n" + "=" * 50)
         print("📈 迁移完成！")
-        print(f"✅ 成功迁移: {migrated_count} 个联系人")
-        if error_count > 0:
-            print(f"⚠️  迁移失败: {error_count} 个联系人")
-        print(f"📁 旧数据库备份: {backup_name}")
+        print(f"✅ 成功迁移: {migrated} 个联系人")
+        print(f"⏱️  本次耗时 {elapsed:.2f} 秒，平均 {rate:,.0f} 个/秒")
+        if not drop_legacy:
+            print(f"📁 旧数据保留在表 {LEGACY_TABLE} 中")
         print("📊 新数据库结构:")
-        print("  - contacts表: id, name, is_favorite, created_time")
-        print("  - contact_methods表: id, contact_id, method_type, method_value")
+        print("  - contacts表: id, name, is_favorite, created_time(整数秒)")
+        print("  - contact_methods表: contact_id, seq, type_id, method_value")
+        print("  - method_types表: id, name")
+        print("  - contact_groups表: id, name, member_count")
+        print("  - group_members表: group_id, contact_id")
+        print("  - contact_daily_counts / method_type_counts表: 统计报表汇总")
         print("=" * 50)
-        
+        return True
+
     except Exception as e:
+        conn.rollback()
         print(f"\n❌ 迁移过程出错: {e}")
-        print("⚠️  正在恢复备份...")
-        try:
-            if os.path.exists(backup_name):
-                shutil.copy2(backup_name, old_db_path)
-                print("✅ 已恢复原始数据库")
-        except Exception as restore_error:
-            print(f"❌ 恢复备份失败: {restore_error}")
-
-def create_new_database():
-    """创建全新的数据库结构"""
+        print("⚠️  已提交的检查点会保留，修复问题后重新运行 migrate 即可继续")
+        return False
+    finally:
+        conn.close()
+
+
+def _tune_for_bulk_load(conn):
+    """批量写入时的连接参数"""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-65536')  # 64MB
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+
+def _table_columns(conn, table):
+    """[(列名, 类型), ...]，表不存在时返回空列表"""
+    return [(col[1], col[2])
+            for col in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _backup(db_path):
+    backup_name = os.path.join(
+        os.path.dirname(db_path),
+        f"contacts_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    )
     try:
-        # 删除可能存在的旧文件
-        if os.path.exists('contacts.db'):
-            os.remove('contacts.db')
+        # 用 backup API 复制，得到的是一致的快照（包含尚未checkpoint的WAL内容）
+        snapshot(db_path, backup_name)
+        print(f"📁 已备份旧数据库: {backup_name}")
+        return backup_name
+    except Exception as e:
+        print(f"❌ 备份数据库失败: {e}")
+        return None
+
+
+def _start_migration(conn):
+    """旧表改名、建新表、写入初始进度，作为第一个检查点提交
+
+    sqlite3 模块不会为DDL隐式开启事务，不显式 BEGIN 的话改名和建表会各自
+    自动提交，在写入进度之前崩溃就会留下只有 contacts_legacy 而没有进度行的库，
+    下次运行既不会继续也认不出旧表。这里三步放在同一个事务里，要么全做要么全不做。
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(f'ALTER TABLE contacts RENAME TO {LEGACY_TABLE}')
+        # 只建表不建索引，索引在数据搬完后由 schema_migrations 建立
+        conn.execute(CREATE_CONTACTS_SQL)
+        conn.execute(CREATE_CONTACT_METHODS_SQL)
+        _save_progress(conn, 0, 0, 'running')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return _load_progress(conn)
+
+
+def _upgrade_schema(db_path):
+    """把表结构升级到 schema_migrations 中登记的最新版本"""
+    schema_migrations.upgrade(db_path, log=lambda line: print(f"  {line}"))
+
+
+def _load_progress(conn):
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+            name TEXT PRIMARY KEY,
+            last_rowid INTEGER NOT NULL,
+            migrated INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            updated_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute(
+        f'SELECT last_rowid, migrated, status FROM {PROGRESS_TABLE} '
+        'WHERE name=?',
+        (PROGRESS_NAME,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {'last_rowid': row[0], 'migrated': row[1], 'status': row[2]}
+
+
+def _save_progress(conn, last_rowid, migrated, status):
+    conn.execute(f'''
+        INSERT OR REPLACE INTO {PROGRESS_TABLE}
+            (name, last_rowid, migrated, status, updated_time)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (PROGRESS_NAME, last_rowid, migrated, status))
+
+
+def _created_time_column(legacy_columns):
+    for column in ('created_time', 'created_at'):
+        if column in legacy_columns:
+            return column
+    return None
+
+
+def _copy_chunk_sql(conn, legacy_columns, last_rowid, chunk_size):
+    """用 INSERT ... SELECT 复制 rowid 在 (last_rowid, 上界] 内的一块"""
+    upper = conn.execute(
+        f'SELECT rowid FROM {LEGACY_TABLE} WHERE rowid > ? '
+        'ORDER BY rowid LIMIT 1 OFFSET ?',
+        (last_rowid, chunk_size - 1)
+    ).fetchone()
+    if upper is None:
+        upper = conn.execute(
+            f'SELECT MAX(rowid) FROM {LEGACY_TABLE} WHERE rowid > ?',
+            (last_rowid,)
+        ).fetchone()
+    upper = upper[0]
+    if upper is None:
+        return 0, last_rowid
+
+    bounds = (last_rowid, upper)
+    created = _created_time_column(legacy_columns)
+    created_expr = (f'COALESCE({created}, CURRENT_TIMESTAMP)' if created
+                    else 'CURRENT_TIMESTAMP')
+
+    # 沿用旧表的rowid作为新id，重复运行同一块也不会产生重复数据
+    cursor = conn.execute(f'''
+        INSERT OR IGNORE INTO contacts (id, name, is_favorite, created_time)
+        SELECT rowid, COALESCE(TRIM(name), ''), 0, {created_expr}
+        FROM {LEGACY_TABLE}
+        WHERE rowid > ? AND rowid <= ?
+    ''', bounds)
+    copied = cursor.rowcount
+
+    for column, method_type in (('phone', 'phone'), ('email', 'email')):
+        if column not in legacy_columns:
+            continue
+        conn.execute(f'''
+            INSERT INTO contact_methods (contact_id, method_type, method_value)
+            SELECT rowid, ?, TRIM({column})
+            FROM {LEGACY_TABLE}
+            WHERE rowid > ? AND rowid <= ?
+              AND {column} IS NOT NULL AND TRIM({column}) <> ''
+        ''', (method_type,) + bounds)
+
+    return copied, upper
+
+
+def _copy_chunk_stream(conn, legacy_columns, last_rowid, chunk_size):
+    """把一块旧数据读到Python里，拆分多值字段后用 executemany 写入"""
+    method_columns = [c for c in ('phone', 'email') if c in legacy_columns]
+    created = _created_time_column(legacy_columns)
+    select_columns = ['rowid', 'name'] + method_columns
+    if created:
+        select_columns.append(created)
+
+    rows = conn.execute(
+        f'SELECT {", ".join(select_columns)} FROM {LEGACY_TABLE} '
+        'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+        (last_rowid, chunk_size)
+    ).fetchall()
+    if not rows:
+        return 0, last_rowid
+
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    contacts = []
+    methods = []
+    for row in rows:
+        rowid, name = row[0], row[1]
+        contacts.append((
+            rowid,
+            str(name).strip() if name is not None else '',
+            (row[-1] if created else None) or now
+        ))
+        for offset, method_type in enumerate(method_columns, start=2):
+            value = row[offset]
+            if value is None:
+                continue
+            for part in str(value).replace(',', ';').split(';'):
+                part = part.strip()
+                if part:
+                    methods.append((rowid, method_type, part))
+
+    cursor = conn.executemany(
+        'INSERT OR IGNORE INTO contacts (id, name, is_favorite, created_time) '
+        'VALUES (?, ?, 0, ?)',
+        contacts
+    )
+    copied = cursor.rowcount
+    conn.executemany(
+        'INSERT INTO contact_methods (contact_id, method_type, method_value) '
+        'VALUES (?, ?, ?)',
+        methods
+    )
+    return copied, rows[-1][0]
+
+
+def create_new_database(db_path=DEFAULT_DB, sample_data=False, force=False):
+    """创建全新的数据库结构
+
+    数据库文件已存在时需要 force=True 才会删除重建
+    """
+    try:
+        if os.path.exists(db_path):
+            if not force:
+                print(f"❌ {db_path} 已存在，如需删除重建请加 --force")
+                return False
+            os.remove(db_path)
             print("🗑️  已删除旧的数据库文件")
-        
-        # 创建新数据库
-        conn = sqlite3.connect('contacts.db')
-        cursor = conn.cursor()
-        
+
         # 创建新表结构
-        cursor.execute('''
-            CREATE TABLE contacts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                is_favorite BOOLEAN DEFAULT 0,
-                created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE contact_methods (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                contact_id INTEGER NOT NULL,
-                method_type TEXT NOT NULL,
-                method_value TEXT NOT NULL,
-                FOREIGN KEY (contact_id) REFERENCES contacts(id) ON DELETE CASCADE
-            )
-        ''')
-        
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+        _upgrade_schema(db_path)
+
         # 添加一些示例数据（可选）
-        add_sample_data = input("\n是否添加示例数据？(y/n): ").lower().strip()
-        if add_sample_data == 'y' or add_sample_data == 'yes':
+        if sample_data:
             print("\n📝 添加示例数据...")
-            
-            # 示例联系人1
-            cursor.execute('INSERT INTO contacts (name, is_favorite) VALUES (?, ?)', 
-                         ("张三", 1))
-            contact1_id = cursor.lastrowid
-            cursor.execute('INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                         (contact1_id, 'phone', '13800138000'))
-            cursor.execute('INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                         (contact1_id, 'email', 'zhangsan@example.com'))
-            
-            # 示例联系人2
-            cursor.execute('INSERT INTO contacts (name, is_favorite) VALUES (?, ?)', 
-                         ("李四", 0))
-            contact2_id = cursor.lastrowid
-            cursor.execute('INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                         (contact2_id, 'phone', '13900139000'))
-            cursor.execute('INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                         (contact2_id, 'phone', '13900139001'))
-            cursor.execute('INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                         (contact2_id, 'email', 'lisi@example.com'))
-            
-            # 示例联系人3
-            cursor.execute('INSERT INTO contacts (name, is_favorite) VALUES (?, ?)', 
-                         ("王五", 1))
-            contact3_id = cursor.lastrowid
-            cursor.execute('INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                         (contact3_id, 'phone', '13700137000'))
-            cursor.execute('INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                         (contact3_id, 'address', '北京市海淀区'))
-            
-            print("✅ 添加了3个示例联系人")
-        
-        conn.commit()
-        conn.close()
-        
+
+            samples = [
+                ("张三", 1, [('phone', '13800138000'),
+                            ('email', 'zhangsan@example.com')]),
+                ("李四", 0, [('phone', '13900139000'),
+                            ('phone', '13900139001'),
+                            ('email', 'lisi@example.com')]),
+                ("王五", 1, [('phone', '13700137000'),
+                            ('address', '北京市海淀区')]),
+            ]
+            # 通过存储层写入，类型id、拼音排序键和API写入的一致
+            repository = SQLiteRepository(Database(db_path))
+            for name, is_favorite, methods in samples:
+                repository.add_contact(
+                    name, [{'type': t, 'value': v} for t, v in methods],
+                    is_favorite)
+
+            print(f"✅ 添加了{len(samples)}个示例联系人")
+
         print("\n" + "=" * 50)
         print("✅ 新数据库创建完成！")
         print("📊 数据库结构:")
-        print("  - contacts表: id, name, is_favorite, created_time")
-        print("  - contact_methods表: id, contact_id, method_type, method_value")
+        print("  - contacts表: id, name, is_favorite, created_time(整数秒)")
+        print("  - contact_methods表: contact_id, seq, type_id, method_value")
+        print("  - method_types表: id, name")
+        print("  - contact_groups表: id, name, member_count")
+        print("  - group_members表: group_id, contact_id")
+        print("  - contact_daily_counts / method_type_counts表: 统计报表汇总")
         print("=" * 50)
-        
+        return True
+
     except Exception as e:
         print(f"❌ 创建新数据库失败: {e}")
+        return False
+
 
-def verify_database():
+def verify_database(db_path=DEFAULT_DB):
     """验证数据库结构"""
     print("\n🔍 验证数据库结构...")
-    
-    if not os.path.exists('contacts.db'):
+
+    if not os.path.exists(db_path):
         print("❌ 数据库文件不存在")
         return False
-    
+
     try:
-        conn = sqlite3.connect('contacts.db')
+        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        
+
         # 检查表是否存在
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         tables = cursor.fetchall()
         table_names = [table[0] for table in tables]
-        
+
+        cursor.execute("PRAGMA user_version")
+        print(f"📌 表结构版本: {cursor.fetchone()[0]}"
+              f"（最新 {schema_migrations.LATEST_VERSION}）")
+
         print("📋 数据库中的表:")
         for table in table_names:
             print(f"  - {table}")
-        
+
         # 检查contacts表结构
         if 'contacts' in table_names:
             cursor.execute("PRAGMA table_info(contacts)")
             columns = cursor.fetchall()
             print("\n📊 contacts表结构:")
-            required_columns = ['id', 'name', 'is_favorite', 'created_time']
+            required_columns = ['id', 'name', 'is_favorite', 'created_time',
+                                'deleted_at', 'initial', 'sort_key']
             for col in columns:
                 col_name = col[1]
                 col_type = col[2]
                 status = "✅" if col_name in required_columns else "❌"
                 print(f"  {status} {col_name} ({col_type})")
-        
+
         # 检查contact_methods表结构
         if 'contact_methods' in table_names:
             cursor.execute("PRAGMA table_info(contact_methods)")
             columns = cursor.fetchall()
             print("\n📊 contact_methods表结构:")
-            required_columns = ['id', 'contact_id', 'method_type', 'method_value']
+            required_columns = ['contact_id', 'seq', 'type_id',
+                                'method_value']
             for col in columns:
                 col_name = col[1]
                 col_type = col[2]
                 status = "✅" if col_name in required_columns else "❌"
                 print(f"  {status} {col_name} ({col_type})")
-        
+
         # 检查数据
         print("\n📈 数据统计:")
         cursor.execute("SELECT COUNT(*) FROM contacts")
         contact_count = cursor.fetchone()[0]
         print(f"  - 联系人数量: {contact_count}")
-        
+
         cursor.execute("SELECT COUNT(*) FROM contact_methods")
         method_count = cursor.fetchone()[0]
         print(f"  - 联系方式数量: {method_count}")
-        
+
         cursor.execute("SELECT COUNT(*) FROM contacts WHERE is_favorite = 1")
         favorite_count = cursor.fetchone()[0]
         print(f"  - 收藏联系人数量: {favorite_count}")
-        
+
         conn.close()
-        
+
         print("\n✅ 数据库验证完成")
         return True
-        
+
     except Exception as e:
         print(f"❌ 验证数据库时出错: {e}")
         return False
 
-if __name__ == '__main__':
-    print("通讯录系统数据库迁移工具")
-    print("1. 迁移现有数据库")
-    print("2. 创建全新数据库")
-    print("3. 验证数据库结构")
-    
-    choice = input("\n请选择操作 (1/2/3): ").strip()
-    
-    if choice == '1':
-        migrate_database()
-    elif choice == '2':
-        create_new_database()
-    elif choice == '3':
-        verify_database()
+
+# ========== 紧凑存储 ==========
+
+# 重建前后对比的典型查询：(说明, 旧结构SQL, 紧凑结构SQL)，? 为一个存在的联系方式值
+REPORT_QUERIES = [
+    ("联系人列表（含联系方式）",
+     '''SELECT c.id, c.name, c.is_favorite, c.created_time,
+               m.method_type, m.method_value
+        FROM contacts c LEFT JOIN contact_methods m ON m.contact_id = c.id
+        WHERE c.deleted_at IS NULL
+        ORDER BY c.id, m.method_type''',
+     '''SELECT c.id, c.name, c.is_favorite,
+               datetime(c.created_time, 'unixepoch'), t.name, m.method_value
+        FROM contacts c LEFT JOIN contact_methods m ON m.contact_id = c.id
+        LEFT JOIN method_types t ON t.id = m.type_id
+        WHERE c.deleted_at IS NULL
+        ORDER BY c.id, t.name, m.seq'''),
+    ("有电话的联系人数",
+     "SELECT COUNT(DISTINCT contact_id) FROM contact_methods "
+     "WHERE method_type = 'phone'",
+     "SELECT COUNT(DISTINCT contact_id) FROM contact_methods "
+     "WHERE type_id = (SELECT id FROM method_types WHERE name = 'phone')"),
+    ("按联系方式的值查找",
+     "SELECT contact_id FROM contact_methods WHERE method_value = ?",
+     "SELECT contact_id FROM contact_methods WHERE method_value = ?"),
+    ("创建时间范围筛选",
+     "SELECT COUNT(*) FROM contacts "
+     "WHERE created_time >= '2020-01-01 00:00:00'",
+     "SELECT COUNT(*) FROM contacts WHERE created_time >= 1577836800"),
+]
+
+
+def compact_database(db_path=DEFAULT_DB, backup=True, runs=5):
+    """把数据库重建为紧凑结构，输出重建前后的大小和查询耗时
+
+    重建期间独占数据库，需要停机或在低峰期执行
+    """
+    print("=" * 50)
+    print("🗜️ 通讯录数据库紧凑存储")
+    print("=" * 50)
+
+    if not os.path.exists(db_path):
+        print("❌ 数据库文件不存在")
+        return False
+
+    try:
+        # 先补齐紧凑结构之前的版本，保证对比的只是本次重建的效果
+        schema_migrations.upgrade(db_path, target=7,
+                                  log=lambda line: print(f"  {line}"))
+    except schema_migrations.LegacySchemaError as e:
+        print(f"❌ {e}")
+        return False
+
+    conn = sqlite3.connect(db_path)
+    try:
+        compacted = 'type_id' in [name for name, _ in
+                                  _table_columns(conn, 'contact_methods')]
+    finally:
+        conn.close()
+    if compacted:
+        print("✅ 数据库已经是紧凑结构，无需重建")
+        _upgrade_schema(db_path)
+        return True
+
+    print(f"\n📏 测量重建前的大小和查询耗时（每个查询 {runs} 次取中位数）...")
+    before = _measure(db_path, runs, compact=False)
+
+    if backup and _backup(db_path) is None:
+        return False
+
+    try:
+        print("\n🏗️ 重建表结构...")
+        started = time.monotonic()
+        _upgrade_schema(db_path)
+        # 旧表删除后留下的空闲页整体回收
+        full_vacuum(db_path)
+        elapsed = time.monotonic() - started
+    except Exception as e:
+        print(f"❌ 重建失败: {e}")
+        return False
+
+    print(f"✅ 重建完成，耗时 {elapsed:.2f} 秒")
+    after = _measure(db_path, runs, compact=True)
+    _print_report(before, after)
+    return True
+
+
+def _measure(db_path, runs, compact):
+    """{'file_size', 'objects': {表/索引名: 字节数}, 'queries': {说明: 秒}}"""
+    conn = sqlite3.connect(db_path)
+    try:
+        # 先把WAL里的内容写回主文件，文件大小才准确
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        pages = conn.execute('PRAGMA page_count').fetchone()[0]
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        try:
+            objects = dict(conn.execute(
+                'SELECT name, SUM(pgsize) FROM dbstat GROUP BY name'))
+        except sqlite3.OperationalError:
+            # SQLite 编译时没有开启 dbstat 虚拟表
+            objects = {}
+
+        sample = conn.execute(
+            'SELECT method_value FROM contact_methods LIMIT 1').fetchone()
+        params = sample or ('',)
+        queries = {}
+        for label, legacy_sql, compact_sql in REPORT_QUERIES:
+            sql = compact_sql if compact else legacy_sql
+            args = params if '?' in sql else ()
+            timings = []
+            for _ in range(max(runs, 1)):
+                started = time.perf_counter()
+                conn.execute(sql, args).fetchall()
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            queries[label] = timings[len(timings) // 2]
+    finally:
+        conn.close()
+    return {'file_size': (pages - free) * page_size, 'objects': objects,
+            'queries': queries}
+
+
+def _print_report(before, after):
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "-"
+
+    print("\n" + "=" * 50)
+    print("📊 重建前后对比")
+    print(f"  数据大小: {before['file_size'] / 1024:,.0f} KB -> "
+          f"{after['file_size'] / 1024:,.0f} KB "
+          f"({change(before['file_size'], after['file_size'])})")
+
+    names = sorted(set(before['objects']) | set(after['objects']))
+    if names:
+        print("\n  表和索引（KB）:")
+        for name in names:
+            old = before['objects'].get(name, 0)
+            new = after['objects'].get(name, 0)
+            print(f"    {name:<36} {old / 1024:>10,.0f}"
+                  f" -> {new / 1024:>10,.0f}"
+                  f"  {change(old, new) if old and new else ''}")
+
+    print("\n  查询耗时（毫秒，中位数）:")
+    for label, old in before['queries'].items():
+        new = after['queries'][label]
+        print(f"    {label:<20} {old * 1000:>10.2f} -> {new * 1000:>10.2f}"
+              f"  ({change(old, new)})")
+    print("=" * 50)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="通讯录系统数据库迁移工具")
+    parser.add_argument('--db', default=DEFAULT_DB,
+                        help=f"数据库文件（默认 {DEFAULT_DB}）")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate = commands.add_parser('migrate', help="迁移现有数据库（可断点续跑）")
+    migrate.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                         help="每个检查点迁移的联系人数")
+    migrate.add_argument('--mode', choices=['sql', 'stream'], default='sql',
+                         help="sql: INSERT...SELECT；"
+                              "stream: executemany并拆分多值字段")
+    migrate.add_argument('--no-backup', action='store_true',
+                         help="开始迁移前不备份数据库文件")
+    migrate.add_argument('--drop-legacy', action='store_true',
+                         help=f"迁移完成后删除旧表 {LEGACY_TABLE}")
+
+    create = commands.add_parser('create', help="创建全新数据库")
+    create.add_argument('--sample-data', action='store_true',
+                        help="添加示例数据")
+    create.add_argument('--force', action='store_true',
+                        help="数据库已存在时删除重建")
+
+    commands.add_parser('verify', help="验证数据库结构")
+
+    compact = commands.add_parser(
+        'compact', help="重建为紧凑结构并输出前后的大小和查询耗时")
+    compact.add_argument('--runs', type=int, default=5,
+                         help="每个对比查询的执行次数（取中位数）")
+    compact.add_argument('--no-backup', action='store_true',
+                         help="重建前不备份数据库文件")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'migrate':
+        ok = migrate_database(args.db, args.chunk_size, args.mode,
+                              backup=not args.no_backup,
+                              drop_legacy=args.drop_legacy)
+    elif args.command == 'create':
+        ok = create_new_database(args.db, args.sample_data, args.force)
+    elif args.command == 'compact':
+        ok = compact_database(args.db, backup=not args.no_backup,
+                              runs=args.runs)
     else:
-        print("❌ 无效选择")
-    
-    input("\n按回车键退出...")
\ No newline at end of file
+        ok = verify_database(args.db)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
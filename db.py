@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+数据库连接管理 - 通讯录系统
+写操作走主库文件，只读接口走只读连接池（WAL快照读或定期刷新的副本）
+"""
+
+import contextvars
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+# 不指定地址簿时使用的默认地址簿（对应原来的 contacts.db）
+DEFAULT_BOOK = 'default'
+# 每执行这么多条SQLite虚拟机指令检查一次查询预算
+PROGRESS_STEPS = 1000
+
+# 当前请求的查询预算（QueryBudget），没有时不限制
+_query_budget = contextvars.ContextVar('query_budget', default=None)
+
+
+class QueryTimeoutError(RuntimeError):
+    """查询超出时间预算，被中断"""
+
+
+class QueryBudget:
+    """一次请求里SQLite语句可以使用的总时间"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+
+    def exhausted(self):
+        return time.monotonic() >= self.deadline
+
+
+def set_query_budget(seconds):
+    """为当前上下文设置查询预算，返回用于 reset_query_budget 的令牌
+
+    之后在这个上下文里从只读连接池执行的语句超过预算时被 progress handler
+    中断，抛出 QueryTimeoutError（WAL模式下读不持有写锁，写操作都是短事务，不设预算）
+    """
+    return _query_budget.set(QueryBudget(seconds) if seconds > 0 else None)
+
+
+def reset_query_budget(token):
+    _query_budget.reset(token)
+
+
+def _over_budget():
+    # progress handler 返回非0时SQLite中断当前语句
+    budget = _query_budget.get()
+    return 1 if budget is not None and budget.exhausted() else 0
+
+
+def _install_budget_check(conn):
+    conn.set_progress_handler(_over_budget, PROGRESS_STEPS)
+    return conn
+
+
+def readonly_uri(path, immutable=False):
+    """生成只读打开数据库用的URI
+
+    immutable=True 告诉SQLite文件不会再变化：不加锁、不检查日志文件，
+    只能用于不会被任何进程写入的快照文件
+    """
+    uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro"
+    return uri + '&immutable=1' if immutable else uri
+
+
+class Database:
+    """一个SQLite数据库文件：写连接直连主库，读连接来自只读连接池
+
+    max_staleness 为只读连接允许落后主库的最长时间（秒）：
+    - 0 表示直接在主库上以只读方式读取，依赖WAL模式的快照读，
+      读事务不阻塞写事务，读到的总是最新提交的数据
+    - 大于0 表示读取一个用 backup API 定期刷新的副本文件，
+      长时间的导出、统计扫描完全不接触主库
+
+    immutable=True 时 path 是预先构建好的只读快照（见 serverless.py），
+    所有连接都以 immutable=1 打开，写入会直接报错；mmap_size 为每个读连接
+    内存映射的字节数，读取直接走操作系统页缓存，不再复制到SQLite自己的缓存
+    """
+
+    def __init__(self, path, max_staleness=0, pool_size=4, immutable=False,
+                 mmap_size=0):
+        self.path = path
+        self.max_staleness = 0 if immutable else max_staleness
+        self.pool_size = pool_size
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.replica_path = f"{os.path.splitext(path)[0]}.replica.db"
+
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # 副本模式下，需要写后读一致的读取仍然直接读主库
+        self._primary_pool = queue.LifoQueue(maxsize=pool_size)
+        # 副本每刷新一次代数加一，旧代数的连接归还时直接关闭
+        self._generation = 0
+        self._refreshed_at = None
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self._closed = False
+
+        # 挂在这个数据库上的进程内附属状态（常驻索引等），随LRU淘汰一起释放
+        self.state = {}
+        # 本进程每个写事务都要通知的对象（联想索引等），见 storage.SQLiteRepository
+        self.write_observers = []
+
+    def connect(self):
+        """获取主库的写连接（调用方负责关闭）"""
+        if self.immutable:
+            # 只读快照：返回只读连接，任何写入都会报 readonly database
+            return sqlite3.connect(readonly_uri(self.path, True), uri=True)
+        conn = sqlite3.connect(self.path)
+        # 彻底删除联系人时由 ON DELETE CASCADE 一起删除联系方式
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    @contextmanager
+    def read(self, fresh=False):
+        """从只读连接池借出一个连接，用完自动归还
+
+        fresh=True 时即使开启了副本也直接读主库，保证读到自己刚写入的数据
+        """
+        use_replica = self.max_staleness > 0 and not fresh
+        if use_replica:
+            self._ensure_fresh_replica()
+
+        generation, conn = self._acquire(use_replica)
+        try:
+            yield conn
+        except sqlite3.OperationalError as e:
+            if _over_budget():
+                raise QueryTimeoutError(
+                    f"查询超过 {_query_budget.get().seconds:g} 秒被中断") from e
+            raise
+        finally:
+            # 借出期间可能开启了读事务，归还前结束它
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(use_replica, generation, conn)
+
+    def close(self):
+        """关闭连接池中所有空闲连接，之后归还的连接也直接关闭"""
+        self._closed = True
+        for item in self.state.values():
+            close = getattr(item, 'close', None)
+            if close:
+                close()
+        for pool in (self._pool, self._primary_pool):
+            while True:
+                try:
+                    _, conn = pool.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+
+    # ========== 连接池 ==========
+
+    def _acquire(self, use_replica):
+        pool = self._pool if use_replica else self._primary_pool
+        # 主库连接不随副本刷新失效，代数固定为0
+        current = self._generation if use_replica else 0
+        while True:
+            try:
+                generation, conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            if generation == current:
+                return generation, conn
+            conn.close()
+
+        source = self.replica_path if use_replica else self.path
+        conn = _install_budget_check(sqlite3.connect(
+            readonly_uri(source, self.immutable), uri=True,
+            check_same_thread=False
+        ))
+        if self.mmap_size:
+            conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        return current, conn
+
+    def _release(self, use_replica, generation, conn):
+        pool = self._pool if use_replica else self._primary_pool
+        current = self._generation if use_replica else 0
+        if self._closed or generation != current:
+            conn.close()
+            return
+        try:
+            pool.put_nowait((generation, conn))
+        except queue.Full:
+            conn.close()
+
+    # ========== 副本刷新 ==========
+
+    def _ensure_fresh_replica(self):
+        """副本过期时触发刷新；没有副本时同步生成，否则后台刷新"""
+        if self._refreshed_at is None:
+            with self._refresh_lock:
+                if self._refreshed_at is None:
+                    self.refresh_replica()
+            return
+
+        age = time.monotonic() - self._refreshed_at
+        if age <= self.max_staleness or self._refreshing:
+            return
+
+        with self._refresh_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self._refresh_lock:
+                self.refresh_replica()
+        except Exception as e:
+            print(f"⚠️  刷新只读副本失败: {e}")
+        finally:
+            self._refreshing = False
+
+    def refresh_replica(self):
+        """用 backup API 把主库复制到临时文件，再原子替换副本文件"""
+        # 多个worker可能同时刷新同一个副本，临时文件名不能重复
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.replica_path) or '.', suffix='.tmp')
+        os.close(fd)
+        try:
+            source = sqlite3.connect(self.path)
+            try:
+                target = sqlite3.connect(tmp_path)
+                try:
+                    source.backup(target)
+                    # 副本只读，不需要WAL；回到rollback日志模式才能纯只读打开
+                    target.execute('PRAGMA journal_mode=DELETE')
+                finally:
+                    target.close()
+            finally:
+                source.close()
+            os.replace(tmp_path, self.replica_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._generation += 1
+        self._refreshed_at = time.monotonic()
+
+
+class ShardManager:
+    """按地址簿分片的数据库管理：每个地址簿一个SQLite文件
+
+    打开的地址簿放在一个有界LRU里，超出上限时关闭最久未使用的地址簿的连接。
+    第一次打开某个地址簿时调用 on_open(path) 懒创建表结构。
+    immutable / mmap_size 传给每个地址簿的 Database（只读快照模式）。
+    """
+
+    def __init__(self, shard_dir, default_path, on_open=None,
+                 max_open=32, max_staleness=0, pool_size=4,
+                 immutable=False, mmap_size=0):
+        self.shard_dir = shard_dir
+        self.default_path = default_path
+        self.on_open = on_open
+        self.max_open = max_open
+        self.max_staleness = max_staleness
+        self.pool_size = pool_size
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path_for(self, book_id):
+        """地址簿对应的数据库文件路径"""
+        if book_id == DEFAULT_BOOK:
+            return self.default_path
+        return os.path.join(self.shard_dir, f"{book_id}.db")
+
+    def peek(self, book_id):
+        """已经打开的地址簿的 Database，没打开时返回 None（不打开、不碰磁盘）"""
+        with self._lock:
+            return self._open.get(book_id)
+
+    def get(self, book_id):
+        """获取地址簿的 Database，必要时打开并放入LRU"""
+        with self._lock:
+            database = self._open.get(book_id)
+            if database is not None:
+                self._open.move_to_end(book_id)
+                return database
+
+        path = self.path_for(book_id)
+        if book_id != DEFAULT_BOOK and not self.immutable:
+            os.makedirs(self.shard_dir, exist_ok=True)
+        if self.on_open:
+            self.on_open(path)
+        database = Database(path, self.max_staleness, self.pool_size,
+                            self.immutable, self.mmap_size)
+
+        with self._lock:
+            # 并发打开同一个地址簿时以先放入的为准
+            existing = self._open.get(book_id)
+            if existing is not None:
+                self._open.move_to_end(book_id)
+                database.close()
+                return existing
+
+            self._open[book_id] = database
+            evicted = []
+            while len(self._open) > self.max_open:
+                _, old = self._open.popitem(last=False)
+                evicted.append(old)
+
+        for old in evicted:
+            old.close()
+        return database
+
+    def book_ids(self):
+        """列出所有已存在的地址簿（包括默认地址簿）"""
+        books = [DEFAULT_BOOK]
+        if os.path.isdir(self.shard_dir):
+            for filename in sorted(os.listdir(self.shard_dir)):
+                book_id, ext = os.path.splitext(filename)
+                if ext == '.db' and not book_id.endswith('.replica'):
+                    books.append(book_id)
+        return books
+
+    def open_book_ids(self):
+        """当前打开着的地址簿（后台维护只处理这些，不为了维护去打开地址簿）"""
+        with self._lock:
+            return list(self._open)
+
+    def close(self):
+        """关闭所有打开的地址簿"""
+        with self._lock:
+            opened = list(self._open.values())
+            self._open.clear()
+        for database in opened:
+            database.close()
+
+
+class ChangeWatcher:
+    """用 PRAGMA data_version 发现其它连接（包括其它进程）提交的写入
+
+    自己的写入同样会改变 data_version，所以写入并同步完派生数据后调用
+    acknowledge() 记下当前版本。changed() 最多每 check_interval 秒
+    真正查询一次数据库，其余时候直接返回 False。
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._conn = None
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def changed(self, force=False):
+        """距离上次 acknowledge() 之后数据库是否被改动过"""
+        with self._lock:
+            if self._version is None:
+                return True
+            if (not force and time.monotonic() - self._checked_at
+                    < self.check_interval):
+                return False
+            return self._current() != self._version
+
+    def acknowledge(self):
+        """把当前版本记为已同步"""
+        with self._lock:
+            self._version = self._current()
+
+    def invalidate(self):
+        """派生数据同步失败时调用，下次 changed() 必定返回 True"""
+        with self._lock:
+            self._version = None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _current(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                readonly_uri(self.path), uri=True, check_same_thread=False
+            )
+        self._checked_at = time.monotonic()
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
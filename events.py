@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+联系人变更事件（Server-Sent Events） - 通讯录系统
+写操作发布精简的变更事件，GET /contacts/events 以SSE推送给客户端，支持 Last-Event-ID 续传。
+
+空闲连接只是阻塞在条件变量上，发布一次事件 O(1)，由各连接自己取走新事件；
+用 gevent worker 运行（gunicorn -k gevent main:app）时每个连接只占一个协程，
+可以挂住成千上万个空闲连接。
+"""
+
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import deque
+
+# 每个地址簿保留的最近事件数，断线续传只能回到这个范围内
+DEFAULT_CAPACITY = 1000
+
+
+class EventHub:
+    """一个地址簿的事件环形缓冲
+
+    事件id为 "<进程标识>-<序号>"；客户端带来的id不是本进程发出的或已经滚出缓冲时，
+    推送 reset 事件，提示客户端重新拉取全量数据
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, version_source=None,
+                 check_interval=1.0):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._events = deque(maxlen=capacity)  # (seq, event_type, data)
+        self._seq = itertools.count(1)
+        self._last_seq = 0
+        self._condition = threading.Condition()
+        self._subscribers = 0
+        self._closed = False
+
+        # version_source() 返回数据变更版本，用来发现其它进程的写入
+        self._version_source = version_source
+        self._known_version = None
+        if version_source is not None:
+            self._known_version = version_source()
+            threading.Thread(target=self._watch, args=(check_interval,),
+                             daemon=True).start()
+
+    @property
+    def subscribers(self):
+        return self._subscribers
+
+    def publish(self, event_type, data, version=None):
+        """发布事件；version 为本次写入后的数据变更版本（本进程的写入不再触发 reset）"""
+        with self._condition:
+            seq = next(self._seq)
+            self._events.append((seq, event_type, data))
+            self._last_seq = seq
+            if version is not None and self._known_version is not None:
+                self._known_version = max(self._known_version, version)
+            self._condition.notify_all()
+        return self.event_id(seq)
+
+    def event_id(self, seq):
+        return f"{self.epoch}-{seq}"
+
+    def parse_id(self, event_id):
+        """Last-Event-ID 转成本进程的序号，无法续传时返回 None"""
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def stream(self, last_event_id=None, heartbeat=15.0):
+        """SSE 文本块的生成器，连接断开（生成器关闭）时自动退订"""
+        with self._condition:
+            self._subscribers += 1
+            last_seq = self._last_seq
+        try:
+            yield 'retry: 3000\n\n'
+            if last_event_id:
+                resumed = self.parse_id(last_event_id)
+                if resumed is None or not self._covers(resumed):
+                    yield format_event(self.event_id(last_seq), 'reset', {})
+                else:
+                    last_seq = resumed
+
+            while not self._closed:
+                events = self._wait(last_seq, heartbeat)
+                if not events:
+                    yield ': keep-alive\n\n'
+                    continue
+                for seq, event_type, data in events:
+                    yield format_event(self.event_id(seq), event_type, data)
+                    last_seq = seq
+        finally:
+            with self._condition:
+                self._subscribers -= 1
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _covers(self, seq):
+        with self._condition:
+            if seq > self._last_seq:
+                return False
+            oldest = self._events[0][0] if self._events else self._last_seq + 1
+            return seq >= oldest - 1
+
+    def _wait(self, last_seq, timeout):
+        """等到有序号大于 last_seq 的事件或超时，返回这些事件"""
+        with self._condition:
+            if self._last_seq <= last_seq and not self._closed:
+                self._condition.wait(timeout)
+            if self._events and self._events[0][0] > last_seq + 1:
+                # 慢客户端落后超过缓冲容量，中间的事件已经丢了
+                seq = self._events[0][0] - 1
+                return [(seq, 'reset', {})] + list(self._events)
+            return [e for e in self._events if e[0] > last_seq]
+
+    def _watch(self, check_interval):
+        """有订阅者时定期检查数据版本，其它进程写入后发布 reset"""
+        while not self._closed:
+            time.sleep(check_interval)
+            if not self._subscribers:
+                continue
+            try:
+                version = self._version_source()
+            except Exception as e:
+                print(f"⚠️  检查数据版本失败: {e}")
+                continue
+            with self._condition:
+                changed = version > self._known_version
+                self._known_version = max(self._known_version, version)
+            if changed:
+                self.publish('reset', {})
+
+
+def format_event(event_id, event_type, data):
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    return f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n"
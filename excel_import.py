@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Excel导入解析 - 通讯录系统
+自动识别列：姓名、收藏、任意联系方式类型的列，以及导出文件里 "类型: 值" 格式的 other_methods 列。
+多个工作表时在子进程中并行解析，解析完成的工作表按批交给同一个写入方。
+导入预检（dry_run）用 iter_sheet 逐行流式解析，并用 validate_record 校验姓名、电话和邮箱。
+"""
+
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from openpyxl import load_workbook
+
+# 表头（去空格、小写后）到字段的映射；没有列出的列都当作一种联系方式
+NAME_HEADERS = {'name', '姓名', '名字'}
+FAVORITE_HEADERS = {'is_favorite', 'favorite', '收藏'}
+OTHER_METHODS_HEADERS = {'other_methods', '其他', '其他联系方式'}
+IGNORED_HEADERS = {'id', 'created_time', '创建时间'}
+METHOD_TYPE_HEADERS = {
+    'phones': 'phone', 'phone': 'phone', '电话': 'phone', '手机': 'phone',
+    'emails': 'email', 'email': 'email', '邮箱': 'email',
+}
+
+# 一个单元格里的多个值用分号分隔
+VALUE_SEPARATORS = (';', '；', '\n')
+TRUE_TEXTS = {'1', 'true', 'yes', 'y', '是'}
+
+# 预检的校验规则：姓名长度；电话只能有数字、空格、横线、括号和开头的 +，数字 5~20 位
+NAME_MAX_LENGTH = 100
+PHONE_PATTERN = re.compile(r'^\+?[\d\s()-]+$')
+PHONE_DIGITS = (5, 20)
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s.]+$')
+
+
+class ImportFormatError(ValueError):
+    """工作表缺少必要的列"""
+
+
+def map_columns(headers):
+    """识别表头，返回 {'name': 列号, 'is_favorite': 列号, 'other_methods': 列号,
+    'methods': [(列号, 联系方式类型), ...]}，没有的字段为 None
+    """
+    mapping = {'name': None, 'is_favorite': None, 'other_methods': None,
+               'methods': []}
+    for position, header in enumerate(headers):
+        if header is None:
+            continue
+        text = str(header).strip()
+        key = text.lower()
+        if not key or key.startswith('unnamed:') or key in IGNORED_HEADERS:
+            continue
+        if key in NAME_HEADERS:
+            field = 'name'
+        elif key in FAVORITE_HEADERS:
+            field = 'is_favorite'
+        elif key in OTHER_METHODS_HEADERS:
+            field = 'other_methods'
+        else:
+            mapping['methods'].append(
+                (position, METHOD_TYPE_HEADERS.get(key, text)))
+            continue
+        if mapping[field] is None:
+            mapping[field] = position
+
+    if mapping['name'] is None:
+        raise ImportFormatError("name")
+    return mapping
+
+
+def cell_text(value):
+    """单元格的值转成文本，空单元格返回空字符串"""
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if value != value:  # NaN
+            return ''
+        # 电话号码常被Excel存成数字，去掉多余的 .0
+        if value.is_integer():
+            value = int(value)
+    return str(value).strip()
+
+
+def split_values(text):
+    """拆分一个单元格里的多个值"""
+    for separator in VALUE_SEPARATORS[1:]:
+        text = text.replace(separator, VALUE_SEPARATORS[0])
+    return [part.strip() for part in text.split(VALUE_SEPARATORS[0])
+            if part.strip()]
+
+
+def parse_other_methods(text):
+    """解析导出的 other_methods：逗号分隔的 "类型: 值"
+
+    不含 "类型: " 的片段视为上一项值里的逗号，拼回上一项
+    """
+    methods = []
+    for part in text.split(','):
+        method_type, separator, value = part.partition(':')
+        if separator and method_type.strip() and value.strip():
+            methods.append({'type': method_type.strip(),
+                            'value': value.strip()})
+        elif methods:
+            methods[-1]['value'] += ',' + part
+        elif part.strip():
+            raise ValueError(f"无法识别的联系方式: {part.strip()}")
+    return methods
+
+
+def parse_favorite(value):
+    text = cell_text(value).lower()
+    if not text:
+        return 0
+    if text in TRUE_TEXTS:
+        return 1
+    return int(float(text) != 0)
+
+
+def iter_records(rows):
+    """逐行解析一个工作表（第一行是表头），产出 (Excel行号, 记录, 错误信息)
+
+    记录为 {'name', 'is_favorite', 'methods'}，解析出错时记录为 None；
+    姓名为空的行跳过。缺少姓名列时在第一次取值时抛出 ImportFormatError
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        raise ImportFormatError("name")
+    mapping = map_columns(header)
+
+    for row_number, row in enumerate(rows, start=2):
+        try:
+            row = tuple(row) + (None,) * (len(header) - len(row))
+            name = cell_text(row[mapping['name']])
+            if not name:
+                continue
+
+            is_favorite = 0
+            if mapping['is_favorite'] is not None:
+                is_favorite = parse_favorite(row[mapping['is_favorite']])
+
+            methods = []
+            for position, method_type in mapping['methods']:
+                for value in split_values(cell_text(row[position])):
+                    methods.append({'type': method_type, 'value': value})
+            if mapping['other_methods'] is not None:
+                methods.extend(parse_other_methods(
+                    cell_text(row[mapping['other_methods']])))
+
+        except Exception as e:
+            yield row_number, None, str(e)
+            continue
+
+        yield row_number, {
+            'name': name,
+            'is_favorite': is_favorite,
+            'methods': methods
+        }, None
+
+
+def parse_rows(rows):
+    """解析一个工作表（第一行是表头）
+
+    返回 (records, row_numbers, errors)：records 为
+    [{'name', 'is_favorite', 'methods'}, ...]，row_numbers 为对应的Excel行号，
+    errors 为 [(行号, 错误信息), ...]
+    """
+    records = []
+    row_numbers = []
+    errors = []
+    for row_number, record, error in iter_records(rows):
+        if record is None:
+            errors.append((row_number, error))
+        else:
+            records.append(record)
+            row_numbers.append(row_number)
+    return records, row_numbers, errors
+
+
+def validate_record(record):
+    """按预检规则检查一条解析好的记录，返回 [(字段, 值, 错误信息), ...]"""
+    problems = []
+    if len(record['name']) > NAME_MAX_LENGTH:
+        problems.append(('name', record['name'],
+                         f"姓名超过{NAME_MAX_LENGTH}个字符"))
+    for method in record['methods']:
+        value = method['value']
+        if method['type'] == 'phone':
+            digits = sum(ch.isdigit() for ch in value)
+            if (not PHONE_PATTERN.match(value)
+                    or not PHONE_DIGITS[0] <= digits <= PHONE_DIGITS[1]):
+                problems.append(('phone', value, "电话号码格式不正确"))
+        elif method['type'] == 'email' and not EMAIL_PATTERN.match(value):
+            problems.append(('email', value, "邮箱格式不正确"))
+    return problems
+
+
+# ========== 读取工作簿 ==========
+
+def sheet_names(path):
+    if path.endswith('.xls'):
+        return list(pd.ExcelFile(path).sheet_names)
+    workbook = load_workbook(path, read_only=True)
+    try:
+        return list(workbook.sheetnames)
+    finally:
+        workbook.close()
+
+
+def iter_sheet(path, sheet_name):
+    """逐行产出一个工作表的 (行号, 记录, 错误信息)，见 iter_records"""
+    if path.endswith('.xls'):
+        # openpyxl 不支持旧格式，交给 pandas（整表读入）
+        df = pd.read_excel(path, sheet_name=sheet_name, dtype=object)
+        yield from iter_records([list(df.columns)] + df.to_numpy().tolist())
+        return
+    # 只读模式按行流式读取，不把整个工作表建成对象
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from iter_records(
+            workbook[sheet_name].iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def parse_sheet(path, sheet_name):
+    """解析工作簿里的一个工作表（子进程里执行）
+
+    返回 (sheet_name, records, row_numbers, errors)；缺少姓名列时 records 为 None
+    """
+    records = []
+    row_numbers = []
+    errors = []
+    try:
+        for row_number, record, error in iter_sheet(path, sheet_name):
+            if record is None:
+                errors.append((row_number, error))
+            else:
+                records.append(record)
+                row_numbers.append(row_number)
+    except ImportFormatError:
+        return sheet_name, None, [], []
+    return sheet_name, records, row_numbers, errors
+
+
+def parse_workbook(path, workers=1):
+    """逐个产出解析好的工作表 (sheet_name, records, row_numbers, errors)
+
+    多个工作表且 workers > 1 时在子进程中并行解析，按完成顺序产出，
+    调用方可以边接收边写入
+    """
+    names = sheet_names(path)
+    if workers <= 1 or len(names) <= 1:
+        for name in names:
+            yield parse_sheet(path, name)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(names))) as pool:
+        futures = [pool.submit(parse_sheet, path, name) for name in names]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def default_workers():
+    return min(4, os.cpu_count() or 1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+导出文件缓存 - 通讯录系统
+生成的导出文件按 (格式, 筛选条件, 数据变更版本) 存在磁盘上，数据没变时直接发送文件；
+同一份导出同时只生成一次，其它并发请求等它生成完
+"""
+
+import hashlib
+import json
+import os
+
+from singleflight import SingleFlight
+
+# 刚生成的文件被并发清理掉时重新生成的次数上限
+MAX_ATTEMPTS = 3
+TMP_PREFIX = 'tmp_'
+
+
+class ExportCache:
+
+    def __init__(self, directory, max_files=16):
+        self.directory = directory
+        self.max_files = max_files
+        self._flight = SingleFlight()
+
+    def open(self, fmt, filters, version, build):
+        """打开缓存文件，没有时先调用 build(path) 生成
+
+        filters 为筛选条件字典；version 为生成时的数据变更版本，
+        必须在读取导出数据之前取得，保证文件内容不比版本旧。
+        返回打开的文件对象，之后即使文件被清理也能正常发送。
+        """
+        digest = hashlib.sha1(
+            json.dumps(filters, sort_keys=True).encode('utf-8')
+        ).hexdigest()[:16]
+        prefix = f"{fmt}_{digest}_"
+        path = os.path.join(self.directory, f"{prefix}{version}.{fmt}")
+        for _ in range(MAX_ATTEMPTS):
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                self._flight.do(
+                    path, lambda: self._build(path, prefix, build))
+                continue
+            # 更新修改时间，清理时按最近使用保留
+            _touch(path)
+            return file
+        raise FileNotFoundError(path)
+
+    def _build(self, path, prefix, build):
+        if os.path.exists(path):
+            return path
+        os.makedirs(self.directory, exist_ok=True)
+        # 临时文件保留扩展名，pandas 按扩展名检查写入格式
+        name = os.path.basename(path)
+        tmp_path = os.path.join(self.directory,
+                                f"{TMP_PREFIX}{os.getpid()}_{name}")
+        try:
+            build(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._prune(path, prefix)
+        return path
+
+    def _prune(self, keep, prefix):
+        """删除同一格式和筛选条件的旧版本，并把文件总数限制在 max_files"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == keep or name.startswith(TMP_PREFIX):
+                continue
+            if name.startswith(prefix):
+                _remove(path)
+            else:
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_files - 1:]:
+            _remove(path)
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _remove(path):
+    # 正在被发送的文件在 Windows 上删不掉，下次再删
+    try:
+        os.remove(path)
+    except OSError:
+        pass
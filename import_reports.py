@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+导入预检报告 - 通讯录系统
+预检（POST /contacts/import?dry_run=1）发现的问题逐条追加写入磁盘上的CSV，
+不在内存里攒一个巨大的错误列表；接口只返回汇总和第一页，其余按页读取或整份下载。
+目录里最多保留 keep 份报告，超出时删除最旧的。
+"""
+
+import csv
+import json
+import os
+import re
+import uuid
+from datetime import datetime
+
+REPORT_COLUMNS = ['sheet', 'row', 'field', 'value', 'kind', 'error']
+REPORT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# 写入中的报告的后缀，写完后改名，读取方不会看到写了一半的文件
+TMP_SUFFIX = '.tmp'
+
+
+class ImportReport:
+    """一份正在写入的报告，用完调用 finish() 或 discard()"""
+
+    def __init__(self, store, report_id):
+        self.store = store
+        self.id = report_id
+        self.issue_count = 0
+        self._tmp_path = store.csv_path(report_id) + TMP_SUFFIX
+        # utf-8-sig 让 Excel 直接打开时中文不乱码
+        self._file = open(self._tmp_path, 'w', newline='',
+                          encoding='utf-8-sig')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(REPORT_COLUMNS)
+
+    def add(self, sheet, row, field, value, kind, error):
+        self._writer.writerow([sheet, row, field, value, kind, error])
+        self.issue_count += 1
+
+    def finish(self, summary):
+        """写入汇总并落盘，返回带 report_id、issue_count、created_time 的汇总"""
+        self._file.close()
+        summary = dict(summary, report_id=self.id,
+                       issue_count=self.issue_count,
+                       created_time=datetime.now().strftime(
+                           '%Y-%m-%d %H:%M:%S'))
+        with open(self.store.summary_path(self.id), 'w',
+                  encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        os.replace(self._tmp_path, self.store.csv_path(self.id))
+        self.store.rotate()
+        return summary
+
+    def discard(self):
+        self._file.close()
+        _remove(self._tmp_path)
+
+
+class ImportReportStore:
+
+    def __init__(self, directory, keep=20):
+        self.directory = directory
+        self.keep = keep
+
+    def create(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return ImportReport(self, uuid.uuid4().hex)
+
+    def csv_path(self, report_id):
+        return os.path.join(self.directory, f"{report_id}.csv")
+
+    def summary_path(self, report_id):
+        return os.path.join(self.directory, f"{report_id}.json")
+
+    def path_for(self, report_id):
+        """报告CSV的路径，id不合法或报告不存在时返回 None"""
+        if not REPORT_ID_PATTERN.match(report_id or ''):
+            return None
+        path = os.path.abspath(self.csv_path(report_id))
+        return path if os.path.isfile(path) else None
+
+    def page(self, report_id, offset, limit):
+        """汇总加上第 offset 条起的最多 limit 条问题，报告不存在时返回 None"""
+        path = self.path_for(report_id)
+        if path is None:
+            return None
+        try:
+            with open(self.summary_path(report_id), encoding='utf-8') as f:
+                summary = json.load(f)
+            issues = []
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                for position, issue in enumerate(reader):
+                    if position < offset:
+                        continue
+                    if len(issues) >= limit:
+                        break
+                    issue['row'] = int(issue['row'])
+                    issues.append(issue)
+        except FileNotFoundError:
+            # 读取时恰好被轮换删除
+            return None
+        return dict(summary, offset=offset, limit=limit, issues=issues)
+
+    def rotate(self):
+        """只保留最新的 keep 份报告"""
+        reports = []
+        for name in os.listdir(self.directory):
+            report_id, ext = os.path.splitext(name)
+            if ext != '.csv' or not REPORT_ID_PATTERN.match(report_id):
+                continue
+            try:
+                reports.append((os.path.getmtime(
+                    os.path.join(self.directory, name)), report_id))
+            except OSError:
+                pass
+        reports.sort(reverse=True)
+        for _, report_id in reports[self.keep:]:
+            _remove(self.csv_path(report_id))
+            _remove(self.summary_path(report_id))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,11 +1,40 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g, Response
 from flask_cors import CORS
 import sqlite3
 import os
+import re
+import random
+import threading
+import time
 import pandas as pd
 from io import BytesIO
+import hmac
 import json
-from datetime import datetime
+import tempfile
+from datetime import datetime, timezone
+from functools import partial, wraps
+
+import replication
+import schema_migrations
+from admission import ConcurrencyLimiter, MemoryTokenBucket, SQLiteTokenBucket
+from backup import BackupManager, BackupScheduler, snapshot as copy_database
+from contact_index import HotIndexRepository
+from db import (DEFAULT_BOOK, ChangeWatcher, QueryTimeoutError, ShardManager,
+                reset_query_budget, set_query_budget)
+from events import EventHub
+from excel_import import (ImportFormatError, default_workers, iter_sheet,
+                          parse_workbook, sheet_names, validate_record)
+from export_cache import ExportCache
+from import_reports import ImportReportStore
+from maintenance import MaintenanceWorker
+from profiling import MODES as PROFILE_MODES, ProfileStore, pstats_text
+from serverless import (FORWARD_HEADERS, PrimaryUnavailableError,
+                        SnapshotMissingError, WriteForwarder, require_snapshot,
+                        snapshot_info, snapshot_paths)
+from singleflight import SingleFlight
+from storage import (EXPORT_COLUMNS, ContactQuery, InvalidQueryError,
+                     MemoryRepository, SQLiteRepository)
+from suggest import SuggestIndex
 
 app = Flask(__name__)
 CORS(app)  # 允许前端跨域访问
@@ -13,35 +42,714 @@ CORS(app)  # 允许前端跨域访问
 # 数据库文件路径
 DATABASE = 'contacts.db'
 
-def init_db():
-    """初始化数据库（新结构）"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # 创建联系人表（去掉单独的phone和email字段）
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS contacts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            is_favorite BOOLEAN DEFAULT 0,
-            created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建联系方式表（支持多个联系方式）
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS contact_methods (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            contact_id INTEGER NOT NULL,
-            method_type TEXT NOT NULL,  -- phone, email, address, social, etc.
-            method_value TEXT NOT NULL,
-            FOREIGN KEY (contact_id) REFERENCES contacts(id) ON DELETE CASCADE
-        )
-    ''')
-    
-    conn.commit()
+# 只读接口允许读到的数据最多落后多少秒
+# 0: 在主库上做WAL快照读；>0: 读取定期用backup API刷新的副本
+READ_MAX_STALENESS = float(os.environ.get('CONTACTS_READ_MAX_STALENESS', 0))
+# 只读连接池大小
+READ_POOL_SIZE = int(os.environ.get('CONTACTS_READ_POOL_SIZE', 4))
+
+# 多地址簿：每个地址簿一个SQLite文件，放在这个目录下
+SHARD_DIR = os.environ.get('CONTACTS_SHARD_DIR', 'books')
+# 同时保持打开的地址簿数量上限（LRU淘汰）
+MAX_OPEN_BOOKS = int(os.environ.get('CONTACTS_MAX_OPEN_BOOKS', 32))
+
+# 只读快照目录（用 python serverless.py build 构建），设置后以只读快照模式运行：
+# 启动时不建表，直接以 immutable=1 打开快照，写请求转发给主库
+SNAPSHOT_DIR = os.environ.get('CONTACTS_SNAPSHOT_DIR')
+# 快照模式下每个读连接内存映射的字节数
+SNAPSHOT_MMAP_SIZE = int(
+    os.environ.get('CONTACTS_SNAPSHOT_MMAP_SIZE', 256 * 1024 * 1024))
+# 快照模式下接收写请求的主库服务地址，不设置时写请求返回503
+PRIMARY_URL = os.environ.get('CONTACTS_PRIMARY_URL')
+# 转发写请求的超时时间（秒）
+PRIMARY_TIMEOUT = float(os.environ.get('CONTACTS_PRIMARY_TIMEOUT', 10))
+
+# 复制角色（见 replication.py）: primary 记录变更日志并提供 /replication/log；
+# follower 从 CONTACTS_PRIMARY_URL 拉取日志应用到本地库，写请求转发给主库
+REPLICATION_ROLE = os.environ.get('CONTACTS_REPLICATION_ROLE', 'primary')
+IS_FOLLOWER = REPLICATION_ROLE == 'follower'
+# 跟随节点复制的地址簿（逗号分隔）
+REPLICATE_BOOKS = [b for b in os.environ.get(
+    'CONTACTS_REPLICATE_BOOKS', DEFAULT_BOOK).split(',') if b]
+# 跟随节点没有新日志时的拉取间隔（秒）和每批应用的日志条数
+REPLICATION_INTERVAL = float(
+    os.environ.get('CONTACTS_REPLICATION_INTERVAL', 1))
+REPLICATION_BATCH_SIZE = int(
+    os.environ.get('CONTACTS_REPLICATION_BATCH_SIZE', 500))
+# 跟随节点转发写请求后，等待本地应用到这次写入的最长时间（秒），0 表示不等待
+REPLICATION_WRITE_WAIT = float(
+    os.environ.get('CONTACTS_REPLICATION_WRITE_WAIT', 2))
+# /replication/log 每次最多返回的日志条数
+REPLICATION_LOG_MAX_LIMIT = 5000
+# 变更日志保留天数，跟随节点落后超过这个时间需要重新下载快照
+CHANGELOG_RETENTION_DAYS = float(
+    os.environ.get('CONTACTS_CHANGELOG_RETENTION_DAYS', 7))
+
+# 存储后端: sqlite（默认）或 memory（纯内存，进程退出即丢失，用于测试和性能对比）
+STORAGE_BACKEND = os.environ.get('CONTACTS_STORAGE', 'sqlite')
+
+# 常驻内存索引（仅 sqlite 后端）: off 关闭；lazy 首次访问时建立；startup 启动时预热
+HOT_INDEX = os.environ.get('CONTACTS_HOT_INDEX', 'off')
+# 常驻索引检查其它进程写入的最小间隔（秒）
+HOT_INDEX_CHECK_INTERVAL = float(
+    os.environ.get('CONTACTS_HOT_INDEX_CHECK_INTERVAL', 1))
+
+# 联想索引检查其它进程写入的最小间隔（秒）
+SUGGEST_CHECK_INTERVAL = float(
+    os.environ.get('CONTACTS_SUGGEST_CHECK_INTERVAL', 1))
+# 联想接口返回条数的默认值和上限
+SUGGEST_DEFAULT_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+
+# 统计报表按天、按周统计的默认跨度和上限
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 366
+ANALYTICS_DEFAULT_WEEKS = 12
+ANALYTICS_MAX_WEEKS = 104
+
+# Excel导入：解析工作表的子进程数、每批写入的记录数
+IMPORT_WORKERS = int(
+    os.environ.get('CONTACTS_IMPORT_WORKERS', default_workers()))
+IMPORT_BATCH_SIZE = int(os.environ.get('CONTACTS_IMPORT_BATCH_SIZE', 1000))
+# 导入预检报告目录（每个地址簿一个子目录）和每个地址簿保留的份数
+IMPORT_REPORT_DIR = os.environ.get('CONTACTS_IMPORT_REPORT_DIR',
+                                   'import_reports')
+IMPORT_REPORT_KEEP = int(os.environ.get('CONTACTS_IMPORT_REPORT_KEEP', 20))
+# 预检报告每页问题条数的默认值和上限
+IMPORT_REPORT_PAGE_SIZE = 100
+IMPORT_REPORT_MAX_PAGE_SIZE = 1000
+
+# 导出格式及其MIME类型
+EXPORT_FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument'
+             '.spreadsheetml.sheet'),
+    'csv': 'text/csv'
+}
+# 导出文件缓存目录（每个地址簿一个子目录）和每个地址簿保留的文件数
+EXPORT_CACHE_DIR = os.environ.get('CONTACTS_EXPORT_CACHE_DIR', 'export_cache')
+EXPORT_CACHE_MAX_FILES = int(
+    os.environ.get('CONTACTS_EXPORT_CACHE_MAX_FILES', 16))
+
+# 在线备份：快照目录（每个地址簿一个子目录）、保留份数、是否gzip压缩
+BACKUP_DIR = os.environ.get('CONTACTS_BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.environ.get('CONTACTS_BACKUP_KEEP', 7))
+BACKUP_COMPRESS = os.environ.get('CONTACTS_BACKUP_COMPRESS', '0') == '1'
+# 定时备份间隔（秒），0 表示不定时备份；只在直接运行 main.py 时启动
+BACKUP_INTERVAL = float(os.environ.get('CONTACTS_BACKUP_INTERVAL', 0))
+# 每批复制的页数和批次之间的休眠（秒），避免备份拖慢正常请求
+BACKUP_PAGES_PER_STEP = int(
+    os.environ.get('CONTACTS_BACKUP_PAGES_PER_STEP', 256))
+BACKUP_STEP_SLEEP = float(os.environ.get('CONTACTS_BACKUP_STEP_SLEEP', 0.01))
+
+# 管理接口（备份、复制、剖析）的令牌，请求头 X-Admin-Token；
+# 未设置时管理接口一律拒绝，跟随节点需要设置与主库相同的令牌
+ADMIN_TOKEN = os.environ.get('CONTACTS_ADMIN_TOKEN')
+ADMIN_HEADER = 'X-Admin-Token'
+
+# 准入控制：耗时路由（全量列表、搜索、导入导出等）和其它路由分别限制并发，
+# 互不占用名额；超出上限的请求最多排队 *_QUEUE_TIMEOUT 秒，排不上返回503
+HEAVY_CONCURRENCY = int(os.environ.get('CONTACTS_HEAVY_CONCURRENCY', 4))
+HEAVY_MAX_WAITING = int(os.environ.get('CONTACTS_HEAVY_MAX_WAITING', 16))
+HEAVY_QUEUE_TIMEOUT = float(os.environ.get('CONTACTS_HEAVY_QUEUE_TIMEOUT', 10))
+LIGHT_CONCURRENCY = int(os.environ.get('CONTACTS_LIGHT_CONCURRENCY', 32))
+LIGHT_MAX_WAITING = int(os.environ.get('CONTACTS_LIGHT_MAX_WAITING', 32))
+LIGHT_QUEUE_TIMEOUT = float(
+    os.environ.get('CONTACTS_LIGHT_QUEUE_TIMEOUT', 0.5))
+HEAVY_ENDPOINTS = {'get_contacts', 'export_contacts', 'import_contacts',
+                   'search_contacts', 'get_all_books_stats', 'start_backup',
+                   'replication_snapshot'}
+# 不受准入控制的路由（健康检查必须始终可用）
+EXEMPT_ENDPOINTS = {'hello', 'health_check'}
+# 长连接路由只限流，不占并发名额（连接数由 EVENTS_MAX_SUBSCRIBERS 限制）
+STREAM_ENDPOINTS = {'contact_events'}
+
+# 变更事件推送（SSE）：每个地址簿保留的事件数、心跳间隔（秒）、
+# 检查其它进程写入的间隔（秒）、每个进程的最大连接数
+EVENTS_CAPACITY = int(os.environ.get('CONTACTS_EVENTS_CAPACITY', 1000))
+EVENTS_HEARTBEAT = float(os.environ.get('CONTACTS_EVENTS_HEARTBEAT', 15))
+EVENTS_CHECK_INTERVAL = float(
+    os.environ.get('CONTACTS_EVENTS_CHECK_INTERVAL', 1))
+EVENTS_MAX_SUBSCRIBERS = int(
+    os.environ.get('CONTACTS_EVENTS_MAX_SUBSCRIBERS', 1000))
+
+# 请求性能剖析（默认关闭，关闭时不注册任何钩子）：
+# 带管理员请求头 X-Profile: cprofile|stacks 的请求，或按采样率随机抽中的请求会被剖析
+PROFILING = os.environ.get('CONTACTS_PROFILING', '0') == '1'
+PROFILE_HEADER = 'X-Profile'
+PROFILE_DIR = os.environ.get('CONTACTS_PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.environ.get('CONTACTS_PROFILE_KEEP', 50))
+PROFILE_SAMPLE_RATE = float(os.environ.get('CONTACTS_PROFILE_SAMPLE_RATE', 0))
+PROFILE_SAMPLE_MODE = os.environ.get('CONTACTS_PROFILE_SAMPLE_MODE', 'stacks')
+PROFILE_SAMPLE_INTERVAL = float(
+    os.environ.get('CONTACTS_PROFILE_SAMPLE_INTERVAL', 0.005))
+
+# 软删除的联系人保留天数，期间可以恢复，过期后由后台维护彻底删除
+DELETED_RETENTION_DAYS = float(
+    os.environ.get('CONTACTS_DELETED_RETENTION_DAYS', 30))
+# 后台维护（清理软删除、孤儿联系方式、增量vacuum、optimize）的检查间隔（秒），
+# 0 表示不运行；只在直接运行 main.py 时启动
+MAINTENANCE_INTERVAL = float(
+    os.environ.get('CONTACTS_MAINTENANCE_INTERVAL', 60))
+# 最近这么多秒内没有请求、也没有正在处理的请求时才做维护
+MAINTENANCE_QUIET_SECONDS = float(
+    os.environ.get('CONTACTS_MAINTENANCE_QUIET_SECONDS', 5))
+# 每批彻底删除的联系人数、每次归还的空闲页数、两次 PRAGMA optimize 的最小间隔（秒）
+MAINTENANCE_BATCH_SIZE = int(
+    os.environ.get('CONTACTS_MAINTENANCE_BATCH_SIZE', 500))
+MAINTENANCE_VACUUM_PAGES = int(
+    os.environ.get('CONTACTS_MAINTENANCE_VACUUM_PAGES', 256))
+MAINTENANCE_OPTIMIZE_INTERVAL = float(
+    os.environ.get('CONTACTS_MAINTENANCE_OPTIMIZE_INTERVAL', 3600))
+
+# 只读请求的SQLite查询时间预算（秒），超出后中断查询并返回503；0 表示不限制
+QUERY_TIMEOUT = float(os.environ.get('CONTACTS_QUERY_TIMEOUT', 10))
+# 子串搜索（单个字符就会扫描全表）和导出单独设置
+SEARCH_QUERY_TIMEOUT = float(
+    os.environ.get('CONTACTS_SEARCH_QUERY_TIMEOUT', 3))
+EXPORT_QUERY_TIMEOUT = float(
+    os.environ.get('CONTACTS_EXPORT_QUERY_TIMEOUT', 60))
+QUERY_TIMEOUTS = {
+    'search_contacts': SEARCH_QUERY_TIMEOUT,
+    'export_contacts': EXPORT_QUERY_TIMEOUT
+}
+
+# 合并相同的并发只读请求（同一地址簿、同一路由和参数、同一数据版本只查询和序列化一次）
+COALESCE_READS = os.environ.get('CONTACTS_COALESCE_READS', '1') == '1'
+
+# 按客户端限流：每秒补充的请求数（0 表示不限流）和允许的突发量
+RATE_LIMIT = float(os.environ.get('CONTACTS_RATE_LIMIT', 0))
+RATE_BURST = float(
+    os.environ.get('CONTACTS_RATE_BURST', max(RATE_LIMIT * 2, 1)))
+# 设置后限流状态存在这个SQLite文件里，多个worker进程共享额度
+RATE_LIMIT_FILE = os.environ.get('CONTACTS_RATE_LIMIT_FILE')
+# 部署在反向代理后面时按 X-Forwarded-For 识别客户端
+TRUST_PROXY = os.environ.get('CONTACTS_TRUST_PROXY', '0') == '1'
+
+# 分组名称的最大长度；批量加入、移出分组时一次最多的联系人数
+GROUP_NAME_MAX_LENGTH = 64
+GROUP_BATCH_MAX = int(os.environ.get('CONTACTS_GROUP_BATCH_MAX', 1000))
+
+# 地址簿id可以通过请求头或路径前缀 /books/<book_id>/... 指定
+BOOK_HEADER = 'X-Address-Book'
+BOOK_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+BOOK_PATH_PATTERN = re.compile(r'^/books/([^/]+)(/.+)$')
+
+class AddressBookError(ValueError):
+    """地址簿id不合法"""
+
+class AddressBookPathMiddleware:
+    """把 /books/<book_id>/contacts... 改写为 /contacts...，地址簿id放入environ"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        match = BOOK_PATH_PATTERN.match(environ.get('PATH_INFO', ''))
+        if match:
+            environ['contacts.book_id'] = match.group(1)
+            environ['PATH_INFO'] = match.group(2)
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = AddressBookPathMiddleware(app.wsgi_app)
+
+def init_db(database=DATABASE):
+    """初始化数据库：应用所有待执行的表结构迁移（见 schema_migrations.py）"""
+    conn = sqlite3.connect(database)
+    # 增量 auto_vacuum 让后台维护可以逐步归还空闲页（只对新建的库生效，
+    # 已有的库需要运行一次 python maintenance.py vacuum --full）
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL模式下读事务不阻塞写事务，只读连接池依赖这一点
+    conn.execute('PRAGMA journal_mode=WAL')
     conn.close()
-    print("✅ 数据库初始化完成（新结构）")
+
+    version = schema_migrations.upgrade(database)
+    print(f"✅ 数据库初始化完成（表结构版本 {version}）")
+
+if SNAPSHOT_DIR:
+    snapshot_database, snapshot_shard_dir = snapshot_paths(SNAPSHOT_DIR)
+    shards = ShardManager(
+        snapshot_shard_dir, snapshot_database,
+        on_open=require_snapshot,
+        max_open=MAX_OPEN_BOOKS,
+        pool_size=READ_POOL_SIZE,
+        immutable=True,
+        mmap_size=SNAPSHOT_MMAP_SIZE
+    )
+else:
+    shards = ShardManager(
+        SHARD_DIR, DATABASE,
+        on_open=init_db,
+        max_open=MAX_OPEN_BOOKS,
+        max_staleness=READ_MAX_STALENESS,
+        pool_size=READ_POOL_SIZE
+    )
+
+def prepare_storage():
+    """启动时准备默认地址簿：普通模式应用表结构迁移，快照模式只检查快照
+
+    跟随节点先为还没有同步过的地址簿下载主库快照
+    """
+    if not SNAPSHOT_DIR:
+        if IS_FOLLOWER:
+            for book_id in REPLICATE_BOOKS:
+                path = shards.path_for(book_id)
+                if replication.needs_bootstrap(path):
+                    seq = replication.bootstrap(path, PRIMARY_URL, book_id,
+                                                ADMIN_TOKEN)
+                    print(f"📥 地址簿 {book_id} 已从主库下载快照（日志位置 {seq}）")
+        init_db()
+        return
+    try:
+        info = snapshot_info(shards.path_for(DEFAULT_BOOK))
+    except SnapshotMissingError as e:
+        print(f"❌ 只读快照不存在: {e}")
+        return
+    print(f"📦 只读快照模式: {info['path']}（表结构版本 "
+          f"{info['schema_version']}，构建于 {info['built_at']}）")
+    if info['schema_version'] != schema_migrations.LATEST_VERSION:
+        print(f"⚠️  快照的表结构版本不是最新的 "
+              f"{schema_migrations.LATEST_VERSION}，请重新构建快照")
+
+def current_book_id():
+    """当前请求的地址簿id（路径前缀优先，其次请求头）"""
+    book_id = (request.environ.get('contacts.book_id')
+               or request.headers.get(BOOK_HEADER)
+               or DEFAULT_BOOK)
+    if not BOOK_ID_PATTERN.match(book_id):
+        raise AddressBookError(book_id)
+    return book_id
+
+def current_database():
+    """当前请求的地址簿对应的数据库"""
+    return shards.get(current_book_id())
+
+# 每个地址簿的进程内状态（内存仓库、常驻索引、联想索引等）
+# sqlite 后端挂在 Database.state 上随LRU淘汰释放；memory 后端放在这里
+memory_book_states = {}
+book_state_lock = threading.Lock()
+
+def book_state(book_id=None):
+    """地址簿的进程内状态字典"""
+    if book_id is None:
+        book_id = current_book_id()
+    if STORAGE_BACKEND == 'memory':
+        with book_state_lock:
+            return memory_book_states.setdefault(book_id, {})
+    return shards.get(book_id).state
+
+def get_book_object(book_id, key, factory):
+    """从地址簿状态中取出对象，不存在时用 factory() 创建"""
+    state = book_state(book_id)
+    with book_state_lock:
+        value = state.get(key)
+        if value is None:
+            value = state[key] = factory()
+        return value
+
+def get_repository(book_id=None, fresh=False):
+    """获取地址簿的存储仓库（默认为当前请求的地址簿）
+
+    fresh=True 保证读到刚提交的数据（不读定期刷新的副本）
+    """
+    if book_id is None:
+        book_id = current_book_id()
+    if STORAGE_BACKEND == 'memory':
+        return get_book_object(book_id, 'memory', MemoryRepository)
+
+    database = shards.get(book_id)
+    if HOT_INDEX == 'off':
+        return SQLiteRepository(database, fresh)
+    return get_book_object(
+        book_id, 'hot_index',
+        lambda: HotIndexRepository(database, HOT_INDEX_CHECK_INTERVAL)
+    )
+
+def cached_repository(book_id):
+    """已经在进程里的存储仓库，不打开地址簿；没有时返回 None"""
+    if STORAGE_BACKEND == 'memory':
+        return get_repository(book_id)
+    database = shards.peek(book_id)
+    if database is None or HOT_INDEX == 'off':
+        return None
+    return database.state.get('hot_index')
+
+def list_book_ids():
+    """所有已存在的地址簿"""
+    if STORAGE_BACKEND == 'memory':
+        with book_state_lock:
+            return sorted(set(memory_book_states) | {DEFAULT_BOOK})
+    return shards.book_ids()
+
+def get_suggest_index(book_id):
+    """地址簿的联想索引（懒建立）"""
+    def load():
+        return get_repository(book_id, fresh=True).list_contacts()
+
+    def create():
+        # 只读快照不会变化，不需要检查外部写入
+        if STORAGE_BACKEND == 'memory' or SNAPSHOT_DIR:
+            return SuggestIndex(load)
+
+        database = shards.get(book_id)
+        index = SuggestIndex(
+            load,
+            ChangeWatcher(database.path, SUGGEST_CHECK_INTERVAL),
+            partial(data_version, book_id)
+        )
+        # 本进程的写事务在写锁内通知索引，记下写入后的版本
+        database.write_observers.append(index)
+        return index
+    return get_book_object(book_id, 'suggest', create)
+
+def get_event_hub(book_id):
+    """地址簿的变更事件缓冲（第一次订阅时建立）"""
+    def create():
+        version_source = None
+        if STORAGE_BACKEND == 'sqlite':
+            version_source = partial(data_version, book_id)
+        return EventHub(EVENTS_CAPACITY, version_source, EVENTS_CHECK_INTERVAL)
+    return get_book_object(book_id, 'events', create)
+
+def data_version(book_id):
+    """主库的数据变更版本"""
+    return SQLiteRepository(shards.get(book_id), fresh=True).change_version()
+
+def notify_change(kind, contact_id=None, **details):
+    """写操作成功后同步进程内的派生结构，并发布变更事件
+
+    kind: upsert（新增/修改）、favorite（收藏）、delete、import、group（分组）；
+    details 为附加在事件里的字段
+    """
+    book_id = current_book_id()
+    state = book_state(book_id)
+
+    suggest_index = state.get('suggest')
+    # 收藏和分组不影响联想键，写入后的版本已经在写事务里记下，不需要更新索引
+    if suggest_index is not None and kind not in ('favorite', 'group'):
+        try:
+            suggest_index.apply_change(
+                kind, contact_id, get_repository(book_id, fresh=True))
+        except Exception as e:
+            print(f"⚠️  更新联想索引失败: {e}")
+
+    hub = state.get('events')
+    if hub is not None:
+        try:
+            data = {} if contact_id is None else {'id': contact_id}
+            data.update(details)
+            version = (data_version(book_id)
+                       if STORAGE_BACKEND == 'sqlite' else None)
+            hub.publish(kind, data, version)
+        except Exception as e:
+            print(f"⚠️  发布变更事件失败: {e}")
+
+def get_backup_manager(book_id):
+    """地址簿的备份管理器"""
+    return get_book_object(book_id, 'backup', lambda: BackupManager(
+        shards.path_for(book_id),
+        os.path.join(BACKUP_DIR, book_id),
+        pages_per_step=BACKUP_PAGES_PER_STEP,
+        step_sleep=BACKUP_STEP_SLEEP,
+        keep=BACKUP_KEEP,
+        compress=BACKUP_COMPRESS
+    ))
+
+def start_backup_schedule():
+    """按 BACKUP_INTERVAL 定时备份所有地址簿"""
+    if BACKUP_INTERVAL <= 0 or STORAGE_BACKEND != 'sqlite' or SNAPSHOT_DIR:
+        return
+    BackupScheduler(
+        BACKUP_INTERVAL,
+        lambda: [get_backup_manager(book_id) for book_id in list_book_ids()]
+    ).start()
+
+def maintenance_books():
+    """后台维护的对象：sqlite 后端只维护当前打开着的地址簿"""
+    if STORAGE_BACKEND == 'memory':
+        return [(book_id, get_repository(book_id), None)
+                for book_id in list_book_ids()]
+    return [(book_id, get_repository(book_id, fresh=True),
+             shards.path_for(book_id))
+            for book_id in shards.open_book_ids()]
+
+def service_quiet():
+    """没有正在处理的请求，且最近 MAINTENANCE_QUIET_SECONDS 秒内没有新请求"""
+    idle = time.monotonic() - last_request_at
+    return (heavy_limiter.stats()['active'] == 0
+            and light_limiter.stats()['active'] == 0
+            and idle >= MAINTENANCE_QUIET_SECONDS)
+
+def start_maintenance():
+    """按 MAINTENANCE_INTERVAL 在服务空闲时做后台维护"""
+    if MAINTENANCE_INTERVAL <= 0 or SNAPSHOT_DIR:
+        return
+    MaintenanceWorker(
+        maintenance_books, service_quiet,
+        interval=MAINTENANCE_INTERVAL,
+        # 跟随节点的软删除由主库清理后经日志同步过来
+        retention_seconds=(None if IS_FOLLOWER
+                           else DELETED_RETENTION_DAYS * 86400),
+        batch_size=MAINTENANCE_BATCH_SIZE,
+        vacuum_pages=MAINTENANCE_VACUUM_PAGES,
+        optimize_interval=MAINTENANCE_OPTIMIZE_INTERVAL,
+        log_retention_seconds=CHANGELOG_RETENTION_DAYS * 86400
+    ).start()
+
+# 跟随节点上每个复制的地址簿一个 replication.Follower
+followers = {}
+
+def start_replication():
+    """跟随节点为每个复制的地址簿启动日志应用线程"""
+    if not IS_FOLLOWER or SNAPSHOT_DIR or STORAGE_BACKEND != 'sqlite':
+        return
+    for book_id in REPLICATE_BOOKS:
+        follower = followers[book_id] = replication.Follower(
+            shards.path_for(book_id), PRIMARY_URL, book_id, ADMIN_TOKEN,
+            REPLICATION_INTERVAL, REPLICATION_BATCH_SIZE, PRIMARY_TIMEOUT)
+        follower.start()
+
+def admin_denied():
+    """管理接口的令牌校验，不通过时返回错误响应"""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "未配置管理令牌，管理接口已关闭"}), 403
+    if not hmac.compare_digest(request.headers.get(ADMIN_HEADER, ''),
+                               ADMIN_TOKEN):
+        return jsonify({"error": "没有管理权限"}), 403
+    return None
+
+heavy_limiter = ConcurrencyLimiter(HEAVY_CONCURRENCY, HEAVY_MAX_WAITING,
+                                   HEAVY_QUEUE_TIMEOUT)
+light_limiter = ConcurrencyLimiter(LIGHT_CONCURRENCY, LIGHT_MAX_WAITING,
+                                   LIGHT_QUEUE_TIMEOUT)
+if RATE_LIMIT <= 0:
+    rate_limiter = None
+elif RATE_LIMIT_FILE:
+    rate_limiter = SQLiteTokenBucket(RATE_LIMIT_FILE, RATE_LIMIT, RATE_BURST)
+else:
+    rate_limiter = MemoryTokenBucket(RATE_LIMIT, RATE_BURST)
+# 最近一次请求的时间，后台维护据此判断服务是否空闲
+last_request_at = time.monotonic()
+
+def client_id():
+    """限流用的客户端标识"""
+    if TRUST_PROXY and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or 'unknown'
+
+@app.before_request
+def admit_request():
+    """先按客户端限流（429），再按路由类别限制并发（503）"""
+    global last_request_at
+    last_request_at = time.monotonic()
+    if (request.method == 'OPTIONS' or request.endpoint is None
+            or request.endpoint in EXEMPT_ENDPOINTS):
+        return None
+
+    if rate_limiter is not None:
+        allowed, wait = rate_limiter.take(client_id())
+        if not allowed:
+            response = jsonify({"error": "请求过于频繁，请稍后再试"})
+            response.headers['Retry-After'] = str(wait)
+            return response, 429
+
+    if request.endpoint in STREAM_ENDPOINTS:
+        return None
+    if COALESCE_READS and request.endpoint in COALESCED_ENDPOINTS:
+        # 这里还没占并发名额，只用不访问数据库的进程内版本
+        key = coalesce_key(local_only=True)
+        if key is not None and read_flight.in_flight(key):
+            return None  # 搭上正在执行的相同请求，不再占并发名额
+    limiter = (heavy_limiter if request.endpoint in HEAVY_ENDPOINTS
+               else light_limiter)
+    if not limiter.acquire():
+        response = jsonify({"error": "服务繁忙，请稍后再试"})
+        response.headers['Retry-After'] = str(limiter.retry_after())
+        return response, 503
+    g.admission = (limiter, time.monotonic())
+    return None
+
+@app.teardown_request
+def release_admission(exc=None):
+    admission = g.pop('admission', None)
+    if admission is not None:
+        limiter, started = admission
+        limiter.release(time.monotonic() - started)
+
+write_forwarder = (WriteForwarder(PRIMARY_URL, PRIMARY_TIMEOUT)
+                   if (SNAPSHOT_DIR or IS_FOLLOWER) and PRIMARY_URL else None)
+# 快照模式和跟随节点在本地处理的请求方法，其余的都转发给主库
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+# 读取主库本地文件的接口：导入预检（POST）在主库上执行，报告也只在主库上
+PRIMARY_READ_ENDPOINTS = {'import_report'}
+
+@app.before_request
+def forward_write():
+    """只读快照模式和跟随节点把写请求原样转发给主库（在准入控制之后）
+
+    跟随节点等本地应用到这次写入后再返回，客户端紧接着读本节点也能读到自己的写入
+    """
+    if (not (SNAPSHOT_DIR or IS_FOLLOWER) or request.endpoint is None
+            or (request.method in READ_METHODS
+                and request.endpoint not in PRIMARY_READ_ENDPOINTS)):
+        return None
+    if write_forwarder is None:
+        return jsonify({"error": "只读节点未配置主库，不能写入"}), 503
+
+    book_id = current_book_id()
+    headers = {BOOK_HEADER: book_id}
+    for name in FORWARD_HEADERS:
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    try:
+        body, status, response_headers = write_forwarder.forward(
+            request.method, request.path,
+            request.query_string.decode('latin-1'), headers,
+            request.get_data())
+    except PrimaryUnavailableError as e:
+        return jsonify({"error": f"主库不可用: {e}"}), 502
+
+    follower = followers.get(book_id)
+    seq = response_headers.get(replication.SEQ_HEADER)
+    if follower is not None and seq and REPLICATION_WRITE_WAIT > 0:
+        follower.wait_for(int(seq), REPLICATION_WRITE_WAIT)
+    return Response(body, status=status, headers=response_headers)
+
+@app.after_request
+def add_replication_seq(response):
+    """主库的写响应带上写入后的日志序号，跟随节点据此等待自己追上"""
+    if (request.method in READ_METHODS or request.endpoint is None
+            or response.status_code >= 400 or STORAGE_BACKEND != 'sqlite'
+            or SNAPSHOT_DIR or IS_FOLLOWER):
+        return response
+    try:
+        with shards.get(current_book_id()).read(fresh=True) as conn:
+            response.headers[replication.SEQ_HEADER] = str(
+                replication.last_seq(conn))
+    except Exception as e:
+        print(f"⚠️  读取变更日志位置失败: {e}")
+    return response
+
+@app.before_request
+def start_query_budget():
+    """只读请求按路由设置查询预算（在准入控制之后，排队时间不计入）"""
+    if (request.method != 'GET' or request.endpoint is None
+            or request.endpoint in STREAM_ENDPOINTS):
+        return None
+    seconds = QUERY_TIMEOUTS.get(request.endpoint, QUERY_TIMEOUT)
+    g.query_budget = set_query_budget(seconds)
+    return None
+
+@app.teardown_request
+def end_query_budget(exc=None):
+    token = g.pop('query_budget', None)
+    if token is not None:
+        reset_query_budget(token)
+
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_KEEP,
+                             PROFILE_SAMPLE_INTERVAL)
+
+def start_profile():
+    """按请求头或采样率决定是否剖析这个请求"""
+    if request.endpoint is None or request.endpoint in STREAM_ENDPOINTS:
+        return None
+    mode = request.headers.get(PROFILE_HEADER)
+    if mode:
+        if admin_denied() is not None:
+            return None
+        if mode not in PROFILE_MODES:
+            mode = 'cprofile'
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        mode = PROFILE_SAMPLE_MODE
+    else:
+        return None
+
+    session = profile_store.start(mode)
+    if session is not None:
+        g.profile = session
+    return None
+
+def finish_profile(response):
+    """保存剖析结果，文件名放在响应头 X-Profile-Id 里"""
+    session = g.pop('profile', None)
+    if session is not None:
+        response.headers['X-Profile-Id'] = profile_store.finish(
+            session, request.endpoint)
+    return response
+
+def finish_profile_on_error(exc=None):
+    # 视图抛出异常时 after_request 不会执行，这里兜底保存
+    session = g.pop('profile', None)
+    if session is not None:
+        profile_store.finish(session, request.endpoint)
+
+if PROFILING:
+    # 在准入控制之后注册，排队等待的时间不计入剖析
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(finish_profile_on_error)
+
+read_flight = SingleFlight()
+# 用 @coalesced 装饰的路由
+COALESCED_ENDPOINTS = set()
+
+def coalesce_key(local_only=False):
+    """合并键：地址簿、路由、参数和数据变更版本
+
+    带上版本后，写入之后发起的读请求不会搭上写入之前开始的查询。
+    优先用进程内版本（内存存储、热索引），不查库也不等索引的锁；
+    没有进程内版本时查主库的 change_version，local_only=True 时返回 None
+    """
+    key = g.get('coalesce_key')
+    if key is None:
+        book_id = current_book_id()
+        if local_only:
+            repository = cached_repository(book_id)
+            version = repository and repository.local_version()
+            if version is None:
+                return None
+        else:
+            repository = get_repository(book_id)
+            version = repository.local_version()
+            if version is None:
+                version = repository.change_version()
+        key = g.coalesce_key = (
+            book_id, request.endpoint, request.query_string,
+            tuple(sorted((request.view_args or {}).items())), version)
+    return key
+
+def coalesced(view):
+    """同时到达的相同只读请求共享一次查询和序列化后的响应体"""
+    COALESCED_ENDPOINTS.add(view.__name__)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not COALESCE_READS:
+            return view(*args, **kwargs)
+
+        def render():
+            response = app.make_response(view(*args, **kwargs))
+            return (response.get_data(), response.status_code,
+                    response.mimetype)
+
+        body, status, mimetype = read_flight.do(coalesce_key(), render)
+        return Response(body, status=status, mimetype=mimetype)
+    return wrapper
+
+@app.errorhandler(AddressBookError)
+def handle_address_book_error(e):
+    return jsonify({"error": f"地址簿id不合法: {e}"}), 400
+
+@app.errorhandler(SnapshotMissingError)
+def handle_snapshot_missing(e):
+    return jsonify({"error": "地址簿不存在"}), 404
+
+@app.errorhandler(QueryTimeoutError)
+def handle_query_timeout(e):
+    return jsonify({"error": f"{e}，请缩小查询范围后重试"}), 503
+
+@app.errorhandler(InvalidQueryError)
+def handle_invalid_query(e):
+    return jsonify({"error": f"查询参数不合法: {e}"}), 400
 
 @app.route('/')
 def hello():
@@ -53,49 +761,56 @@ def hello():
 
 @app.route('/health')
 def health_check():
-    return jsonify({"status": "healthy", "message": "服务运行正常"}), 200
+    health = {
+        "status": "healthy",
+        "message": "服务运行正常",
+        "admission": {
+            "heavy": heavy_limiter.stats(),
+            "light": light_limiter.stats()
+        },
+        "coalescing": read_flight.stats()
+    }
+    if followers:
+        health["replication"] = [follower.stats()
+                                 for follower in followers.values()]
+    if SNAPSHOT_DIR:
+        try:
+            snapshot = snapshot_info(shards.path_for(DEFAULT_BOOK))
+        except SnapshotMissingError:
+            snapshot = None
+        health["snapshot"] = {
+            "info": snapshot,
+            "writes": write_forwarder.stats() if write_forwarder else None
+        }
+    return jsonify(health), 200
 
 # ========== 联系人管理 ==========
 
 @app.route('/contacts', methods=['GET'])
+@coalesced
 def get_contacts():
-    """获取所有联系人及其联系方式"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # 获取所有联系人
-    cursor.execute('SELECT id, name, is_favorite, created_time FROM contacts ORDER BY is_favorite DESC, created_time DESC')
-    contacts = cursor.fetchall()
-    
-    # 获取所有联系方式
-    cursor.execute('SELECT contact_id, method_type, method_value FROM contact_methods ORDER BY contact_id, method_type')
-    methods = cursor.fetchall()
-    
-    conn.close()
-    
-    # 组装数据
-    contact_list = []
-    for contact in contacts:
-        contact_id, name, is_favorite, created_time = contact
-        
-        # 查找该联系人的所有联系方式
-        contact_methods = []
-        for method in methods:
-            if method[0] == contact_id:
-                contact_methods.append({
-                    'type': method[1],
-                    'value': method[2]
-                })
-        
-        contact_list.append({
-            'id': contact_id,
-            'name': name,
-            'is_favorite': bool(is_favorite),
-            'created_time': created_time,
-            'methods': contact_methods
-        })
-    
-    return jsonify(contact_list)
+    """获取联系人及其联系方式
+
+    可选参数：is_favorite=1/0、has=联系方式类型（可重复）、created_from、
+    created_to（YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS）、name_prefix、
+    initial=拼音分组字母、group=分组id、
+    sort=name/created_time/id/pinyin（前面加 - 倒序）、limit、offset
+    """
+    query = ContactQuery.from_params(request.args)
+    return jsonify(get_repository().list_contacts(query))
+
+@app.route('/contacts/sections', methods=['GET'])
+@coalesced
+def get_contact_sections():
+    """A-Z 分组索引：每个字母的人数和在 ?sort=pinyin 列表中的起始位置
+
+    客户端跳到某个字母时请求 /contacts?sort=pinyin&offset=<offset>&limit=<n>
+    """
+    sections = get_repository().sections()
+    return jsonify({
+        "total": sum(section['count'] for section in sections),
+        "sections": sections
+    })
 
 @app.route('/contacts', methods=['POST'])
 def add_contact():
@@ -107,25 +822,9 @@ def add_contact():
     if not name:
         return jsonify({"error": "姓名不能为空"}), 400
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
     try:
-        # 插入联系人
-        cursor.execute('INSERT INTO contacts (name) VALUES (?)', (name,))
-        contact_id = cursor.lastrowid
-        
-        # 插入所有联系方式
-        for method in methods:
-            method_type = method.get('type')
-            method_value = method.get('value')
-            if method_type and method_value:
-                cursor.execute(
-                    'INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                    (contact_id, method_type, method_value)
-                )
-        
-        conn.commit()
+        contact_id = get_repository().add_contact(name, methods)
+        notify_change('upsert', contact_id)
         return jsonify({
             "message": "联系人添加成功",
             "id": contact_id,
@@ -133,10 +832,7 @@ def add_contact():
         }), 201
         
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 @app.route('/contacts/<int:contact_id>', methods=['PUT'])
 def update_contact(contact_id):
@@ -145,208 +841,380 @@ def update_contact(contact_id):
     name = data.get('name')
     methods = data.get('methods', [])
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
     try:
-        # 更新联系人基本信息
-        if name:
-            cursor.execute('UPDATE contacts SET name=? WHERE id=?', (name, contact_id))
-        
-        # 删除旧的联系方式
-        cursor.execute('DELETE FROM contact_methods WHERE contact_id=?', (contact_id,))
-        
-        # 插入新的联系方式
-        for method in methods:
-            method_type = method.get('type')
-            method_value = method.get('value')
-            if method_type and method_value:
-                cursor.execute(
-                    'INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                    (contact_id, method_type, method_value)
-                )
-        
-        conn.commit()
+        if not get_repository().update_contact(contact_id, name, methods):
+            return jsonify({"error": "联系人不存在"}), 404
+        notify_change('upsert', contact_id)
         return jsonify({"message": "联系人更新成功"})
         
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 @app.route('/contacts/<int:contact_id>', methods=['DELETE'])
 def delete_contact(contact_id):
-    """删除联系人（级联删除联系方式）"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
+    """删除联系人（软删除，保留期内可以恢复）"""
     try:
-        cursor.execute('DELETE FROM contacts WHERE id=?', (contact_id,))
-        conn.commit()
-        affected_rows = cursor.rowcount
-        
-        if affected_rows > 0:
-            return jsonify({"message": "联系人删除成功"})
+        if get_repository().delete_contact(contact_id):
+            notify_change('delete', contact_id)
+            return jsonify({
+                "message": "联系人删除成功",
+                "restore_days": DELETED_RETENTION_DAYS
+            })
         else:
             return jsonify({"error": "联系人不存在"}), 404
             
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+
+@app.route('/contacts/<int:contact_id>/restore', methods=['POST'])
+def restore_contact(contact_id):
+    """恢复保留期内删除的联系人"""
+    try:
+        if get_repository().restore_contact(contact_id):
+            notify_change('upsert', contact_id)
+            return jsonify({"message": "联系人恢复成功"})
+        else:
+            return jsonify({"error": "联系人不存在或已被彻底删除"}), 404
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 # ========== 书签功能 ==========
 
 @app.route('/contacts/<int:contact_id>/favorite', methods=['PUT'])
 def toggle_favorite(contact_id):
     """切换联系人的收藏状态"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('UPDATE contacts SET is_favorite = NOT is_favorite WHERE id=?', (contact_id,))
-        conn.commit()
-        
-        # 获取更新后的状态
-        cursor.execute('SELECT name, is_favorite FROM contacts WHERE id=?', (contact_id,))
-        result = cursor.fetchone()
+        result = get_repository().toggle_favorite(contact_id)
         
         if result:
+            name, is_favorite = result
+            notify_change('favorite', contact_id, is_favorite=is_favorite)
             return jsonify({
-                "message": f"{'取消' if result[1] else '添加'}收藏成功",
-                "name": result[0],
-                "is_favorite": bool(result[1])
+                "message": f"{'取消' if is_favorite else '添加'}收藏成功",
+                "name": name,
+                "is_favorite": is_favorite
             })
         else:
             return jsonify({"error": "联系人不存在"}), 404
             
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 @app.route('/contacts/favorites', methods=['GET'])
+@coalesced
 def get_favorites():
     """获取所有收藏的联系人"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT c.id, c.name, c.is_favorite, c.created_time,
-               cm.method_type, cm.method_value
-        FROM contacts c
-        LEFT JOIN contact_methods cm ON c.id = cm.contact_id
-        WHERE c.is_favorite = 1
-        ORDER BY c.created_time DESC
-    ''')
-    
-    results = cursor.fetchall()
-    conn.close()
-    
-    # 组织数据
-    favorites = {}
-    for row in results:
-        contact_id = row[0]
-        if contact_id not in favorites:
-            favorites[contact_id] = {
-                'id': contact_id,
-                'name': row[1],
-                'is_favorite': bool(row[2]),
-                'created_time': row[3],
-                'methods': []
-            }
-        
-        if row[4] and row[5]:  # 如果有联系方式
-            favorites[contact_id]['methods'].append({
-                'type': row[4],
-                'value': row[5]
-            })
-    
-    return jsonify(list(favorites.values()))
+    return jsonify(get_repository().list_favorites())
+
+# ========== 分组功能 ==========
+
+@app.route('/groups', methods=['GET'])
+@coalesced
+def list_groups():
+    """所有分组及成员人数（分组里的联系人用 GET /contacts?group=<id>）"""
+    return jsonify(get_repository().list_groups())
+
+@app.route('/groups', methods=['POST'])
+def create_group():
+    """创建分组"""
+    data = request.json or {}
+    name = (data.get('name') or '').strip()
+
+    if not name:
+        return jsonify({"error": "分组名称不能为空"}), 400
+    if len(name) > GROUP_NAME_MAX_LENGTH:
+        return jsonify({"error": f"分组名称不能超过{GROUP_NAME_MAX_LENGTH}个字符"}), 400
+
+    try:
+        group_id = get_repository().create_group(name)
+        if group_id is None:
+            return jsonify({"error": "同名分组已存在"}), 409
+        notify_change('group', group_id=group_id)
+        return jsonify({
+            "message": "分组创建成功",
+            "id": group_id,
+            "name": name
+        }), 201
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/groups/<int:group_id>', methods=['DELETE'])
+def delete_group(group_id):
+    """删除分组（分组里的联系人不受影响）"""
+    try:
+        if get_repository().delete_group(group_id):
+            notify_change('group', group_id=group_id)
+            return jsonify({"message": "分组删除成功"})
+        else:
+            return jsonify({"error": "分组不存在"}), 404
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def group_member_ids():
+    """请求体里的 contact_ids，返回 (联系人id列表, 错误响应)"""
+    contact_ids = (request.json or {}).get('contact_ids')
+    if (not isinstance(contact_ids, list) or not contact_ids
+            or not all(type(i) is int for i in contact_ids)):
+        return None, (jsonify({"error": "contact_ids 必须是非空的联系人id列表"}), 400)
+    if len(contact_ids) > GROUP_BATCH_MAX:
+        return None, (jsonify({"error": f"一次最多处理{GROUP_BATCH_MAX}个联系人"}), 400)
+    return contact_ids, None
+
+@app.route('/groups/<int:group_id>/members', methods=['POST'])
+def add_group_members(group_id):
+    """批量加入分组：{"contact_ids": [1, 2, ...]}，不存在、已删除或已在分组里的联系人跳过"""
+    contact_ids, error = group_member_ids()
+    if error:
+        return error
+
+    try:
+        added = get_repository().add_group_members(group_id, contact_ids)
+        if added is None:
+            return jsonify({"error": "分组不存在"}), 404
+        notify_change('group', group_id=group_id)
+        return jsonify({
+            "message": f"已加入{added}个联系人",
+            "added": added,
+            "skipped": len(contact_ids) - added
+        })
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/groups/<int:group_id>/members', methods=['DELETE'])
+def remove_group_members(group_id):
+    """批量移出分组：{"contact_ids": [1, 2, ...]}"""
+    contact_ids, error = group_member_ids()
+    if error:
+        return error
+
+    try:
+        removed = get_repository().remove_group_members(group_id, contact_ids)
+        if removed is None:
+            return jsonify({"error": "分组不存在"}), 404
+        notify_change('group', group_id=group_id)
+        return jsonify({
+            "message": f"已移出{removed}个联系人",
+            "removed": removed
+        })
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 # ========== 导入导出功能 ==========
 
+def write_export(rows, fmt, target):
+    """把导出行写成 xlsx 或 csv，target 为文件路径或文件对象"""
+    df = pd.DataFrame(rows, columns=EXPORT_COLUMNS)
+    if fmt == 'csv':
+        # 带BOM，Excel直接打开不会乱码
+        df.to_csv(target, index=False, encoding='utf-8-sig')
+        return
+
+    with pd.ExcelWriter(target, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='通讯录', index=False)
+
+        # 获取工作表并设置列宽
+        worksheet = writer.sheets['通讯录']
+        worksheet.column_dimensions['A'].width = 8   # ID
+        worksheet.column_dimensions['B'].width = 15  # 姓名
+        worksheet.column_dimensions['C'].width = 10  # 收藏
+        worksheet.column_dimensions['D'].width = 25  # 电话
+        worksheet.column_dimensions['E'].width = 30  # 邮箱
+        worksheet.column_dimensions['F'].width = 35  # 其他
+
+def get_export_cache(book_id):
+    """地址簿的导出文件缓存"""
+    return get_book_object(book_id, 'export_cache', lambda: ExportCache(
+        os.path.join(EXPORT_CACHE_DIR, book_id), EXPORT_CACHE_MAX_FILES))
+
 @app.route('/contacts/export', methods=['GET'])
 def export_contacts():
-    """导出所有联系人到Excel"""
+    """导出联系人到Excel（?format=csv 导出CSV，筛选和排序参数同 GET /contacts）"""
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"不支持的导出格式: {fmt}"}), 400
+    query = ContactQuery.from_params(request.args)
+
     try:
-        conn = sqlite3.connect(DATABASE)
+        repository = get_repository()
+        filters = query.to_dict()
         
-        # 查询所有联系人及其联系方式
-        query = '''
-            SELECT 
-                c.id,
-                c.name,
-                c.is_favorite,
-                GROUP_CONCAT(
-                    CASE 
-                        WHEN cm.method_type = 'phone' THEN cm.method_value
-                        ELSE NULL
-                    END
-                ) as phones,
-                GROUP_CONCAT(
-                    CASE 
-                        WHEN cm.method_type = 'email' THEN cm.method_value
-                        ELSE NULL
-                    END
-                ) as emails,
-                GROUP_CONCAT(
-                    CASE 
-                        WHEN cm.method_type NOT IN ('phone', 'email') 
-                        THEN cm.method_type || ': ' || cm.method_value
-                        ELSE NULL
-                    END
-                ) as other_methods
-            FROM contacts c
-            LEFT JOIN contact_methods cm ON c.id = cm.contact_id
-            GROUP BY c.id
-        '''
+        def build(target):
+            write_export(repository.export_rows(query), fmt, target)
         
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        
-        # 清理数据
-        if 'phones' in df.columns:
-            df['phones'] = df['phones'].apply(lambda x: x.replace(',', ';') if pd.notna(x) else '')
-        if 'emails' in df.columns:
-            df['emails'] = df['emails'].apply(lambda x: x.replace(',', ';') if pd.notna(x) else '')
-        
-        # 创建Excel文件
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='通讯录', index=False)
-            
-            # 获取工作表并设置列宽
-            worksheet = writer.sheets['通讯录']
-            worksheet.column_dimensions['A'].width = 8   # ID
-            worksheet.column_dimensions['B'].width = 15  # 姓名
-            worksheet.column_dimensions['C'].width = 10  # 收藏
-            worksheet.column_dimensions['D'].width = 25  # 电话
-            worksheet.column_dimensions['E'].width = 30  # 邮箱
-            worksheet.column_dimensions['F'].width = 35  # 其他
-        
-        output.seek(0)
+        if STORAGE_BACKEND == 'sqlite':
+            # 数据没有变化时直接发送上次生成的文件
+            version = repository.change_version()
+            output = get_export_cache(current_book_id()).open(
+                fmt, filters, version, build)
+        else:
+            output = BytesIO()
+            build(output)
+            output.seek(0)
         
         # 生成文件名
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f'通讯录_导出_{timestamp}.xlsx'
+        filename = f'通讯录_导出_{timestamp}.{fmt}'
         
-        return send_file(
+        response = send_file(
             output,
             download_name=filename,
             as_attachment=True,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype=EXPORT_FORMATS[fmt]
         )
+        # 传入文件对象时 send_file 不知道文件大小
+        if STORAGE_BACKEND == 'sqlite':
+            response.content_length = os.fstat(output.fileno()).st_size
+        return response
         
     except Exception as e:
         return jsonify({"error": f"导出失败: {str(e)}"}), 500
 
+def import_workbook(path):
+    """解析并导入工作簿中所有带姓名列的工作表
+
+    工作表在子进程中并行解析，解析好的记录按 IMPORT_BATCH_SIZE 分批写入
+    返回 (成功条数, 错误信息列表, 导入的工作表数)
+    """
+    repository = get_repository()
+    success_count = 0
+    errors = []
+    sheets = set()
+
+    for sheet_name, records, row_numbers, row_errors in parse_workbook(
+            path, IMPORT_WORKERS):
+        if records is None:
+            continue
+        sheets.add(sheet_name)
+        errors.extend((sheet_name, row, message)
+                      for row, message in row_errors)
+
+        for start in range(0, len(records), IMPORT_BATCH_SIZE):
+            count, failures = repository.import_contacts(
+                records[start:start + IMPORT_BATCH_SIZE])
+            success_count += count
+            errors.extend((sheet_name, row_numbers[start + position], message)
+                          for position, message in failures)
+
+    # 只有一个工作表时沿用原来的错误格式
+    messages = [
+        (f"工作表'{sheet_name}'" if len(sheets) > 1 else "")
+        + f"第{row}行错误: {message}"
+        for sheet_name, row, message in errors
+    ]
+    return success_count, messages, len(sheets)
+
+def get_import_reports(book_id):
+    """地址簿的导入预检报告目录"""
+    return get_book_object(
+        book_id, 'import_reports', lambda: ImportReportStore(
+            os.path.join(IMPORT_REPORT_DIR, book_id), IMPORT_REPORT_KEEP))
+
+def check_import_batch(repository, sheet_name, batch, seen, report, totals):
+    """校验一批 (行号, 记录)，用一次批量查找检查联系方式是否与已有联系人重复
+
+    seen 记录文件里已出现过的值 -> (工作表, 行号)，用来发现文件内部的重复
+    """
+    values = {method['value'] for _, record in batch
+              for method in record['methods']}
+    existing = repository.find_by_method_values(values)
+
+    for row_number, record in batch:
+        problems = validate_record(record)
+        for field, value, message in problems:
+            report.add(sheet_name, row_number, field, value, 'invalid',
+                       message)
+        if problems:
+            totals['invalid'] += 1
+            continue
+        totals['importable'] += 1
+
+        duplicated = False
+        for method in record['methods']:
+            value = method['value']
+            if value in existing:
+                ids = ', '.join(str(i) for i in existing[value])
+                report.add(sheet_name, row_number, method['type'], value,
+                           'duplicate', f"与已有联系人重复（id: {ids}）")
+                duplicated = True
+            elif value in seen:
+                first_sheet, first_row = seen[value]
+                report.add(sheet_name, row_number, method['type'], value,
+                           'duplicate_in_file',
+                           f"与工作表'{first_sheet}'第{first_row}行重复")
+                duplicated = True
+            else:
+                seen[value] = (sheet_name, row_number)
+        if duplicated:
+            totals['duplicates'] += 1
+        else:
+            totals['clean'] += 1
+
+def check_workbook(path, report):
+    """导入预检：逐行流式解析并校验所有带姓名列的工作表，不写入任何数据
+
+    问题逐条写入 report，返回汇总计数：sheets、rows（非空行）、importable（能导入）、
+    invalid（解析或格式错误）、duplicates（能导入但与已有数据或文件内重复）、clean（没有问题）
+    """
+    repository = get_repository()
+    totals = {'sheets': 0, 'rows': 0, 'importable': 0, 'invalid': 0,
+              'duplicates': 0, 'clean': 0}
+    seen = {}
+
+    for sheet_name in sheet_names(path):
+        batch = []
+        try:
+            for row_number, record, error in iter_sheet(path, sheet_name):
+                totals['rows'] += 1
+                if record is None:
+                    report.add(sheet_name, row_number, '', '', 'parse', error)
+                    totals['invalid'] += 1
+                    continue
+                batch.append((row_number, record))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    check_import_batch(repository, sheet_name, batch, seen,
+                                       report, totals)
+                    batch = []
+        except ImportFormatError:
+            # 缺少姓名列的工作表和正式导入一样跳过
+            continue
+        if batch:
+            check_import_batch(repository, sheet_name, batch, seen,
+                               report, totals)
+        totals['sheets'] += 1
+    return totals
+
+def dry_run_import(path):
+    """预检上传的工作簿，返回 (响应JSON, 状态码)"""
+    store = get_import_reports(current_book_id())
+    report = store.create()
+    try:
+        totals = check_workbook(path, report)
+    except Exception:
+        report.discard()
+        raise
+    if totals['sheets'] == 0:
+        report.discard()
+        return {"error": "Excel缺少必要列: name"}, 400
+
+    summary = report.finish(totals)
+    result = store.page(summary['report_id'], 0, IMPORT_REPORT_PAGE_SIZE)
+    result['message'] = (f"预检完成！可导入: {totals['importable']}条，"
+                         f"有误: {totals['invalid']}条，"
+                         f"重复: {totals['duplicates']}条")
+    return result, 200
+
 @app.route('/contacts/import', methods=['POST'])
 def import_contacts():
-    """从Excel导入联系人"""
+    """从Excel导入联系人
+
+    ?dry_run=1 只做预检：校验姓名、电话、邮箱并检查重复，不写入数据，
+    返回汇总和问题报告的第一页（其余见 GET /contacts/import/reports/<report_id>）
+    """
     try:
         if 'file' not in request.files:
             return jsonify({"error": "没有上传文件"}), 400
@@ -359,67 +1227,25 @@ def import_contacts():
         if not (file.filename.endswith('.xlsx') or file.filename.endswith('.xls')):
             return jsonify({"error": "只支持Excel文件 (.xlsx, .xls)"}), 400
         
-        # 读取Excel文件
-        df = pd.read_excel(file)
+        # 保存到临时文件，供解析子进程读取
+        suffix = os.path.splitext(file.filename)[1]
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            file.save(path)
+            if request.args.get('dry_run') in ('1', 'true'):
+                result, status = dry_run_import(path)
+                return jsonify(result), status
+            success_count, errors, sheet_count = import_workbook(path)
+        finally:
+            os.remove(path)
         
         # 检查必要的列
-        required_columns = ['name']
-        for col in required_columns:
-            if col not in df.columns:
-                return jsonify({"error": f"Excel缺少必要列: {col}"}), 400
-        
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
+        if sheet_count == 0:
+            return jsonify({"error": "Excel缺少必要列: name"}), 400
         
-        success_count = 0
-        error_count = 0
-        errors = []
-        
-        for index, row in df.iterrows():
-            try:
-                # 插入联系人
-                name = str(row['name']).strip()
-                if not name:
-                    continue
-                
-                is_favorite = int(row.get('is_favorite', 0)) if pd.notna(row.get('is_favorite')) else 0
-                
-                cursor.execute(
-                    'INSERT INTO contacts (name, is_favorite) VALUES (?, ?)',
-                    (name, is_favorite)
-                )
-                contact_id = cursor.lastrowid
-                
-                # 处理电话
-                if 'phones' in df.columns and pd.notna(row.get('phones')):
-                    phones = str(row['phones']).split(';')
-                    for phone in phones:
-                        phone = phone.strip()
-                        if phone:
-                            cursor.execute(
-                                'INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                                (contact_id, 'phone', phone)
-                            )
-                
-                # 处理邮箱
-                if 'emails' in df.columns and pd.notna(row.get('emails')):
-                    emails = str(row['emails']).split(';')
-                    for email in emails:
-                        email = email.strip()
-                        if email:
-                            cursor.execute(
-                                'INSERT INTO contact_methods (contact_id, method_type, method_value) VALUES (?, ?, ?)',
-                                (contact_id, 'email', email)
-                            )
-                
-                success_count += 1
-                
-            except Exception as e:
-                error_count += 1
-                errors.append(f"第{index+2}行错误: {str(e)}")
-        
-        conn.commit()
-        conn.close()
+        notify_change('import', count=success_count)
+        error_count = len(errors)
         
         return jsonify({
             "message": f"导入完成！成功: {success_count}条，失败: {error_count}条",
@@ -431,98 +1257,266 @@ def import_contacts():
     except Exception as e:
         return jsonify({"error": f"导入失败: {str(e)}"}), 500
 
+@app.route('/contacts/import/reports/<report_id>', methods=['GET'])
+def import_report(report_id):
+    """分页查看导入预检报告（?offset=&limit=），?format=csv 下载整份报告"""
+    store = get_import_reports(current_book_id())
+    if request.args.get('format') == 'csv':
+        path = store.path_for(report_id)
+        if path is None:
+            return jsonify({"error": "预检报告不存在"}), 404
+        return send_file(path, as_attachment=True, mimetype='text/csv',
+                         download_name=f'导入预检_{report_id}.csv')
+
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', IMPORT_REPORT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "offset 和 limit 必须是整数"}), 400
+    offset = max(0, offset)
+    limit = max(1, min(limit, IMPORT_REPORT_MAX_PAGE_SIZE))
+
+    result = store.page(report_id, offset, limit)
+    if result is None:
+        return jsonify({"error": "预检报告不存在"}), 404
+    return jsonify(result)
+
 # ========== 辅助功能 ==========
 
+@app.route('/contacts/events', methods=['GET'])
+def contact_events():
+    """变更事件流（SSE），断线重连时用 Last-Event-ID 请求头或
+    ?last_event_id= 续传；事件: upsert、favorite、delete、import、group、reset（需重新拉取）
+    """
+    hub = get_event_hub(current_book_id())
+    if hub.subscribers >= EVENTS_MAX_SUBSCRIBERS:
+        response = jsonify({"error": "事件连接数已满，请稍后再试"})
+        response.headers['Retry-After'] = str(int(EVENTS_HEARTBEAT))
+        return response, 503
+
+    last_event_id = (request.headers.get('Last-Event-ID')
+                     or request.args.get('last_event_id'))
+    return Response(
+        hub.stream(last_event_id, EVENTS_HEARTBEAT),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # 关闭nginx缓冲，事件立即送达
+        }
+    )
+
+@app.route('/contacts/suggest', methods=['GET'])
+def suggest_contacts():
+    """输入联想：按姓名、拼音、拼音首字母或电话号码匹配，只返回id和姓名"""
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', SUGGEST_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "limit必须是整数"}), 400
+    limit = max(1, min(limit, SUGGEST_MAX_LIMIT))
+
+    return jsonify(get_suggest_index(current_book_id()).suggest(query, limit))
+
 @app.route('/contacts/search/<keyword>', methods=['GET'])
+@coalesced
 def search_contacts(keyword):
     """搜索联系人（按姓名或联系方式）"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # 搜索联系人
-    cursor.execute('''
-        SELECT DISTINCT c.id, c.name, c.is_favorite, c.created_time
-        FROM contacts c
-        LEFT JOIN contact_methods cm ON c.id = cm.contact_id
-        WHERE c.name LIKE ? OR cm.method_value LIKE ?
-        ORDER BY c.is_favorite DESC, c.created_time DESC
-    ''', (f'%{keyword}%', f'%{keyword}%'))
-    
-    contacts = cursor.fetchall()
-    
-    # 获取这些联系人的所有联系方式
-    contact_ids = [str(c[0]) for c in contacts]
-    if contact_ids:
-        placeholders = ','.join(['?'] * len(contact_ids))
-        cursor.execute(f'''
-            SELECT contact_id, method_type, method_value 
-            FROM contact_methods 
-            WHERE contact_id IN ({placeholders})
-        ''', contact_ids)
-        methods = cursor.fetchall()
-    else:
-        methods = []
-    
-    conn.close()
-    
-    # 组装数据
-    contact_list = []
-    for contact in contacts:
-        contact_id = contact[0]
-        contact_methods = []
-        
-        for method in methods:
-            if method[0] == contact_id:
-                contact_methods.append({
-                    'type': method[1],
-                    'value': method[2]
-                })
-        
-        contact_list.append({
-            'id': contact_id,
-            'name': contact[1],
-            'is_favorite': bool(contact[2]),
-            'created_time': contact[3],
-            'methods': contact_methods
-        })
-    
-    return jsonify(contact_list)
+    return jsonify(get_repository().search(keyword))
 
 @app.route('/contacts/stats', methods=['GET'])
+@coalesced
 def get_stats():
-    """获取统计数据"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM contacts')
-    total = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM contacts WHERE is_favorite = 1')
-    favorites = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(DISTINCT contact_id) FROM contact_methods WHERE method_type = "phone"')
-    with_phone = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(DISTINCT contact_id) FROM contact_methods WHERE method_type = "email"')
-    with_email = cursor.fetchone()[0]
-    
-    conn.close()
-    
+    """获取统计数据（?group=<id> 只统计这个分组的成员）"""
+    group_id = ContactQuery.from_params(request.args).group_id
+    stats = get_repository().stats(group_id)
+    if stats is None:
+        return jsonify({"error": "分组不存在"}), 404
+    return jsonify(stats)
+
+@app.route('/contacts/analytics', methods=['GET'])
+def get_analytics():
+    """统计报表：每天/每周新增人数、收藏占比、各联系方式类型的人数（日期按UTC）
+
+    ?days= 天数（默认30）、?weeks= 周数（默认12）。数据来自触发器维护的汇总表；
+    响应带 ETag（数据版本、参数和当天日期），客户端带 If-None-Match 时数据没变返回 304
+    """
+    try:
+        days = int(request.args.get('days', ANALYTICS_DEFAULT_DAYS))
+        weeks = int(request.args.get('weeks', ANALYTICS_DEFAULT_WEEKS))
+    except ValueError:
+        return jsonify({"error": "days 和 weeks 必须是整数"}), 400
+    days = max(1, min(days, ANALYTICS_MAX_DAYS))
+    weeks = max(1, min(weeks, ANALYTICS_MAX_WEEKS))
+
+    repository = get_repository()
+    # 版本必须在读取报表之前取得，保证报表内容不比 ETag 旧
+    today = datetime.now(timezone.utc).date()
+    etag = (f"{current_book_id()}-{repository.change_version()}-"
+            f"{days}-{weeks}-{today:%Y%m%d}")
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(repository.analytics(days, weeks, today))
+    response.set_etag(etag)
+    # 每次都回源校验，数据没变时只返回 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/books/stats', methods=['GET'])
+def get_all_books_stats():
+    """汇总所有地址簿的统计数据"""
+    books = {}
+    total = {}
+    for book_id in list_book_ids():
+        stats = get_repository(book_id).stats()
+        books[book_id] = stats
+        for key, value in stats.items():
+            total[key] = total.get(key, 0) + value
+
     return jsonify({
-        "total_contacts": total,
-        "favorite_contacts": favorites,
-        "contacts_with_phone": with_phone,
-        "contacts_with_email": with_email
+        "book_count": len(books),
+        "total": total,
+        "books": books
     })
 
+@app.route('/admin/backups', methods=['GET'])
+def get_backup_status():
+    """当前地址簿的备份状态和快照列表"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    if STORAGE_BACKEND != 'sqlite':
+        return jsonify({"error": "内存存储后端不支持备份"}), 400
+    return jsonify(get_backup_manager(current_book_id()).status())
+
+@app.route('/admin/backups', methods=['POST'])
+def start_backup():
+    """在后台开始备份当前地址簿，立即返回，进度通过 GET 查询"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    if STORAGE_BACKEND != 'sqlite':
+        return jsonify({"error": "内存存储后端不支持备份"}), 400
+
+    manager = get_backup_manager(current_book_id())
+    if not manager.start():
+        return jsonify({"error": "已有备份正在进行"}), 409
+    return jsonify({
+        "message": "备份已开始",
+        "status": manager.status()
+    }), 202
+
+# ========== 复制 ==========
+
+@app.route('/replication/log', methods=['GET'])
+def replication_log():
+    """变更日志：序号大于 from 的最多 limit 条，供跟随节点拉取
+
+    需要的日志已被清理时返回 410，跟随节点需要重新下载快照
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+    if STORAGE_BACKEND != 'sqlite' or SNAPSHOT_DIR:
+        return jsonify({"error": "当前存储后端不支持复制"}), 400
+    try:
+        from_seq = int(request.args.get('from', 0))
+        limit = int(request.args.get('limit', REPLICATION_BATCH_SIZE))
+    except ValueError:
+        return jsonify({"error": "from 和 limit 必须是整数"}), 400
+    limit = max(1, min(limit, REPLICATION_LOG_MAX_LIMIT))
+
+    try:
+        with current_database().read(fresh=True) as conn:
+            return jsonify(replication.read_log(conn, from_seq, limit))
+    except replication.ResyncRequired as e:
+        return jsonify({"error": f"{e}，需要重新同步"}), 410
+
+@app.route('/replication/snapshot', methods=['GET'])
+def replication_snapshot():
+    """下载当前地址簿的一致快照，响应头 X-Replication-Seq 为快照对应的日志位置"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    if STORAGE_BACKEND != 'sqlite' or SNAPSHOT_DIR:
+        return jsonify({"error": "当前存储后端不支持复制"}), 400
+
+    book_id = current_book_id()
+    # 经 shards.get 打开，还没创建过的地址簿先建好表结构
+    source_path = current_database().path
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        copy_database(source_path, path)
+        conn = sqlite3.connect(path)
+        try:
+            seq = replication.last_seq(conn)
+        finally:
+            conn.close()
+        output = open(path, 'rb')
+    except Exception:
+        os.remove(path)
+        raise
+
+    try:
+        response = send_file(output, download_name=f'{book_id}.db',
+                             as_attachment=True,
+                             mimetype='application/octet-stream')
+    except Exception:
+        output.close()
+        os.remove(path)
+        raise
+    response.content_length = os.fstat(output.fileno()).st_size
+    response.headers[replication.SEQ_HEADER] = str(seq)
+    # 文件还开着时不能删（Windows上会报错），响应关闭时先关文件再删临时文件；
+    # send_file 默认直通文件对象，不会调用 call_on_close 注册的回调
+    response.direct_passthrough = False
+    response.call_on_close(lambda: os.remove(path))
+    return response
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    """已保存的剖析结果"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({
+        "enabled": PROFILING,
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "profiles": profile_store.list()
+    })
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+def download_profile(name):
+    """下载剖析结果；pstats 文件加 ?format=text 返回按累计耗时排序的文本摘要"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    path = profile_store.path_for(name)
+    if path is None:
+        return jsonify({"error": "剖析结果不存在"}), 404
+
+    if request.args.get('format') == 'text' and name.endswith('.pstats'):
+        return Response(pstats_text(path), mimetype='text/plain')
+    return send_file(path, as_attachment=True, download_name=name,
+                     mimetype='application/octet-stream')
+
 # ========== 启动应用 ==========
 if __name__ == '__main__':
     # 这是本地运行时的代码
-    init_db()
+    prepare_storage()
+    start_replication()
+    if HOT_INDEX == 'startup' and STORAGE_BACKEND == 'sqlite':
+        get_repository(DEFAULT_BOOK).warm()
+    start_backup_schedule()
+    start_maintenance()
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
 else:
     # 这是Vercel Serverless环境运行时的代码
     # Vercel会寻找一个名为 `app` 的Flask应用实例
-    init_db()
+    # 快照模式（CONTACTS_SNAPSHOT_DIR）下不建表，冷启动直接读部署包里的快照
+    prepare_storage()
+    if HOT_INDEX == 'startup' and STORAGE_BACKEND == 'sqlite':
+        get_repository(DEFAULT_BOOK).warm()
     # 注意：在Vercel上，app.run() 不会被调用
\ No newline at end of file
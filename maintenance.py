@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+后台维护 - 通讯录系统
+- purge: 彻底删除保留期已过的软删除联系人（分批短事务，联系方式由外键级联删除）
+- sweep: 清扫没有对应联系人的孤儿联系方式（按联系人id窗口推进游标，每次只扫一小段）
+- vacuum: 增量 vacuum，把空闲页还给文件系统
+- optimize: PRAGMA optimize，按需更新查询规划用的统计信息
+- prune-log: 清理超过保留期的变更日志（见 replication.py）
+- rebuild-analytics: 整体重算统计报表的汇总表（平时由触发器增量维护，手工改过数据后使用）
+
+API 进程里由 MaintenanceWorker 在服务空闲时执行；也可以手动运行：
+
+    python maintenance.py --db contacts.db purge --retention-days 30
+    python maintenance.py --db contacts.db sweep
+    python maintenance.py --db contacts.db vacuum [--full]
+    python maintenance.py --db contacts.db optimize
+    python maintenance.py --db contacts.db prune-log --retention-days 7
+    python maintenance.py --db contacts.db rebuild-analytics
+"""
+
+import argparse
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from db import Database
+from schema_migrations import REBUILD_ANALYTICS_SQL
+from storage import SQLiteRepository
+
+DEFAULT_DB = 'contacts.db'
+DEFAULT_RETENTION_DAYS = 30
+# 变更日志的默认保留天数，跟随节点落后超过这个时间需要重新下载快照
+DEFAULT_LOG_RETENTION_DAYS = 7
+DEFAULT_BATCH_SIZE = 500
+# 每次增量 vacuum 最多归还的页数
+DEFAULT_VACUUM_PAGES = 256
+# 写连接等待写锁的超时时间（秒）
+BUSY_TIMEOUT = 30
+# PRAGMA auto_vacuum 的取值：2 表示 INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def connect(path):
+    """自动提交模式的短连接，每条语句一个事务"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+
+def retention_cutoff(retention_seconds):
+    """保留期的截止时间，格式与 CURRENT_TIMESTAMP 一致（UTC）"""
+    moment = datetime.now(timezone.utc) - timedelta(seconds=retention_seconds)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def purge_deleted(repository, deleted_before, batch_size=DEFAULT_BATCH_SIZE,
+                  pause=0.0, should_continue=None):
+    """分批彻底删除 deleted_before 之前软删除的联系人，返回删除的个数
+
+    should_continue() 返回 False 时在批次之间停下，剩下的留到下次
+    """
+    total = 0
+    while True:
+        purged = repository.purge_deleted(deleted_before, batch_size)
+        total += purged
+        if purged < batch_size:
+            return total
+        if should_continue is not None and not should_continue():
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def sweep_orphans(path, start_id=0, window=DEFAULT_BATCH_SIZE * 10):
+    """删除 contact_id 在 (start_id, start_id + window] 内、没有对应联系人的联系方式
+
+    contact_methods 按 (contact_id, seq) 聚簇存放，按 contact_id 窗口扫描正好是连续的一段。
+    返回 (删除条数, 下次的 start_id)；扫到末尾后游标回到 0
+    """
+    conn = connect(path)
+    try:
+        end_id = start_id + window
+        deleted = conn.execute('''
+            DELETE FROM contact_methods
+            WHERE contact_id > ? AND contact_id <= ?
+              AND NOT EXISTS (SELECT 1 FROM contacts c
+                              WHERE c.id = contact_methods.contact_id)
+        ''', (start_id, end_id)).rowcount
+        max_id = conn.execute(
+            'SELECT MAX(contact_id) FROM contact_methods').fetchone()[0] or 0
+        return deleted, (end_id if end_id < max_id else 0)
+    finally:
+        conn.close()
+
+
+def prune_changelog(path, retention_seconds, batch_size=DEFAULT_BATCH_SIZE,
+                    should_continue=None):
+    """分批删除 retention_seconds 之前的变更日志，返回删除的条数
+
+    日志按序号从旧到新扫描，遇到不满足条件的就停止，不需要 changed_at 上的索引
+    """
+    cutoff = int(time.time() - retention_seconds)
+    conn = connect(path)
+    try:
+        total = 0
+        while True:
+            deleted = conn.execute('''
+                DELETE FROM changelog WHERE seq IN (
+                    SELECT seq FROM changelog WHERE changed_at < ?
+                    ORDER BY seq LIMIT ?
+                )
+            ''', (cutoff, batch_size)).rowcount
+            total += deleted
+            if deleted < batch_size:
+                return total
+            if should_continue is not None and not should_continue():
+                return total
+    finally:
+        conn.close()
+
+
+def incremental_vacuum(path, pages=DEFAULT_VACUUM_PAGES):
+    """归还最多 pages 个空闲页，返回归还的页数
+
+    数据库不是 auto_vacuum=INCREMENTAL 时什么也不做（见 vacuum --full）
+    """
+    conn = connect(path)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] \
+                != AUTO_VACUUM_INCREMENTAL:
+            return 0
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not before:
+            return 0
+        # 每归还一页返回一行，取完结果才会执行完
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def full_vacuum(path):
+    """切换到增量 auto_vacuum 并整体重建数据库文件（期间独占数据库，需停机或低峰期执行）"""
+    conn = connect(path)
+    try:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+def rebuild_analytics(path):
+    """在一个事务里重算 contact_daily_counts / method_type_counts，返回 (天数, 类型数)"""
+    conn = connect(path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in REBUILD_ANALYTICS_SQL:
+                conn.execute(statement)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return (conn.execute(
+                    'SELECT COUNT(*) FROM contact_daily_counts').fetchone()[0],
+                conn.execute(
+                    'SELECT COUNT(*) FROM method_type_counts').fetchone()[0])
+    finally:
+        conn.close()
+
+
+def optimize(path):
+    conn = connect(path)
+    try:
+        conn.execute('PRAGMA optimize')
+    finally:
+        conn.close()
+
+
+class MaintenanceWorker:
+    """后台维护线程：每隔 interval 秒检查一次，服务空闲时依次维护各地址簿
+
+    books() 返回 [(book_id, repository, path), ...]，path 为 None 时
+    （内存存储）只做软删除清理；is_quiet() 返回 False 时在步骤之间停下。
+    retention_seconds 为 None 时不清理软删除的联系人（跟随节点由主库的日志同步删除）
+    """
+
+    def __init__(self, books, is_quiet, interval=60,
+                 retention_seconds=DEFAULT_RETENTION_DAYS * 86400,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 vacuum_pages=DEFAULT_VACUUM_PAGES, optimize_interval=3600,
+                 log_retention_seconds=DEFAULT_LOG_RETENTION_DAYS * 86400):
+        self.books = books
+        self.is_quiet = is_quiet
+        self.interval = interval
+        self.retention_seconds = retention_seconds
+        self.log_retention_seconds = log_retention_seconds
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.optimize_interval = optimize_interval
+        # 每个数据库文件的孤儿清扫游标和上次 optimize 的时间
+        self._sweep_cursors = {}
+        self._optimized_at = {}
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        """维护一轮，返回 {'purged', 'orphans', 'log_entries', 'vacuumed_pages'}"""
+        totals = {'purged': 0, 'orphans': 0, 'log_entries': 0,
+                  'vacuumed_pages': 0}
+        for book_id, repository, path in self.books():
+            if not self.is_quiet():
+                break
+            try:
+                if self.retention_seconds is not None:
+                    totals['purged'] += purge_deleted(
+                        repository, retention_cutoff(self.retention_seconds),
+                        self.batch_size, should_continue=self.is_quiet)
+                if path is None or not self.is_quiet():
+                    continue
+
+                totals['log_entries'] += prune_changelog(
+                    path, self.log_retention_seconds, self.batch_size,
+                    should_continue=self.is_quiet)
+                if not self.is_quiet():
+                    continue
+                orphans, self._sweep_cursors[path] = sweep_orphans(
+                    path, self._sweep_cursors.get(path, 0),
+                    self.batch_size * 10)
+                totals['orphans'] += orphans
+                if self.is_quiet():
+                    totals['vacuumed_pages'] += incremental_vacuum(
+                        path, self.vacuum_pages)
+
+                now = time.monotonic()
+                last = self._optimized_at.get(path)
+                if self.is_quiet() and (
+                        last is None or now - last >= self.optimize_interval):
+                    optimize(path)
+                    self._optimized_at[path] = now
+            except Exception as e:
+                print(f"⚠️  维护地址簿 {book_id} 失败: {e}")
+        return totals
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            totals = self.run_once()
+            if any(totals.values()):
+                print(f"🧹 后台维护: 清理联系人 {totals['purged']} 个, "
+                      f"孤儿联系方式 {totals['orphans']} 条, "
+                      f"变更日志 {totals['log_entries']} 条, "
+                      f"归还空闲页 {totals['vacuumed_pages']} 页")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='通讯录数据库维护工具')
+    parser.add_argument('--db', default=DEFAULT_DB, help='数据库文件路径')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    purge_parser = sub.add_parser('purge', help='彻底删除保留期已过的软删除联系人')
+    purge_parser.add_argument('--retention-days', type=float,
+                              default=DEFAULT_RETENTION_DAYS,
+                              help='软删除的保留天数，0 表示全部清理')
+    purge_parser.add_argument('--batch-size', type=int,
+                              default=DEFAULT_BATCH_SIZE)
+    purge_parser.add_argument('--pause', type=float, default=0.05,
+                              help='批次之间的休眠秒数')
+
+    sub.add_parser('sweep', help='清扫孤儿联系方式')
+
+    vacuum_parser = sub.add_parser('vacuum', help='归还空闲页')
+    vacuum_parser.add_argument('--pages', type=int,
+                               default=DEFAULT_VACUUM_PAGES)
+    vacuum_parser.add_argument('--full', action='store_true',
+                               help='开启增量 auto_vacuum 并整体重建（独占数据库）')
+
+    sub.add_parser('optimize', help='更新查询规划统计信息')
+
+    log_parser = sub.add_parser('prune-log', help='清理超过保留期的变更日志')
+    log_parser.add_argument('--retention-days', type=float,
+                            default=DEFAULT_LOG_RETENTION_DAYS)
+
+    sub.add_parser('rebuild-analytics', help='重算统计报表的汇总表')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'purge':
+        repository = SQLiteRepository(Database(args.db), fresh=True)
+        purged = purge_deleted(
+            repository, retention_cutoff(args.retention_days * 86400),
+            args.batch_size, args.pause)
+        print(f"✅ 彻底删除了 {purged} 个联系人")
+    elif args.command == 'sweep':
+        total = 0
+        start_id = 0
+        while True:
+            deleted, start_id = sweep_orphans(args.db, start_id)
+            total += deleted
+            if start_id == 0:
+                break
+        print(f"✅ 清扫了 {total} 条孤儿联系方式")
+    elif args.command == 'vacuum':
+        if args.full:
+            full_vacuum(args.db)
+            print("✅ 已开启增量 auto_vacuum 并重建数据库")
+        else:
+            freed = incremental_vacuum(args.db, args.pages)
+            print(f"✅ 归还了 {freed} 个空闲页")
+    elif args.command == 'optimize':
+        optimize(args.db)
+        print("✅ 已更新查询规划统计信息")
+    elif args.command == 'prune-log':
+        pruned = prune_changelog(args.db, args.retention_days * 86400)
+        print(f"✅ 清理了 {pruned} 条变更日志")
+    elif args.command == 'rebuild-analytics':
+        days, types = rebuild_analytics(args.db)
+        print(f"✅ 已重算统计汇总表：{days} 天，{types} 种联系方式类型")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+拼音与号码归一化 - 通讯录系统
+为联想、排序等功能生成姓名的拼音键和电话号码的数字键
+"""
+
+import re
+from functools import lru_cache
+
+from pypinyin import Style, lazy_pinyin
+
+NON_DIGIT = re.compile(r'\D')
+WHITESPACE = re.compile(r'\s+')
+# 不以英文字母开头（拼音后）的姓名归入这个分组
+OTHER_INITIAL = '#'
+INITIALS = tuple(chr(code) for code in range(ord('A'), ord('Z') + 1)) + (
+    OTHER_INITIAL,)
+
+
+def pinyin_full(name):
+    """姓名全拼（小写、无空格），非中文字符原样保留，如 张三 -> zhangsan"""
+    return ''.join(lazy_pinyin(name)).replace(' ', '').lower()
+
+
+def pinyin_initials(name):
+    """姓名拼音首字母，如 张三丰 -> zsf"""
+    parts = lazy_pinyin(name, style=Style.FIRST_LETTER)
+    return ''.join(part.strip() for part in parts).replace(' ', '').lower()
+
+
+@lru_cache(maxsize=65536)
+def collation_key(name):
+    """姓名的排序键，返回 (分组字母, 排序键)
+
+    排序键为逐字拼音用空格连接（小写），如 张三 -> ('Z', 'zhang san')；
+    按 (分组字母, 排序键) 排序即为通讯录的 A-Z 顺序，# 分组在最前
+    """
+    key = WHITESPACE.sub(' ', ' '.join(lazy_pinyin(name or ''))).strip()
+    key = key.lower()
+    first = key[:1]
+    initial = first.upper() if 'a' <= first <= 'z' else OTHER_INITIAL
+    return initial, key
+
+
+def normalize_phone(value):
+    """电话号码只保留数字，并去掉 +86 / 0086 国家码"""
+    text = str(value).strip()
+    digits = NON_DIGIT.sub('', text)
+    if digits.startswith('0086'):
+        digits = digits[4:]
+    elif digits.startswith('86') and (text.startswith('+')
+                                      or len(digits) == 13):
+        digits = digits[2:]
+    return digits
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+请求性能剖析 - 通讯录系统
+按管理员请求头或采样率对单个请求做剖析，结果存到磁盘上的有界目录：
+- cprofile: cProfile 的 pstats 文件（python -m pstats 或 snakeviz 查看）
+- stacks: 定时采样调用栈，输出折叠栈格式（flamegraph.pl / speedscope 直接打开）
+"""
+
+import cProfile
+import itertools
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from io import StringIO
+
+MODES = ('cprofile', 'stacks')
+EXTENSIONS = {'cprofile': 'pstats', 'stacks': 'collapsed'}
+PROFILE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+\.(pstats|collapsed)$')
+
+
+class StackSampler:
+    """在后台线程里每隔 interval 秒采样一次目标线程的调用栈"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n"
+                       for stack, count in sorted(self.counts.items()))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}:"
+                             f"{code.co_firstlineno})")
+                frame = frame.f_back
+            stack = ';'.join(reversed(names))
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+
+
+class ProfileSession:
+    """一次请求的剖析"""
+
+    def __init__(self, mode, sample_interval):
+        self.mode = mode
+        self.started = time.perf_counter()
+        if mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = StackSampler(threading.get_ident(),
+                                          sample_interval)
+            self._profiler.start()
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+        else:
+            self._profiler.stop()
+        return time.perf_counter() - self.started
+
+    def write(self, path):
+        if self.mode == 'cprofile':
+            self._profiler.dump_stats(path)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self._profiler.collapsed())
+
+
+class ProfileStore:
+    """剖析结果的有界目录：最多保留 keep 个文件，超出时删除最旧的
+
+    同一时刻只剖析一个请求（cProfile 和采样线程都有开销，也避免结果互相干扰）
+    """
+
+    def __init__(self, directory, keep=50, sample_interval=0.005):
+        self.directory = directory
+        self.keep = keep
+        self.sample_interval = sample_interval
+        self._busy = threading.Lock()
+        self._seq = itertools.count(1)
+
+    def start(self, mode):
+        """开始剖析当前线程，已有请求在剖析时返回 None"""
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            return ProfileSession(mode, self.sample_interval)
+        except Exception:
+            self._busy.release()
+            raise
+
+    def finish(self, session, label):
+        """结束剖析并保存，返回文件名"""
+        try:
+            elapsed = session.stop()
+            os.makedirs(self.directory, exist_ok=True)
+            label = re.sub(r'[^A-Za-z0-9_-]', '_', label or 'request')[:40]
+            name = (f"{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}_"
+                    f"{next(self._seq):06d}_{label}_{elapsed * 1000:.0f}ms."
+                    f"{EXTENSIONS[session.mode]}")
+            path = os.path.join(self.directory, name)
+            session.write(path)
+            self._rotate()
+            return name
+        finally:
+            self._busy.release()
+
+    def list(self):
+        """[{'name', 'size', 'time'}, ...]，从新到旧"""
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in os.listdir(self.directory):
+            if not PROFILE_NAME_PATTERN.match(name):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            profiles.append({
+                'name': name,
+                'size': stat.st_size,
+                'time': datetime.fromtimestamp(stat.st_mtime)
+                                .strftime('%Y-%m-%d %H:%M:%S')
+            })
+        profiles.sort(key=lambda p: p['name'], reverse=True)
+        return profiles
+
+    def path_for(self, name):
+        """文件名对应的路径，不合法或不存在时返回 None"""
+        if not PROFILE_NAME_PATTERN.match(name or ''):
+            return None
+        path = os.path.abspath(os.path.join(self.directory, name))
+        return path if os.path.isfile(path) else None
+
+    def _rotate(self):
+        for profile in self.list()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, profile['name']))
+            except OSError:
+                pass
+
+
+def pstats_text(path, limit=50):
+    """pstats 文件按累计耗时排序的文本摘要"""
+    output = StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return output.getvalue()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+基于变更日志的复制 - 通讯录系统
+主库上联系人、联系方式和分组的每次写入都由触发器记入 changelog 表（见 schema_migrations.py 版本9、10），
+跟随节点通过 GET /replication/log?from=<seq> 拉取日志，按批在一个事务里应用到自己的SQLite副本。
+
+- 跟随节点第一次启动（或日志已被清理、主库从备份恢复过，需要重新同步）时先下载
+  /replication/snapshot 作为起点
+- 应用日志时本地的 change_version 等触发器照常生效，缓存、常驻索引和事件推送都能感知变化
+- 跟随节点的写请求转发给主库（见 main.py forward_write）
+
+日志和快照接口属于管理接口，主库必须设置 CONTACTS_ADMIN_TOKEN（未设置时一律返回403），
+跟随节点设置同一个令牌，拉取时放在 X-Admin-Token 请求头里。两个本地进程测试：
+
+    export CONTACTS_ADMIN_TOKEN=<随机字符串>
+    PORT=5000 python main.py
+    PORT=5001 CONTACTS_REPLICATION_ROLE=follower \\
+        CONTACTS_PRIMARY_URL=http://127.0.0.1:5000 \\
+        CONTACTS_SHARD_DIR=follower_books python main.py   # 在另一个目录里运行
+
+也可以单独运行应用进程（API 用 gunicorn 多进程运行时）：
+
+    python replication.py --db contacts.db follow \\
+        --primary http://127.0.0.1:5000 --admin-token "$CONTACTS_ADMIN_TOKEN"
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import requests
+
+# 写连接等待写锁的超时时间（秒）
+BUSY_TIMEOUT = 30
+DEFAULT_BATCH_SIZE = 500
+# 跟随节点拉取日志和快照时带给主库的请求头
+BOOK_HEADER = 'X-Address-Book'
+ADMIN_HEADER = 'X-Admin-Token'
+# 快照对应的日志位置、写入后主库的日志位置
+SEQ_HEADER = 'X-Replication-Seq'
+
+
+class ResyncRequired(RuntimeError):
+    """需要的日志已经被主库清理，只能重新下载快照"""
+
+
+def connect(path):
+    """自动提交模式的写连接，事务由调用方显式控制"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+
+# ========== 主库：读取日志 ==========
+
+def last_seq(conn):
+    """已写入的最大日志序号（日志被清理后也不会变小）"""
+    row = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'changelog'").fetchone()
+    return row[0] if row else 0
+
+
+def read_log(conn, from_seq, limit):
+    """序号大于 from_seq 的最多 limit 条日志
+
+    返回 {'entries', 'last_seq', 'oldest_seq', 'has_more'}；
+    from_seq 之后的日志已经被清理时抛出 ResyncRequired
+    """
+    latest = last_seq(conn)
+    oldest = conn.execute('SELECT MIN(seq) FROM changelog').fetchone()[0]
+    if oldest is None:
+        oldest = latest + 1
+    if from_seq < oldest - 1:
+        raise ResyncRequired(f"日志 {from_seq + 1}~{oldest - 1} 已被清理")
+
+    rows = conn.execute(
+        'SELECT seq, changed_at, entity, op, data FROM changelog '
+        'WHERE seq > ? ORDER BY seq LIMIT ?',
+        (from_seq, limit)
+    ).fetchall()
+    return {
+        'entries': [{
+            'seq': seq,
+            'changed_at': changed_at,
+            'entity': entity,
+            'op': op,
+            'data': json.loads(data)
+        } for seq, changed_at, entity, op, data in rows],
+        'last_seq': latest,
+        'oldest_seq': oldest,
+        'has_more': bool(rows) and rows[-1][0] < latest
+    }
+
+
+# ========== 跟随节点：应用日志 ==========
+
+def applied_seq(conn):
+    """(已应用到的主库日志序号, 是否需要重新同步)，还没有同步过时返回 (None, False)"""
+    row = conn.execute(
+        'SELECT last_seq, resync_required FROM replication_state WHERE id = 1'
+    ).fetchone()
+    return (row[0], bool(row[1])) if row else (None, False)
+
+
+def apply_entries(conn, entries):
+    """在一个事务里应用一批日志，返回应用后的日志序号
+
+    已经应用过的序号直接跳过，同一批日志被多个进程重复应用也不会回退数据
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current, _ = applied_seq(conn)
+        current = current or 0
+        type_ids = {}
+        for entry in entries:
+            if entry['seq'] <= current:
+                continue
+            _apply(conn, entry, type_ids)
+            current = entry['seq']
+        _save_state(conn, current)
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    return current
+
+
+def _apply(conn, entry, type_ids):
+    data = entry['data']
+    if entry['entity'] == 'contact':
+        if entry['op'] == 'delete':
+            conn.execute('DELETE FROM contacts WHERE id = ?', (data['id'],))
+            return
+        conn.execute('''
+            INSERT INTO contacts
+                (id, name, is_favorite, created_time, deleted_at,
+                 initial, sort_key)
+            VALUES (:id, :name, :is_favorite, :created_time, :deleted_at,
+                    :initial, :sort_key)
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name, is_favorite = excluded.is_favorite,
+                created_time = excluded.created_time,
+                deleted_at = excluded.deleted_at,
+                initial = excluded.initial, sort_key = excluded.sort_key
+        ''', data)
+    elif entry['entity'] == 'method':
+        if entry['op'] == 'delete':
+            conn.execute(
+                'DELETE FROM contact_methods WHERE contact_id = ? AND seq = ?',
+                (data['contact_id'], data['seq']))
+            return
+        method_type = data['type']
+        if method_type not in type_ids:
+            conn.execute(
+                'INSERT OR IGNORE INTO method_types (name) VALUES (?)',
+                (method_type,))
+            type_ids[method_type] = conn.execute(
+                'SELECT id FROM method_types WHERE name = ?',
+                (method_type,)).fetchone()[0]
+        conn.execute('''
+            INSERT INTO contact_methods
+                (contact_id, seq, type_id, method_value)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(contact_id, seq) DO UPDATE SET
+                type_id = excluded.type_id,
+                method_value = excluded.method_value
+        ''', (data['contact_id'], data['seq'], type_ids[method_type],
+              data['value']))
+    elif entry['entity'] == 'group':
+        if entry['op'] == 'delete':
+            conn.execute('DELETE FROM contact_groups WHERE id = ?',
+                         (data['id'],))
+            return
+        # 成员人数由本地的计数触发器维护，不覆盖
+        conn.execute('''
+            INSERT INTO contact_groups (id, name, created_time)
+            VALUES (:id, :name, :created_time)
+            ON CONFLICT(id) DO UPDATE SET name = excluded.name
+        ''', data)
+    elif entry['entity'] == 'member':
+        if entry['op'] == 'delete':
+            conn.execute(
+                'DELETE FROM group_members '
+                'WHERE group_id = ? AND contact_id = ?',
+                (data['group_id'], data['contact_id']))
+            return
+        conn.execute(
+            'INSERT OR IGNORE INTO group_members (group_id, contact_id) '
+            'VALUES (?, ?)',
+            (data['group_id'], data['contact_id']))
+
+
+def _save_state(conn, seq, resync_required=False):
+    conn.execute('''
+        INSERT INTO replication_state
+            (id, last_seq, resync_required, updated_at)
+        VALUES (1, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT(id) DO UPDATE SET
+            last_seq = excluded.last_seq,
+            resync_required = excluded.resync_required,
+            updated_at = excluded.updated_at
+    ''', (seq, int(resync_required)))
+
+
+def mark_resync_required(path):
+    conn = connect(path)
+    try:
+        current, _ = applied_seq(conn)
+        _save_state(conn, current or 0, resync_required=True)
+    finally:
+        conn.close()
+
+
+def needs_bootstrap(path):
+    """本地库还没有从主库同步过，或者落后太多需要重新下载快照"""
+    if not os.path.isfile(path):
+        return True
+    conn = sqlite3.connect(path)
+    try:
+        current, resync_required = applied_seq(conn)
+    except sqlite3.OperationalError:
+        # 还没有 replication_state 表（本地库是旧版本或空库）
+        return True
+    finally:
+        conn.close()
+    return current is None or resync_required
+
+
+def bootstrap(path, primary_url, book_id, admin_token=None, timeout=300):
+    """下载主库快照替换本地库文件，返回快照对应的日志序号
+
+    只能在本地库没有被打开时调用（启动时、跟随进程开始之前）
+    """
+    response = requests.get(f"{primary_url.rstrip('/')}/replication/snapshot",
+                            headers=_headers(book_id, admin_token),
+                            stream=True, timeout=timeout)
+    response.raise_for_status()
+    seq = int(response.headers[SEQ_HEADER])
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.bootstrap"
+    with open(tmp_path, 'wb') as f:
+        for chunk in response.iter_content(1024 * 1024):
+            f.write(chunk)
+
+    conn = connect(tmp_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _save_state(conn, seq)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    # 旧库的WAL和共享内存文件必须一起删掉，否则会被当成新文件的日志
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(tmp_path, path)
+    return seq
+
+
+def _headers(book_id, admin_token):
+    headers = {BOOK_HEADER: book_id}
+    if admin_token:
+        headers[ADMIN_HEADER] = admin_token
+    return headers
+
+
+class Follower:
+    """跟随一个主库地址簿：后台线程不断拉取日志并应用到本地库 path
+
+    主库没有新日志时每 interval 秒拉取一次，有积压时连续拉取
+    """
+
+    def __init__(self, path, primary_url, book_id, admin_token=None,
+                 interval=1.0, batch_size=DEFAULT_BATCH_SIZE, timeout=10.0):
+        self.path = path
+        self.primary_url = primary_url.rstrip('/')
+        self.book_id = book_id
+        self.admin_token = admin_token
+        self.interval = interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+        self.applied_seq = 0
+        self.primary_seq = 0
+        self.applied_total = 0
+        self.errors = 0
+        self.last_error = None
+        self.resync_required = False
+        # 上次追上主库的时间、最后一次成功拉取的时间（time.time()）
+        self._caught_up_at = None
+        self._polled_at = None
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """立即拉取一次（比如刚转发了一个写请求）"""
+        self._wake.set()
+
+    def wait_for(self, seq, timeout):
+        """等到本地应用到日志序号 seq，超时返回 False"""
+        self.wake()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.applied_seq < seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.resync_required:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def poll_once(self):
+        """拉取并应用一批日志，返回主库是否还有更多"""
+        conn = connect(self.path)
+        try:
+            current, _ = applied_seq(conn)
+            response = requests.get(
+                f"{self.primary_url}/replication/log",
+                params={'from': current or 0, 'limit': self.batch_size},
+                headers=_headers(self.book_id, self.admin_token),
+                timeout=self.timeout)
+            if response.status_code == 410:
+                raise ResyncRequired(response.json().get('error'))
+            response.raise_for_status()
+            log = response.json()
+            applied = apply_entries(conn, log['entries'])
+        finally:
+            conn.close()
+
+        now = time.time()
+        with self._condition:
+            self.applied_total += len(log['entries'])
+            self.applied_seq = applied
+            self.primary_seq = log['last_seq']
+            self._polled_at = now
+            if applied >= log['last_seq']:
+                self._caught_up_at = now
+            elif self._caught_up_at is None and log['entries']:
+                self._caught_up_at = log['entries'][0]['changed_at']
+            self._condition.notify_all()
+        return log['has_more']
+
+    def stats(self):
+        """复制延迟指标：落后的日志条数和秒数"""
+        now = time.time()
+        with self._condition:
+            lag_entries = max(self.primary_seq - self.applied_seq, 0)
+            lag_seconds = 0.0
+            if lag_entries and self._caught_up_at is not None:
+                lag_seconds = now - self._caught_up_at
+            return {
+                'book': self.book_id,
+                'primary': self.primary_url,
+                'applied_seq': self.applied_seq,
+                'primary_seq': self.primary_seq,
+                'lag_entries': lag_entries,
+                'lag_seconds': round(lag_seconds, 3),
+                'last_poll_age': (round(now - self._polled_at, 3)
+                                  if self._polled_at else None),
+                'applied_total': self.applied_total,
+                'errors': self.errors,
+                'last_error': self.last_error,
+                'resync_required': self.resync_required
+            }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            has_more = False
+            try:
+                has_more = self.poll_once()
+            except ResyncRequired as e:
+                # 下次启动时重新下载快照
+                mark_resync_required(self.path)
+                with self._condition:
+                    self.resync_required = True
+                    self.last_error = str(e)
+                    self._condition.notify_all()
+                print(f"❌ 地址簿 {self.book_id} 落后太多，需要重新同步: {e}")
+                return
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+            if not has_more:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='通讯录变更日志复制工具')
+    parser.add_argument('--db', default='contacts.db', help='本地数据库文件')
+    parser.add_argument('--book', default='default', help='要复制的地址簿')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    bootstrap_parser = sub.add_parser('bootstrap', help='下载主库快照作为本地库')
+    follow_parser = sub.add_parser('follow', help='持续拉取并应用主库的变更日志')
+    for command in (bootstrap_parser, follow_parser):
+        command.add_argument('--primary', required=True, help='主库服务地址')
+        command.add_argument('--admin-token',
+                             default=os.environ.get('CONTACTS_ADMIN_TOKEN'))
+    follow_parser.add_argument('--interval', type=float, default=1.0,
+                               help='没有新日志时的拉取间隔（秒）')
+    follow_parser.add_argument('--batch-size', type=int,
+                               default=DEFAULT_BATCH_SIZE)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'bootstrap' or needs_bootstrap(args.db):
+        seq = bootstrap(args.db, args.primary, args.book, args.admin_token)
+        print(f"✅ 已下载主库快照（日志位置 {seq}）")
+    if args.command == 'follow':
+        follower = Follower(args.db, args.primary, args.book,
+                            args.admin_token, args.interval, args.batch_size)
+        follower.start()
+        try:
+            while not follower.resync_required:
+                time.sleep(10)
+                stats = follower.stats()
+                print(f"🔁 已应用到 {stats['applied_seq']}，落后 "
+                      f"{stats['lag_entries']} 条 / {stats['lag_seconds']} 秒")
+        except KeyboardInterrupt:
+            follower.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1178 @@
+#!/usr/bin/env python3
+"""
+版本化表结构迁移 - 通讯录系统
+按版本号顺序登记所有表结构变更，已应用的版本记录在 PRAGMA user_version 中
+
+    python schema_migrations.py --db contacts.db status
+    python schema_migrations.py --db contacts.db dry-run
+    python schema_migrations.py --db contacts.db upgrade \\
+        --batch-size 1000 --pause 0.05
+
+回填数据等耗时步骤按小批次执行，每批一个短事务，批次之间让出写锁，
+API 可以在升级过程中照常读写。所有步骤都可以重复执行，中断后重新运行即可。
+"""
+
+import argparse
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+from pinyin_keys import collation_key
+
+DEFAULT_DB = 'contacts.db'
+DEFAULT_BATCH_SIZE = 1000
+# 写连接等待写锁的超时时间（秒）
+BUSY_TIMEOUT = 30
+# dry-run 时用来测速的样本行数
+SAMPLE_ROWS = 2000
+
+
+class LegacySchemaError(RuntimeError):
+    """数据库还是旧结构，需要先运行 database_migration.py migrate"""
+
+
+CREATE_CONTACTS_SQL = '''
+    CREATE TABLE IF NOT EXISTS contacts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        is_favorite BOOLEAN DEFAULT 0,
+        created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+CREATE_CONTACT_METHODS_SQL = '''
+    CREATE TABLE IF NOT EXISTS contact_methods (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        contact_id INTEGER NOT NULL,
+        method_type TEXT NOT NULL,  -- phone, email, address, social, etc.
+        method_value TEXT NOT NULL,
+        FOREIGN KEY (contact_id) REFERENCES contacts(id) ON DELETE CASCADE
+    )
+'''
+
+
+# ========== 迁移步骤 ==========
+
+class Step:
+    """迁移中的一个步骤"""
+
+    description = ''
+
+    def run(self, conn, batch_size, pause):
+        """执行步骤（可重复执行）"""
+        raise NotImplementedError
+
+    def estimate(self, conn, batch_size):
+        """估算 (涉及行数, 预计秒数)，不修改数据"""
+        return 0, 0.0
+
+
+class SQLStep(Step):
+    """在一个短事务里执行几条很快的语句（建表等）"""
+
+    def __init__(self, description, *statements):
+        self.description = description
+        self.statements = statements
+
+    def run(self, conn, batch_size, pause):
+        with _immediate(conn):
+            for statement in self.statements:
+                conn.execute(statement)
+
+
+class AddColumnStep(Step):
+    """添加列（列已存在时跳过，多个进程同时升级也安全）"""
+
+    def __init__(self, table, column, definition):
+        self.table = table
+        self.column = column
+        self.definition = definition
+        self.description = f"{table} 添加列 {column}"
+
+    def run(self, conn, batch_size, pause):
+        with _immediate(conn):
+            if self.column not in table_columns(conn, self.table):
+                conn.execute(f'ALTER TABLE {self.table} ADD COLUMN '
+                             f'{self.column} {self.definition}')
+
+
+class CreateIndexStep(Step):
+    """建索引
+
+    SQLite 建索引只能一条语句完成，期间持有写锁；dry-run 会按表大小估算耗时，
+    大表建议在低峰期单独运行 upgrade。
+    """
+
+    def __init__(self, name, table, columns, where=None):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.where = where
+        self.description = f"{table} 建索引 {name}({columns})"
+
+    def run(self, conn, batch_size, pause):
+        sql = (f'CREATE INDEX IF NOT EXISTS {self.name} '
+               f'ON {self.table}({self.columns})')
+        if self.where:
+            sql += f' WHERE {self.where}'
+        with _immediate(conn):
+            conn.execute(sql)
+
+    def estimate(self, conn, batch_size):
+        rows = _count(conn, self.table)
+        started = time.perf_counter()
+        sample = conn.execute(
+            f'SELECT {self.columns} FROM {self.table} '
+            f'ORDER BY {self.columns} LIMIT ?',
+            (SAMPLE_ROWS,)
+        ).fetchall()
+        elapsed = time.perf_counter() - started
+        per_row = elapsed / len(sample) if sample else 0
+        return rows, per_row * rows
+
+
+class BackfillStep(Step):
+    """用SQL表达式分批回填列
+
+    每批更新最多 batch_size 行满足 where 的记录，where 必须在回填后不再成立
+    （比如 "col IS NULL"），这样重复执行和中断后续跑都是安全的。
+    """
+
+    def __init__(self, table, assignments, where, description=None):
+        self.table = table
+        self.assignments = assignments
+        self.where = where
+        self.description = description or f"{table} 回填 {assignments}"
+
+    def run(self, conn, batch_size, pause):
+        while True:
+            with _immediate(conn):
+                changed = conn.execute(f'''
+                    UPDATE {self.table} SET {self.assignments}
+                    WHERE rowid IN (
+                        SELECT rowid FROM {self.table}
+                        WHERE {self.where} LIMIT ?
+                    )
+                ''', (batch_size,)).rowcount
+            if changed < batch_size:
+                return
+            time.sleep(pause)
+
+    def estimate(self, conn, batch_size):
+        rows = _count(conn, self.table, self.where)
+        return rows, _time_rolled_back(conn, lambda: conn.execute(f'''
+            UPDATE {self.table} SET {self.assignments}
+            WHERE rowid IN (
+                SELECT rowid FROM {self.table} WHERE {self.where} LIMIT ?
+            )
+        ''', (SAMPLE_ROWS,)).rowcount, rows)
+
+
+class PythonBackfillStep(Step):
+    """需要Python计算的回填（比如拼音排序键）
+
+    select_columns 从满足 where 的行里取出，compute(row) 返回要写入的值元组，
+    再用 update_sql（最后一个参数为 rowid）批量写回。
+    """
+
+    def __init__(self, table, select_columns, where, compute, update_sql,
+                 description):
+        self.table = table
+        self.select_columns = select_columns
+        self.where = where
+        self.compute = compute
+        self.update_sql = update_sql
+        self.description = description
+
+    def run(self, conn, batch_size, pause):
+        while True:
+            with _immediate(conn):
+                changed = self._batch(conn, batch_size)
+            if changed < batch_size:
+                return
+            time.sleep(pause)
+
+    def estimate(self, conn, batch_size):
+        rows = _count(conn, self.table, self.where)
+        return rows, _time_rolled_back(
+            conn, lambda: self._batch(conn, SAMPLE_ROWS), rows)
+
+    def _batch(self, conn, limit):
+        rows = conn.execute(
+            f'SELECT rowid, {self.select_columns} FROM {self.table} '
+            f'WHERE {self.where} LIMIT ?',
+            (limit,)
+        ).fetchall()
+        conn.executemany(
+            self.update_sql,
+            [tuple(self.compute(row[1:])) + (row[0],) for row in rows]
+        )
+        return len(rows)
+
+
+class CompactTablesStep(Step):
+    """重建 contacts / contact_methods 为紧凑结构（版本8）
+
+    - 联系方式类型存到 method_types 表，contact_methods 只存整数 type_id
+    - created_time / deleted_at 从文本时间改为UTC整数秒
+    - contact_methods 改为 WITHOUT ROWID，主键 (contact_id, seq) 按联系人聚簇存放，
+      seq 沿用旧表联系方式的 id，保留原来的插入顺序
+
+    SQLite 不能修改列类型，只能建新表、复制、删旧表、改名。和回填步骤一样
+    分批进行，API 在迁移期间照常读写：
+    1. 一个短事务里建 *_compact 新表和最终的索引，在旧表上装同步触发器；
+       索引名要留给新表，旧表上的同名索引先删掉（这期间相关查询会变慢，但不阻塞）
+    2. 按 id 分批把旧表复制到新表，每批一个短事务，触发器已经同步过的行跳过
+    3. 一个短事务里删旧表、新表改名、恢复计数器和触发器，不再整表复制或建索引
+    中断后重新运行会从头补齐，已经复制过的行跳过。
+    """
+
+    description = "重建为紧凑结构（类型id、整数时间戳、WITHOUT ROWID）"
+
+    def run(self, conn, batch_size, pause):
+        # 删表、改名期间不能检查外键（只能在事务外切换）
+        conn.execute('PRAGMA foreign_keys=OFF')
+        with _immediate(conn):
+            if _compacted(conn):
+                return
+            self._prepare(conn)
+
+        for table, *statements in COMPACT_COPY_BATCHES:
+            last_id = 0
+            while True:
+                with _immediate(conn):
+                    # 多个进程同时升级时，另一个进程可能已经换好了表
+                    if _compacted(conn):
+                        return
+                    upper = conn.execute(
+                        f'SELECT MAX(id) FROM (SELECT id FROM {table} '
+                        'WHERE id > ? ORDER BY id LIMIT ?)',
+                        (last_id, batch_size)
+                    ).fetchone()[0]
+                    if upper is None:
+                        break
+                    for statement in statements:
+                        conn.execute(statement, (last_id, upper))
+                last_id = upper
+                time.sleep(pause)
+
+        with _immediate(conn):
+            if not _compacted(conn):
+                self._swap(conn)
+
+    def estimate(self, conn, batch_size):
+        rows = _count(conn, 'contacts') + _count(conn, 'contact_methods')
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS compact_sample '
+                     '(contact_id INTEGER, seq INTEGER, type_id INTEGER, '
+                     'method_value TEXT, PRIMARY KEY (contact_id, seq)) '
+                     'WITHOUT ROWID')
+        return rows, _time_rolled_back(conn, lambda: conn.execute(f'''
+            INSERT INTO compact_sample
+            SELECT contact_id, id, 0, method_value
+            FROM (SELECT * FROM contact_methods LIMIT {SAMPLE_ROWS})
+        ''').rowcount, rows)
+
+    def _prepare(self, conn):
+        conn.execute(CREATE_METHOD_TYPES_SQL)
+        conn.execute("INSERT OR IGNORE INTO method_types (name) "
+                     "VALUES ('phone'), ('email')")
+        conn.execute(CREATE_COMPACT_CONTACTS_SQL)
+        conn.execute(CREATE_COMPACT_CONTACT_METHODS_SQL)
+
+        # 只删旧表上的同名索引，中断重跑时这些名字已经属于新表
+        for name, table, _, _ in COMPACT_INDEXES:
+            if conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                    "AND name = ? AND tbl_name = ?", (name, table)
+            ).fetchone():
+                conn.execute(f'DROP INDEX {name}')
+        for statement in (compact_index_sql('_compact')
+                          + COMPACT_MIRROR_TRIGGERS):
+            conn.execute(statement)
+
+    def _swap(self, conn):
+        # AUTOINCREMENT 的计数器随旧表删除，重建后恢复，删除过的id不会被复用
+        sequence = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'contacts'"
+        ).fetchone()
+
+        # 旧表的索引、计数触发器和同步触发器随旧表删除，新表的索引随改名带过去
+        conn.execute('DROP TABLE contact_methods')
+        conn.execute('DROP TABLE contacts')
+        conn.execute('ALTER TABLE contacts_compact RENAME TO contacts')
+        conn.execute('ALTER TABLE contact_methods_compact '
+                     'RENAME TO contact_methods')
+
+        if sequence is not None:
+            conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) "
+                         "WHERE name = 'contacts'", sequence)
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) "
+                         "SELECT 'contacts', ? WHERE NOT EXISTS "
+                         "(SELECT 1 FROM sqlite_sequence "
+                         "WHERE name = 'contacts')", sequence)
+
+        for statement in (change_version_triggers(('contacts',
+                                                   'contact_methods'))
+                          + CONTACT_SECTIONS_TRIGGERS):
+            conn.execute(statement)
+
+
+class Migration:
+    """一个版本的表结构变更，由若干步骤组成"""
+
+    def __init__(self, version, description, *steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+# ========== 迁移登记表（只能追加，不能修改已发布的版本） ==========
+
+CREATE_CHANGE_VERSION_SQL = '''
+    CREATE TABLE IF NOT EXISTS change_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+'''
+
+
+CREATE_CONTACT_SECTIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS contact_sections (
+        initial TEXT PRIMARY KEY,
+        count INTEGER NOT NULL
+    )
+'''
+
+# 未删除联系人按分组字母计数；排序键由应用写入，没有排序键的行不计入
+CONTACT_SECTIONS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_insert_section
+    AFTER INSERT ON contacts
+    WHEN NEW.initial IS NOT NULL AND NEW.deleted_at IS NULL
+    BEGIN
+        INSERT INTO contact_sections (initial, count) VALUES (NEW.initial, 1)
+        ON CONFLICT(initial) DO UPDATE SET count = count + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_delete_section
+    AFTER DELETE ON contacts
+    WHEN OLD.initial IS NOT NULL AND OLD.deleted_at IS NULL
+    BEGIN
+        UPDATE contact_sections SET count = count - 1
+        WHERE initial = OLD.initial;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_update_section
+    AFTER UPDATE OF initial, deleted_at ON contacts
+    BEGIN
+        UPDATE contact_sections SET count = count - 1
+        WHERE initial = OLD.initial AND OLD.deleted_at IS NULL;
+        INSERT INTO contact_sections (initial, count)
+        SELECT NEW.initial, 1
+        WHERE NEW.initial IS NOT NULL AND NEW.deleted_at IS NULL
+        ON CONFLICT(initial) DO UPDATE SET count = count + 1;
+    END
+    '''
+]
+
+
+CREATE_METHOD_TYPES_SQL = '''
+    CREATE TABLE IF NOT EXISTS method_types (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE  -- phone, email, address, social, etc.
+    )
+'''
+
+# 时间列为UTC整数秒（strftime('%s')），比 'YYYY-MM-DD HH:MM:SS' 文本省一半以上空间
+CREATE_COMPACT_CONTACTS_SQL = '''
+    CREATE TABLE IF NOT EXISTS contacts_compact (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        is_favorite INTEGER NOT NULL DEFAULT 0,
+        created_time INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        deleted_at INTEGER,
+        initial TEXT,
+        sort_key TEXT
+    )
+'''
+
+CREATE_COMPACT_CONTACT_METHODS_SQL = '''
+    CREATE TABLE IF NOT EXISTS contact_methods_compact (
+        contact_id INTEGER NOT NULL
+            REFERENCES contacts(id) ON DELETE CASCADE,
+        seq INTEGER NOT NULL,
+        type_id INTEGER NOT NULL REFERENCES method_types(id),
+        method_value TEXT NOT NULL,
+        PRIMARY KEY (contact_id, seq)
+    ) WITHOUT ROWID
+'''
+
+# 重建后的索引 (名称, 表, 列, 条件)；WITHOUT ROWID 表的二级索引自带主键
+# (contact_id, seq)，按值查联系人、按类型统计都不用回表；按联系人取联系方式直接走主键
+COMPACT_INDEXES = [
+    ('idx_contacts_favorite_created', 'contacts',
+     'is_favorite, created_time', None),
+    ('idx_contacts_name', 'contacts', 'name', None),
+    ('idx_contacts_created', 'contacts', 'created_time', None),
+    ('idx_contacts_deleted', 'contacts', 'deleted_at',
+     'deleted_at IS NOT NULL'),
+    ('idx_contacts_initial_sort', 'contacts', 'initial, sort_key', None),
+    ('idx_contact_methods_value', 'contact_methods', 'method_value', None),
+    ('idx_contact_methods_type_contact', 'contact_methods',
+     'type_id, contact_id', None)
+]
+
+# 旧表一行联系人转成紧凑结构的值，{row} 为 NEW 或表别名
+_COMPACT_CONTACT_VALUES = '''
+    {row}.id, {row}.name, COALESCE({row}.is_favorite, 0),
+    CAST(strftime('%s', {row}.created_time) AS INTEGER),
+    CAST(strftime('%s', {row}.deleted_at) AS INTEGER),
+    {row}.initial, {row}.sort_key
+'''
+
+_COMPACT_METHOD_UPSERT = '''
+    INSERT OR IGNORE INTO method_types (name) VALUES (NEW.method_type);
+    INSERT OR REPLACE INTO contact_methods_compact
+        (contact_id, seq, type_id, method_value)
+    SELECT NEW.contact_id, NEW.id, id, NEW.method_value
+    FROM method_types WHERE name = NEW.method_type;
+'''
+
+# 版本8复制期间把旧表上的写入同步到新表，随旧表一起删除；
+# 新表的 seq 沿用旧表联系方式的 id，保留插入顺序
+COMPACT_MIRROR_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_compact_contacts_{event.lower()}
+    AFTER {event} ON contacts
+    BEGIN
+        INSERT INTO contacts_compact
+            (id, name, is_favorite, created_time, deleted_at,
+             initial, sort_key)
+        VALUES ({_COMPACT_CONTACT_VALUES.format(row='NEW')})
+        ON CONFLICT(id) DO UPDATE SET
+            name = excluded.name, is_favorite = excluded.is_favorite,
+            created_time = excluded.created_time,
+            deleted_at = excluded.deleted_at,
+            initial = excluded.initial, sort_key = excluded.sort_key;
+    END
+    '''
+    for event in ('INSERT', 'UPDATE')
+] + [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_compact_contacts_delete
+    AFTER DELETE ON contacts
+    BEGIN
+        DELETE FROM contacts_compact WHERE id = OLD.id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_compact_methods_insert
+    AFTER INSERT ON contact_methods
+    BEGIN
+        {_COMPACT_METHOD_UPSERT}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_compact_methods_update
+    AFTER UPDATE ON contact_methods
+    BEGIN
+        DELETE FROM contact_methods_compact
+        WHERE contact_id = OLD.contact_id AND seq = OLD.id;
+        {_COMPACT_METHOD_UPSERT}
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_compact_methods_delete
+    AFTER DELETE ON contact_methods
+    BEGIN
+        DELETE FROM contact_methods_compact
+        WHERE contact_id = OLD.contact_id AND seq = OLD.id;
+    END
+    '''
+]
+
+# 版本8按旧表 id 分批复制：(表, 每批执行的语句...)，参数为 (上一批的最大id, 本批最大id)
+COMPACT_COPY_BATCHES = [
+    ('contacts', f'''
+        INSERT OR IGNORE INTO contacts_compact
+            (id, name, is_favorite, created_time, deleted_at,
+             initial, sort_key)
+        SELECT {_COMPACT_CONTACT_VALUES.format(row='c')}
+        FROM contacts c
+        WHERE c.id > ? AND c.id <= ?
+    '''),
+    ('contact_methods', '''
+        INSERT OR IGNORE INTO method_types (name)
+        SELECT DISTINCT method_type FROM contact_methods
+        WHERE id > ? AND id <= ?
+    ''', '''
+        INSERT OR IGNORE INTO contact_methods_compact
+            (contact_id, seq, type_id, method_value)
+        SELECT m.contact_id, m.id, t.id, m.method_value
+        FROM contact_methods m
+        JOIN method_types t ON t.name = m.method_type
+        WHERE m.id > ? AND m.id <= ?
+    ''')
+]
+
+
+def compact_index_sql(suffix=''):
+    """建 COMPACT_INDEXES 的语句；复制期间索引建在 *_compact 表上（suffix）"""
+    statements = []
+    for name, table, columns, where in COMPACT_INDEXES:
+        sql = (f'CREATE INDEX IF NOT EXISTS {name} '
+               f'ON {table}{suffix}({columns})')
+        if where:
+            sql += f' WHERE {where}'
+        statements.append(sql)
+    return statements
+
+
+CREATE_CHANGELOG_SQL = '''
+    CREATE TABLE IF NOT EXISTS changelog (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        changed_at INTEGER NOT NULL
+            DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        entity TEXT NOT NULL,  -- contact, method, group, member
+        op TEXT NOT NULL,      -- upsert, delete
+        data TEXT NOT NULL     -- JSON：upsert 为整行，delete 为主键
+    )
+'''
+
+# 跟随节点已应用到的主库日志位置（主库上这张表为空）
+CREATE_REPLICATION_STATE_SQL = '''
+    CREATE TABLE IF NOT EXISTS replication_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_seq INTEGER NOT NULL,
+        resync_required INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER
+    )
+'''
+
+_CONTACT_ROW_JSON = '''json_object(
+    'id', NEW.id, 'name', NEW.name, 'is_favorite', NEW.is_favorite,
+    'created_time', NEW.created_time, 'deleted_at', NEW.deleted_at,
+    'initial', NEW.initial, 'sort_key', NEW.sort_key)'''
+# 类型按名字记录，各节点的 method_types id 不必一致
+_METHOD_ROW_JSON = '''json_object(
+    'contact_id', NEW.contact_id, 'seq', NEW.seq,
+    'type', (SELECT name FROM method_types WHERE id = NEW.type_id),
+    'value', NEW.method_value)'''
+
+# 所有写入（API、导入、后台清理、其它进程）都由触发器记入变更日志，见 replication.py
+CHANGELOG_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_insert_log
+    AFTER INSERT ON contacts
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('contact', 'upsert', {_CONTACT_ROW_JSON});
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_update_log
+    AFTER UPDATE ON contacts
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('contact', 'upsert', {_CONTACT_ROW_JSON});
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_delete_log
+    AFTER DELETE ON contacts
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('contact', 'delete', json_object('id', OLD.id));
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_methods_insert_log
+    AFTER INSERT ON contact_methods
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('method', 'upsert', {_METHOD_ROW_JSON});
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_methods_update_log
+    AFTER UPDATE ON contact_methods
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('method', 'delete', json_object(
+            'contact_id', OLD.contact_id, 'seq', OLD.seq));
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('method', 'upsert', {_METHOD_ROW_JSON});
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_methods_delete_log
+    AFTER DELETE ON contact_methods
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('method', 'delete', json_object(
+            'contact_id', OLD.contact_id, 'seq', OLD.seq));
+    END
+    '''
+]
+
+
+CREATE_CONTACT_GROUPS_SQL = '''
+    CREATE TABLE IF NOT EXISTS contact_groups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        created_time INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        member_count INTEGER NOT NULL DEFAULT 0  -- 未删除的成员数，由触发器维护
+    )
+'''
+
+# 按分组列成员是主键上的范围扫描；按联系人找分组（软删除时更新人数）走 contact_id 索引
+CREATE_GROUP_MEMBERS_SQL = '''
+    CREATE TABLE IF NOT EXISTS group_members (
+        group_id INTEGER NOT NULL
+            REFERENCES contact_groups(id) ON DELETE CASCADE,
+        contact_id INTEGER NOT NULL
+            REFERENCES contacts(id) ON DELETE CASCADE,
+        PRIMARY KEY (group_id, contact_id)
+    ) WITHOUT ROWID
+'''
+
+# 只统计未删除的成员。外键级联删除成员时联系人行已经不可见，
+# 所以彻底删除未软删除的联系人时在 BEFORE DELETE 里先减掉
+GROUP_COUNT_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_group_members_insert_count
+    AFTER INSERT ON group_members
+    BEGIN
+        UPDATE contact_groups SET member_count = member_count + 1
+        WHERE id = NEW.group_id AND EXISTS (
+            SELECT 1 FROM contacts
+            WHERE id = NEW.contact_id AND deleted_at IS NULL);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_group_members_delete_count
+    AFTER DELETE ON group_members
+    BEGIN
+        UPDATE contact_groups SET member_count = member_count - 1
+        WHERE id = OLD.group_id AND EXISTS (
+            SELECT 1 FROM contacts
+            WHERE id = OLD.contact_id AND deleted_at IS NULL);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_update_group_count
+    AFTER UPDATE OF deleted_at ON contacts
+    WHEN (OLD.deleted_at IS NULL) != (NEW.deleted_at IS NULL)
+    BEGIN
+        UPDATE contact_groups
+        SET member_count = member_count
+            + CASE WHEN NEW.deleted_at IS NULL THEN 1 ELSE -1 END
+        WHERE id IN (SELECT group_id FROM group_members
+                     WHERE contact_id = NEW.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_delete_group_count
+    BEFORE DELETE ON contacts
+    WHEN OLD.deleted_at IS NULL
+    BEGIN
+        UPDATE contact_groups SET member_count = member_count - 1
+        WHERE id IN (SELECT group_id FROM group_members
+                     WHERE contact_id = OLD.id);
+    END
+    '''
+]
+
+_GROUP_ROW_JSON = '''json_object(
+    'id', NEW.id, 'name', NEW.name, 'created_time', NEW.created_time)'''
+
+# member_count 不记日志，跟随节点由自己的计数触发器维护
+GROUP_CHANGELOG_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_groups_insert_log
+    AFTER INSERT ON contact_groups
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('group', 'upsert', {_GROUP_ROW_JSON});
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_groups_update_log
+    AFTER UPDATE OF name ON contact_groups
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('group', 'upsert', {_GROUP_ROW_JSON});
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_groups_delete_log
+    AFTER DELETE ON contact_groups
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('group', 'delete', json_object('id', OLD.id));
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_group_members_insert_log
+    AFTER INSERT ON group_members
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('member', 'upsert', json_object(
+            'group_id', NEW.group_id, 'contact_id', NEW.contact_id));
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_group_members_delete_log
+    AFTER DELETE ON group_members
+    BEGIN
+        INSERT INTO changelog (entity, op, data)
+        VALUES ('member', 'delete', json_object(
+            'group_id', OLD.group_id, 'contact_id', OLD.contact_id));
+    END
+    '''
+]
+
+
+CREATE_CONTACT_DAILY_COUNTS_SQL = '''
+    CREATE TABLE IF NOT EXISTS contact_daily_counts (
+        day INTEGER PRIMARY KEY,  -- created_time / 86400，即UTC日期
+        created INTEGER NOT NULL,
+        favorites INTEGER NOT NULL
+    )
+'''
+
+CREATE_METHOD_TYPE_COUNTS_SQL = '''
+    CREATE TABLE IF NOT EXISTS method_type_counts (
+        type_id INTEGER PRIMARY KEY REFERENCES method_types(id),
+        methods INTEGER NOT NULL,  -- 这种类型的联系方式条数
+        contacts INTEGER NOT NULL  -- 至少有一条这种类型联系方式的联系人数
+    )
+'''
+
+_LIVE_CONTACT = '''EXISTS (
+    SELECT 1 FROM contacts WHERE id = {}.contact_id AND deleted_at IS NULL)'''
+
+# 统计报表的汇总表，只统计未删除的联系人。汇总表本身不记变更日志，
+# 跟随节点由自己的触发器维护；彻底删除时的处理同 GROUP_COUNT_TRIGGERS
+ANALYTICS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_insert_daily
+    AFTER INSERT ON contacts
+    WHEN NEW.deleted_at IS NULL AND NEW.created_time IS NOT NULL
+    BEGIN
+        INSERT INTO contact_daily_counts (day, created, favorites)
+        VALUES (NEW.created_time / 86400, 1, NEW.is_favorite != 0)
+        ON CONFLICT(day) DO UPDATE SET
+            created = created + 1, favorites = favorites + excluded.favorites;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_delete_daily
+    AFTER DELETE ON contacts
+    WHEN OLD.deleted_at IS NULL
+    BEGIN
+        UPDATE contact_daily_counts
+        SET created = created - 1,
+            favorites = favorites - (OLD.is_favorite != 0)
+        WHERE day = OLD.created_time / 86400;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_update_daily
+    AFTER UPDATE OF created_time, is_favorite, deleted_at ON contacts
+    BEGIN
+        UPDATE contact_daily_counts
+        SET created = created - 1,
+            favorites = favorites - (OLD.is_favorite != 0)
+        WHERE day = OLD.created_time / 86400 AND OLD.deleted_at IS NULL;
+        INSERT INTO contact_daily_counts (day, created, favorites)
+        SELECT NEW.created_time / 86400, 1, NEW.is_favorite != 0
+        WHERE NEW.deleted_at IS NULL AND NEW.created_time IS NOT NULL
+        ON CONFLICT(day) DO UPDATE SET
+            created = created + 1, favorites = favorites + excluded.favorites;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_methods_insert_type_count
+    AFTER INSERT ON contact_methods
+    WHEN {_LIVE_CONTACT.format('NEW')}
+    BEGIN
+        INSERT INTO method_type_counts (type_id, methods, contacts)
+        VALUES (NEW.type_id, 1, NOT EXISTS (
+            SELECT 1 FROM contact_methods
+            WHERE contact_id = NEW.contact_id AND type_id = NEW.type_id
+              AND seq != NEW.seq))
+        ON CONFLICT(type_id) DO UPDATE SET
+            methods = methods + 1, contacts = contacts + excluded.contacts;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_methods_delete_type_count
+    AFTER DELETE ON contact_methods
+    WHEN {_LIVE_CONTACT.format('OLD')}
+    BEGIN
+        UPDATE method_type_counts
+        SET methods = methods - 1, contacts = contacts - NOT EXISTS (
+            SELECT 1 FROM contact_methods
+            WHERE contact_id = OLD.contact_id AND type_id = OLD.type_id)
+        WHERE type_id = OLD.type_id;
+    END
+    ''',
+    # 复制时同一位置的联系方式可能被改成另一种类型
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_contact_methods_update_type_count
+    AFTER UPDATE OF type_id ON contact_methods
+    WHEN OLD.type_id != NEW.type_id AND {_LIVE_CONTACT.format('NEW')}
+    BEGIN
+        UPDATE method_type_counts
+        SET methods = methods - 1, contacts = contacts - NOT EXISTS (
+            SELECT 1 FROM contact_methods
+            WHERE contact_id = OLD.contact_id AND type_id = OLD.type_id)
+        WHERE type_id = OLD.type_id;
+        INSERT INTO method_type_counts (type_id, methods, contacts)
+        VALUES (NEW.type_id, 1, NOT EXISTS (
+            SELECT 1 FROM contact_methods
+            WHERE contact_id = NEW.contact_id AND type_id = NEW.type_id
+              AND seq != NEW.seq))
+        ON CONFLICT(type_id) DO UPDATE SET
+            methods = methods + 1, contacts = contacts + excluded.contacts;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_update_type_count
+    AFTER UPDATE OF deleted_at ON contacts
+    WHEN (OLD.deleted_at IS NULL) != (NEW.deleted_at IS NULL)
+    BEGIN
+        INSERT INTO method_type_counts (type_id, methods, contacts)
+        SELECT type_id, COUNT(*) * sign, sign
+        FROM contact_methods,
+             (SELECT CASE WHEN NEW.deleted_at IS NULL THEN 1 ELSE -1 END
+                     AS sign)
+        WHERE contact_id = NEW.id
+        GROUP BY type_id
+        ON CONFLICT(type_id) DO UPDATE SET
+            methods = methods + excluded.methods,
+            contacts = contacts + excluded.contacts;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_contacts_delete_type_count
+    BEFORE DELETE ON contacts
+    WHEN OLD.deleted_at IS NULL
+    BEGIN
+        INSERT INTO method_type_counts (type_id, methods, contacts)
+        SELECT type_id, -COUNT(*), -1 FROM contact_methods
+        WHERE contact_id = OLD.id
+        GROUP BY type_id
+        ON CONFLICT(type_id) DO UPDATE SET
+            methods = methods + excluded.methods,
+            contacts = contacts + excluded.contacts;
+    END
+    '''
+]
+
+# 整体重算汇总表（迁移时和 maintenance.py rebuild-analytics），在一个事务里执行
+REBUILD_ANALYTICS_SQL = [
+    'DELETE FROM contact_daily_counts',
+    '''
+    INSERT INTO contact_daily_counts (day, created, favorites)
+    SELECT created_time / 86400, COUNT(*), SUM(is_favorite != 0)
+    FROM contacts
+    WHERE deleted_at IS NULL AND created_time IS NOT NULL
+    GROUP BY created_time / 86400
+    ''',
+    'DELETE FROM method_type_counts',
+    '''
+    INSERT INTO method_type_counts (type_id, methods, contacts)
+    SELECT m.type_id, COUNT(*), COUNT(DISTINCT m.contact_id)
+    FROM contact_methods m
+    JOIN contacts c ON c.id = m.contact_id
+    WHERE c.deleted_at IS NULL
+    GROUP BY m.type_id
+    '''
+]
+
+
+def change_version_triggers(tables):
+    """表的每次增删改都让 change_version 加一，其它进程的写入同样生效"""
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+        AFTER {event} ON {table}
+        BEGIN
+            UPDATE change_version SET version = version + 1 WHERE id = 1;
+        END
+        '''
+        for table in tables
+        for event in ('INSERT', 'UPDATE', 'DELETE')
+    ]
+
+
+MIGRATIONS = [
+    Migration(
+        1, "创建联系人表和联系方式表",
+        SQLStep("创建 contacts / contact_methods",
+                CREATE_CONTACTS_SQL, CREATE_CONTACT_METHODS_SQL)
+    ),
+    Migration(
+        2, "按联系人取联系方式、按联系方式的值精确查找",
+        CreateIndexStep('idx_contact_methods_contact_id', 'contact_methods',
+                        'contact_id'),
+        CreateIndexStep('idx_contact_methods_value', 'contact_methods',
+                        'method_value')
+    ),
+    Migration(
+        3, "联系人列表排序（收藏优先、创建时间倒序）",
+        CreateIndexStep('idx_contacts_favorite_created', 'contacts',
+                        'is_favorite, created_time')
+    ),
+    Migration(
+        4, "数据变更计数（导出缓存等按它判断数据是否变化）",
+        SQLStep("创建 change_version 表和计数触发器",
+                CREATE_CHANGE_VERSION_SQL,
+                "INSERT OR IGNORE INTO change_version (id, version) "
+                "VALUES (1, 0)",
+                *change_version_triggers(('contacts', 'contact_methods')))
+    ),
+    Migration(
+        5, "联系人列表的筛选和排序（姓名前缀、创建时间范围、联系方式类型）",
+        CreateIndexStep('idx_contacts_name', 'contacts', 'name'),
+        CreateIndexStep('idx_contacts_created', 'contacts', 'created_time'),
+        CreateIndexStep('idx_contact_methods_type_contact', 'contact_methods',
+                        'method_type, contact_id')
+    ),
+    Migration(
+        6, "软删除：删除只打标记，保留期过后由后台清理",
+        AddColumnStep('contacts', 'deleted_at', 'TIMESTAMP'),
+        CreateIndexStep('idx_contacts_deleted', 'contacts', 'deleted_at',
+                        where='deleted_at IS NOT NULL')
+    ),
+    Migration(
+        7, "拼音排序键和 A-Z 分组索引",
+        AddColumnStep('contacts', 'initial', 'TEXT'),
+        AddColumnStep('contacts', 'sort_key', 'TEXT'),
+        SQLStep("创建 contact_sections 表和计数触发器",
+                CREATE_CONTACT_SECTIONS_SQL, *CONTACT_SECTIONS_TRIGGERS),
+        PythonBackfillStep(
+            'contacts', 'name', 'sort_key IS NULL',
+            lambda row: collation_key(row[0]),
+            'UPDATE contacts SET initial = ?, sort_key = ? WHERE rowid = ?',
+            "contacts 回填拼音排序键"),
+        CreateIndexStep('idx_contacts_initial_sort', 'contacts',
+                        'initial, sort_key'),
+        # 回填过程中触发器已经在计数，这里整体重算一遍，中断重跑也不会多计
+        SQLStep("重新统计各分组人数",
+                "DELETE FROM contact_sections",
+                "INSERT INTO contact_sections (initial, count) "
+                "SELECT initial, COUNT(*) FROM contacts "
+                "WHERE initial IS NOT NULL AND deleted_at IS NULL "
+                "GROUP BY initial")
+    ),
+    Migration(
+        8, "紧凑存储：联系方式类型改为整数id、时间改为整数秒、联系方式按联系人聚簇",
+        CompactTablesStep()
+    ),
+    Migration(
+        9, "变更日志：跟随节点通过 /replication/log 复制数据",
+        SQLStep("创建 changelog / replication_state 表和日志触发器",
+                CREATE_CHANGELOG_SQL, CREATE_REPLICATION_STATE_SQL,
+                *CHANGELOG_TRIGGERS)
+    ),
+    Migration(
+        10, "联系人分组：成员表和增量维护的成员人数",
+        SQLStep("创建 contact_groups / group_members 表和触发器",
+                CREATE_CONTACT_GROUPS_SQL, CREATE_GROUP_MEMBERS_SQL,
+                *GROUP_COUNT_TRIGGERS, *GROUP_CHANGELOG_TRIGGERS,
+                *change_version_triggers(('contact_groups', 'group_members'))),
+        CreateIndexStep('idx_group_members_contact', 'group_members',
+                        'contact_id')
+    ),
+    Migration(
+        11, "统计报表：按天的新增人数和各联系方式类型的人数汇总表",
+        SQLStep("创建 contact_daily_counts / method_type_counts 表和触发器",
+                CREATE_CONTACT_DAILY_COUNTS_SQL, CREATE_METHOD_TYPE_COUNTS_SQL,
+                *ANALYTICS_TRIGGERS),
+        # 触发器先建好再重算，重算期间的写入不会漏计，中断重跑也不会多计
+        SQLStep("重新统计汇总表", *REBUILD_ANALYTICS_SQL)
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+# ========== 执行 ==========
+
+def connect(path):
+    """自动提交模式的连接，事务由各步骤显式控制"""
+    return sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def table_columns(conn, table):
+    return [col[1] for col in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def pending_migrations(conn):
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def check_not_legacy(conn):
+    """旧结构（contacts 表没有 is_favorite 列）不能直接升级"""
+    columns = table_columns(conn, 'contacts')
+    if columns and 'is_favorite' not in columns:
+        raise LegacySchemaError(
+            "数据库还是旧结构，请先运行: python database_migration.py migrate")
+
+
+def upgrade(path, batch_size=DEFAULT_BATCH_SIZE, pause=0.0, target=None,
+            log=print):
+    """把数据库升级到 target 版本（默认最新），返回升级后的版本号"""
+    conn = connect(path)
+    try:
+        check_not_legacy(conn)
+        for migration in pending_migrations(conn):
+            if target is not None and migration.version > target:
+                break
+            started = time.monotonic()
+            for step in migration.steps:
+                step.run(conn, batch_size, pause)
+            # 版本号只在所有步骤完成后写入，中断后会从这个版本重新执行
+            conn.execute(f'PRAGMA user_version = {migration.version}')
+            log(f"✅ 已升级到版本 {migration.version}: {migration.description}"
+                f"（{time.monotonic() - started:.2f} 秒）")
+        return current_version(conn)
+    finally:
+        conn.close()
+
+
+def dry_run(path, batch_size=DEFAULT_BATCH_SIZE):
+    """估算每个待执行步骤的耗时，不修改数据
+
+    返回 [(版本, 步骤说明, 涉及行数, 预计秒数), ...]
+    前面版本的结构还没应用时，后面依赖它的步骤无法估算，记为 None
+    """
+    conn = connect(path)
+    try:
+        check_not_legacy(conn)
+        plan = []
+        for migration in pending_migrations(conn):
+            for step in migration.steps:
+                try:
+                    rows, seconds = step.estimate(conn, batch_size)
+                except sqlite3.Error:
+                    rows, seconds = None, None
+                plan.append((migration.version, step.description, rows,
+                             seconds))
+        return plan
+    finally:
+        conn.close()
+
+
+def _compacted(conn):
+    """版本8的紧凑结构是否已经建好"""
+    return 'type_id' in table_columns(conn, 'contact_methods')
+
+
+def _count(conn, table, where=None):
+    sql = f'SELECT COUNT(*) FROM {table}'
+    if where:
+        sql += f' WHERE {where}'
+    return conn.execute(sql).fetchone()[0]
+
+
+def _time_rolled_back(conn, batch, rows):
+    """在会回滚的事务里跑一批样本，按样本速度外推总耗时"""
+    conn.execute('BEGIN')
+    try:
+        started = time.perf_counter()
+        sampled = batch()
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.execute('ROLLBACK')
+    if not sampled:
+        return 0.0
+    return elapsed / sampled * rows
+
+
+@contextmanager
+def _immediate(conn):
+    """BEGIN IMMEDIATE ... COMMIT：一开始就拿写锁，出错回滚"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+# ========== 命令行 ==========
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="通讯录系统表结构版本迁移")
+    parser.add_argument('--db', default=DEFAULT_DB,
+                        help=f"数据库文件（默认 {DEFAULT_DB}）")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('status', help="查看当前版本和待执行的迁移")
+
+    dry = commands.add_parser('dry-run', help="估算待执行迁移的耗时")
+    dry.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    up = commands.add_parser('upgrade', help="执行待执行的迁移")
+    up.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                    help="回填时每批处理的行数")
+    up.add_argument('--pause', type=float, default=0.0,
+                    help="批次之间暂停的秒数，给API让出写锁")
+    up.add_argument('--target', type=int, default=None,
+                    help="只升级到指定版本")
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'status':
+            conn = connect(args.db)
+            try:
+                print(f"📊 当前版本: {current_version(conn)}，"
+                      f"最新版本: {LATEST_VERSION}")
+                for migration in pending_migrations(conn):
+                    print(f"  - 待执行 {migration.version}: "
+                          f"{migration.description}")
+            finally:
+                conn.close()
+
+        elif args.command == 'dry-run':
+            plan = dry_run(args.db, args.batch_size)
+            if not plan:
+                print("✅ 已是最新版本，无需迁移")
+            total = 0.0
+            for version, description, rows, seconds in plan:
+                if seconds is None:
+                    print(f"  [{version}] {description}: 依赖前面的步骤，无法预估")
+                    continue
+                total += seconds
+                print(f"  [{version}] {description}: {rows} 行，"
+                      f"预计 {seconds:.2f} 秒")
+            if plan:
+                print(f"⏱️  预计总耗时 {total:.2f} 秒（不含无法预估的步骤）")
+
+        else:
+            version = upgrade(args.db, args.batch_size, args.pause,
+                              args.target)
+            print(f"📈 当前版本: {version}")
+
+    except LegacySchemaError as e:
+        print(f"❌ {e}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Serverless 只读快照模式 - 通讯录系统
+Vercel 等 Serverless 环境里每个冷启动实例都从一个空的本地 contacts.db 开始，并且重复建表。
+快照模式下函数直接打开随代码一起部署的、预先构建好的只读快照：
+- 以 immutable=1 打开，不加锁、不检查日志文件，配合较大的 mmap_size，冷启动不用做任何初始化
+- 写请求原样转发给单独部署的主库服务（CONTACTS_PRIMARY_URL），快照由发布流程定期重新构建
+
+构建快照（默认地址簿和 books/ 下的所有地址簿）：
+
+    python serverless.py build --db contacts.db --shard-dir books \\
+        --out snapshot
+
+部署时设置 CONTACTS_SNAPSHOT_DIR=snapshot、CONTACTS_PRIMARY_URL=<主库地址>。
+本地测试时主库可以是另一个以普通模式运行的 main.py（PORT=5001 python main.py）。
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import requests
+
+import schema_migrations
+from backup import snapshot
+from db import ShardManager, readonly_uri
+
+# 快照目录里默认地址簿的文件名、其它地址簿所在的子目录
+DEFAULT_FILE = 'contacts.db'
+BOOKS_DIR = 'books'
+# 转发写请求时原样带给主库的请求头（地址簿id由调用方单独传入）
+FORWARD_HEADERS = ('Content-Type', 'X-Admin-Token')
+# 主库响应中原样返回给客户端的响应头
+RESPONSE_HEADERS = ('Content-Type', 'Content-Disposition', 'Retry-After',
+                    'X-Replication-Seq')
+
+
+class SnapshotMissingError(LookupError):
+    """快照目录里没有这个地址簿的快照文件"""
+
+
+class PrimaryUnavailableError(RuntimeError):
+    """主库服务连不上或超时"""
+
+
+def snapshot_paths(snapshot_dir):
+    """(默认地址簿快照路径, 其它地址簿快照目录)"""
+    return (os.path.join(snapshot_dir, DEFAULT_FILE),
+            os.path.join(snapshot_dir, BOOKS_DIR))
+
+
+def require_snapshot(path):
+    """ShardManager 的 on_open：快照模式下不建库，文件不存在时报错"""
+    if not os.path.isfile(path):
+        raise SnapshotMissingError(path)
+
+
+def snapshot_info(path):
+    """快照的基本信息：大小、构建时间、表结构版本、数据变更版本"""
+    require_snapshot(path)
+    conn = sqlite3.connect(readonly_uri(path, immutable=True), uri=True)
+    try:
+        schema_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        change_version = conn.execute(
+            'SELECT version FROM change_version WHERE id = 1').fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'path': path,
+        'size': os.path.getsize(path),
+        'built_at': datetime.fromtimestamp(os.path.getmtime(path))
+                            .strftime('%Y-%m-%d %H:%M:%S'),
+        'schema_version': schema_version,
+        'change_version': change_version
+    }
+
+
+def build_snapshot(source_path, target_path):
+    """把数据库复制成只读快照，返回 snapshot_info
+
+    复制后升级到最新表结构、收集查询规划统计、整理碎片，并改回 rollback 日志模式
+    （immutable 打开时不会读 -wal 文件，快照里不能有未写回的WAL内容）
+    """
+    directory = os.path.dirname(target_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{target_path}.building"
+    snapshot(source_path, tmp_path)
+    schema_migrations.upgrade(tmp_path, log=lambda line: None)
+
+    conn = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.execute('ANALYZE')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+    # 部署包里的旧快照可能正被读取，写完再原子替换
+    os.replace(tmp_path, target_path)
+    return snapshot_info(target_path)
+
+
+def build_all(db_path, shard_dir, out_dir):
+    """为默认地址簿和 shard_dir 下的所有地址簿构建快照，返回 [(book_id, info), ...]"""
+    source = ShardManager(shard_dir, db_path)
+    default_path, books_dir = snapshot_paths(out_dir)
+    target = ShardManager(books_dir, default_path)
+    return [(book_id, build_snapshot(source.path_for(book_id),
+                                     target.path_for(book_id)))
+            for book_id in source.book_ids()
+            if os.path.isfile(source.path_for(book_id))]
+
+
+class WriteForwarder:
+    """把写请求转发给主库服务"""
+
+    def __init__(self, primary_url, timeout=10.0):
+        self.primary_url = primary_url.rstrip('/')
+        self.timeout = timeout
+        self.forwarded = 0
+        self.failed = 0
+
+    def forward(self, method, path, query_string, headers, body):
+        """返回 (响应体, 状态码, 响应头)；主库不可用时抛出 PrimaryUnavailableError"""
+        url = self.primary_url + path
+        if query_string:
+            url += '?' + query_string
+        try:
+            response = requests.request(method, url, headers=headers,
+                                        data=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.failed += 1
+            raise PrimaryUnavailableError(str(e)) from e
+        self.forwarded += 1
+        return (response.content, response.status_code,
+                {name: response.headers[name] for name in RESPONSE_HEADERS
+                 if name in response.headers})
+
+    def stats(self):
+        return {
+            'primary': self.primary_url,
+            'forwarded': self.forwarded,
+            'failed': self.failed
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='通讯录只读快照工具')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = sub.add_parser('build', help='构建只读快照')
+    build_parser.add_argument('--db', default='contacts.db',
+                              help='默认地址簿的数据库文件')
+    build_parser.add_argument('--shard-dir', default='books',
+                              help='其它地址簿的数据库目录')
+    build_parser.add_argument('--out', default='snapshot', help='快照输出目录')
+
+    info_parser = sub.add_parser('info', help='查看快照信息')
+    info_parser.add_argument('--out', default='snapshot', help='快照目录')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        built = build_all(args.db, args.shard_dir, args.out)
+        for book_id, info in built:
+            print(f"📦 {book_id}: {info['path']}  {info['size']:,} 字节  "
+                  f"表结构版本 {info['schema_version']}")
+        print(f"✅ 已构建 {len(built)} 个地址簿的只读快照")
+    else:
+        default_path, books_dir = snapshot_paths(args.out)
+        shards = ShardManager(books_dir, default_path)
+        for book_id in shards.book_ids():
+            try:
+                info = snapshot_info(shards.path_for(book_id))
+            except SnapshotMissingError:
+                continue
+            print(f"📦 {book_id}: {info['size']:,} 字节  构建于 "
+                  f"{info['built_at']}  表结构版本 {info['schema_version']}  "
+                  f"数据版本 {info['change_version']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
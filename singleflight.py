@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+请求合并（single-flight） - 通讯录系统
+同一个 key 同时只执行一次，其余并发调用等待并共享这次的结果（或异常）
+"""
+
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # 真正执行的次数、搭便车共享结果的次数
+        self.executions = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        """执行 fn() 并返回结果；同一 key 已在执行时等待它的结果"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self, key):
+        """key 当前是否正在执行"""
+        with self._lock:
+            return key in self._calls
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executions': self.executions,
+                'shared': self.shared,
+                'in_flight': len(self._calls)
+            }
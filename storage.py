@@ -0,0 +1,1615 @@
+#!/usr/bin/env python3
+"""
+存储层 - 通讯录系统
+路由只通过 ContactRepository 接口访问数据，具体实现有：
+- SQLiteRepository: 基于 contacts.db 的实现（默认）
+- MemoryRepository: 纯内存实现，带索引，用于测试、热缓存和性能对比
+"""
+
+import calendar
+import threading
+from bisect import bisect_left, insort
+from datetime import date, datetime, timedelta, timezone
+
+from pinyin_keys import INITIALS, collation_key
+
+# 导出Excel的列
+EXPORT_COLUMNS = ['id', 'name', 'is_favorite', 'phones', 'emails',
+                  'other_methods']
+# 批量按值查找时每条 IN (...) 语句的参数个数，低于 SQLite 的变量上限
+LOOKUP_CHUNK_SIZE = 500
+# 统计报表的日期按UTC计算，与 created_time 一致；天数从这一天起算
+EPOCH_DATE = date(1970, 1, 1)
+
+
+def now_timestamp():
+    """与 SQLite CURRENT_TIMESTAMP 相同格式的当前UTC时间"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def clean_methods(methods):
+    """过滤掉类型或值为空的联系方式，返回 (type, value) 列表"""
+    cleaned = []
+    for method in methods or []:
+        method_type = method.get('type')
+        method_value = method.get('value')
+        if method_type and method_value:
+            cleaned.append((method_type, method_value))
+    return cleaned
+
+
+def export_row(contact):
+    """把联系人字典转换成导出用的一行"""
+    phones = [m['value'] for m in contact['methods'] if m['type'] == 'phone']
+    emails = [m['value'] for m in contact['methods'] if m['type'] == 'email']
+    others = [f"{m['type']}: {m['value']}" for m in contact['methods']
+              if m['type'] not in ('phone', 'email')]
+    return {
+        'id': contact['id'],
+        'name': contact['name'],
+        'is_favorite': int(contact['is_favorite']),
+        'phones': ';'.join(phones),
+        'emails': ';'.join(emails),
+        'other_methods': ','.join(others) if others else None
+    }
+
+
+# ========== SQLite 表结构相关的SQL片段（见 schema_migrations.py 版本8） ==========
+
+# created_time / deleted_at 以UTC整数秒存储，读出时转换回 'YYYY-MM-DD HH:MM:SS'
+CONTACT_COLUMNS = ("c.id, c.name, c.is_favorite, "
+                   "datetime(c.created_time, 'unixepoch')")
+NOW_EPOCH_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+# 联系方式类型存在 method_types 表里，contact_methods 只存类型id
+METHOD_ROWS_SQL = '''
+    SELECT m.contact_id, t.name, m.method_value
+    FROM contact_methods m
+    JOIN method_types t ON t.id = m.type_id
+'''
+TYPE_ID_SQL = '(SELECT id FROM method_types WHERE name = ?)'
+
+
+def to_epoch(timestamp):
+    """'YYYY-MM-DD HH:MM:SS'（UTC）转成整数秒"""
+    moment = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(moment.timetuple())
+
+
+# ========== 列表筛选和排序 ==========
+
+# 排序键只能从这里选，对应的SQL列是固定的
+SORT_COLUMNS = {
+    'name': ('c.name',),
+    'created_time': ('c.created_time',),
+    'id': ('c.id',),
+    # 通讯录 A-Z 顺序，与 /contacts/sections 的偏移量一致
+    'pinyin': ('c.initial', 'c.sort_key')
+}
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+# 比任何以前缀开头的字符串都大，姓名前缀用范围查询以便走索引
+PREFIX_UPPER_BOUND = '\U0010ffff'
+MAX_FILTER_LENGTH = 64
+# 分页时每页最多的联系人数
+MAX_PAGE_SIZE = 1000
+# 默认顺序：收藏优先、创建时间倒序，同一秒创建的按id升序（与 MemoryRepository._order_key 一致），
+# 保证分页时顺序稳定
+DEFAULT_ORDER_SQL = 'c.is_favorite DESC, c.created_time DESC, c.id ASC'
+
+
+class InvalidQueryError(ValueError):
+    """筛选或排序参数不合法"""
+
+
+class ContactQuery:
+    """联系人列表的筛选和排序条件
+
+    - is_favorite: 只要（不要）收藏的联系人
+    - method_types: 必须拥有的联系方式类型（全部满足）
+    - created_from / created_before: 创建时间范围 [from, before)
+    - name_prefix: 姓名前缀（区分大小写）
+    - initial: 拼音分组字母（A-Z 或 #）
+    - group_id: 只要这个分组的成员
+    - sort / descending: 排序键（name、created_time、id、pinyin），为空时用默认顺序
+    - limit / offset: 分页，limit 为空时返回全部
+    """
+
+    def __init__(self, is_favorite=None, method_types=(), created_from=None,
+                 created_before=None, name_prefix=None, sort=None,
+                 descending=False, initial=None, group_id=None, limit=None,
+                 offset=0):
+        self.is_favorite = is_favorite
+        self.method_types = tuple(method_types)
+        self.created_from = created_from
+        self.created_before = created_before
+        self.name_prefix = name_prefix
+        self.initial = initial
+        self.group_id = group_id
+        self.sort = sort
+        self.descending = descending
+        self.limit = limit
+        self.offset = offset
+
+    @classmethod
+    def from_params(cls, params):
+        """从请求参数解析：is_favorite、has（可重复）、created_from、
+        created_to（含当天/当秒）、name_prefix、initial、group（分组id）、
+        sort（前面加 - 表示倒序）、limit、offset
+        """
+        is_favorite = None
+        if params.get('is_favorite'):
+            text = params.get('is_favorite').lower()
+            if text not in ('1', '0', 'true', 'false'):
+                raise InvalidQueryError("is_favorite 只能是 1/0/true/false")
+            is_favorite = text in ('1', 'true')
+
+        method_types = [t for t in params.getlist('has') if t]
+        name_prefix = params.get('name_prefix') or None
+        for value in method_types + [name_prefix or '']:
+            if len(value) > MAX_FILTER_LENGTH:
+                raise InvalidQueryError(
+                    f"筛选值不能超过{MAX_FILTER_LENGTH}个字符")
+
+        created_from = None
+        if params.get('created_from'):
+            created_from, _ = _parse_time(params.get('created_from'))
+        created_before = None
+        if params.get('created_to'):
+            moment, date_only = _parse_time(params.get('created_to'))
+            # 结束时间包含在内：日期包含当天，时间包含当秒
+            created_before = (moment + timedelta(days=1) if date_only
+                              else moment + timedelta(seconds=1))
+
+        initial = params.get('initial') or None
+        if initial is not None:
+            initial = initial.upper()
+            if initial not in INITIALS:
+                raise InvalidQueryError("initial 只能是 A-Z 或 #")
+
+        group_id = _parse_int(params, 'group', 1, None)
+        limit = _parse_int(params, 'limit', 1, MAX_PAGE_SIZE)
+        offset = _parse_int(params, 'offset', 0, None) or 0
+
+        sort = params.get('sort') or None
+        descending = False
+        if sort:
+            descending = sort.startswith('-')
+            sort = sort.lstrip('-')
+            if sort not in SORT_COLUMNS:
+                raise InvalidQueryError(
+                    f"sort 只能是 {', '.join(SORT_COLUMNS)}（前面加 - 倒序）")
+
+        return cls(
+            is_favorite=is_favorite,
+            method_types=sorted(set(method_types)),
+            created_from=_format_time(created_from),
+            created_before=_format_time(created_before),
+            name_prefix=name_prefix,
+            initial=initial,
+            group_id=group_id,
+            sort=sort,
+            descending=descending,
+            limit=limit,
+            offset=offset
+        )
+
+    def to_dict(self):
+        """条件的字典形式（用作缓存键）"""
+        return {
+            'is_favorite': self.is_favorite,
+            'method_types': list(self.method_types),
+            'created_from': self.created_from,
+            'created_before': self.created_before,
+            'name_prefix': self.name_prefix,
+            'initial': self.initial,
+            'group_id': self.group_id,
+            'sort': self.sort,
+            'descending': self.descending,
+            'limit': self.limit,
+            'offset': self.offset
+        }
+
+    @property
+    def filtered(self):
+        """是否有筛选条件（排序不算）"""
+        return (self.is_favorite is not None or bool(self.method_types)
+                or bool(self.created_from) or bool(self.created_before)
+                or bool(self.name_prefix) or bool(self.initial)
+                or self.group_id is not None)
+
+    @property
+    def paged(self):
+        return self.limit is not None or self.offset > 0
+
+    def where_sql(self):
+        """编译成参数化的 WHERE 子句（联系人表别名为 c，总是排除已删除的），
+        返回 (sql, params)
+        """
+        clauses = ['c.deleted_at IS NULL']
+        params = []
+        if self.is_favorite is not None:
+            clauses.append('c.is_favorite = ?')
+            params.append(int(self.is_favorite))
+        for method_type in self.method_types:
+            clauses.append(
+                'EXISTS (SELECT 1 FROM contact_methods m '
+                f'WHERE m.type_id = {TYPE_ID_SQL} AND m.contact_id = c.id)')
+            params.append(method_type)
+        if self.created_from:
+            clauses.append('c.created_time >= ?')
+            params.append(to_epoch(self.created_from))
+        if self.created_before:
+            clauses.append('c.created_time < ?')
+            params.append(to_epoch(self.created_before))
+        if self.name_prefix:
+            clauses.append('c.name >= ? AND c.name < ?')
+            params.extend([self.name_prefix,
+                           self.name_prefix + PREFIX_UPPER_BOUND])
+        if self.initial:
+            clauses.append('c.initial = ?')
+            params.append(self.initial)
+        if self.group_id is not None:
+            # 成员表主键 (group_id, contact_id) 上的范围扫描，再按id取联系人
+            clauses.append('c.id IN (SELECT contact_id FROM group_members '
+                           'WHERE group_id = ?)')
+            params.append(self.group_id)
+        return 'WHERE ' + ' AND '.join(clauses), params
+
+    def order_sql(self, default):
+        if not self.sort:
+            return default
+        direction = 'DESC' if self.descending else 'ASC'
+        return ', '.join(f'{column} {direction}'
+                         for column in SORT_COLUMNS[self.sort] + ('c.id',))
+
+    def page_sql(self):
+        """分页子句，返回 (sql, params)；不分页时为空"""
+        if not self.paged:
+            return '', []
+        # LIMIT -1 表示不限条数，只跳过 offset
+        return 'LIMIT ? OFFSET ?', [
+            -1 if self.limit is None else self.limit, self.offset]
+
+    def matches(self, contact):
+        """联系人字典是否满足筛选条件（内存实现使用）
+
+        联系人字典里没有分组信息，group_id 由内存实现先按成员筛选
+        """
+        if (self.is_favorite is not None
+                and bool(contact['is_favorite']) != self.is_favorite):
+            return False
+        types = {m['type'] for m in contact['methods']}
+        if any(t not in types for t in self.method_types):
+            return False
+        created_time = contact['created_time'] or ''
+        if self.created_from and created_time < self.created_from:
+            return False
+        if self.created_before and created_time >= self.created_before:
+            return False
+        if self.name_prefix and not contact['name'].startswith(
+                self.name_prefix):
+            return False
+        if self.initial and collation_key(contact['name'])[0] != self.initial:
+            return False
+        return True
+
+    def apply(self, contacts):
+        """在已按默认顺序排列的联系人字典列表上筛选、排序和分页"""
+        contacts = [c for c in contacts if self.matches(c)]
+        if self.sort == 'pinyin':
+            contacts.sort(key=lambda c: (collation_key(c['name']), c['id']),
+                          reverse=self.descending)
+        elif self.sort:
+            contacts.sort(key=lambda c: (c[self.sort], c['id']),
+                          reverse=self.descending)
+        if self.paged:
+            end = None if self.limit is None else self.offset + self.limit
+            contacts = contacts[self.offset:end]
+        return contacts
+
+
+def _parse_time(text):
+    """解析时间参数，返回 (datetime, 是否只有日期)"""
+    for time_format in TIME_FORMATS:
+        try:
+            return (datetime.strptime(text.strip(), time_format),
+                    time_format == '%Y-%m-%d')
+        except ValueError:
+            continue
+    raise InvalidQueryError(
+        f"时间格式不正确: {text}（应为 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS）")
+
+
+def _parse_int(params, name, minimum, maximum):
+    """解析整数参数，没有时返回 None"""
+    text = params.get(name)
+    if not text:
+        return None
+    try:
+        value = int(text)
+    except ValueError:
+        raise InvalidQueryError(f"{name} 必须是整数")
+    if value < minimum or (maximum is not None and value > maximum):
+        upper = f"~{maximum}" if maximum is not None else " 以上"
+        raise InvalidQueryError(f"{name} 只能是 {minimum}{upper}")
+    return value
+
+
+def _format_time(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S') if moment else None
+
+
+class ContactRepository:
+    """联系人存储接口
+
+    联系人统一用字典表示：
+    {'id', 'name', 'is_favorite', 'created_time',
+     'methods': [{'type', 'value'}, ...]}
+    """
+
+    def list_contacts(self, query=None):
+        """所有联系人，收藏优先，其次按创建时间倒序
+
+        query 为 ContactQuery 时按条件筛选和排序
+        """
+        raise NotImplementedError
+
+    def get_contact(self, contact_id):
+        """单个联系人，不存在时返回 None"""
+        raise NotImplementedError
+
+    def add_contact(self, name, methods, is_favorite=False):
+        """添加联系人，返回新联系人的id"""
+        raise NotImplementedError
+
+    def update_contact(self, contact_id, name, methods):
+        """更新联系人：name 为空时保留原姓名，联系方式整体替换
+
+        返回联系人是否存在（已删除的联系人不能更新）
+        """
+        raise NotImplementedError
+
+    def delete_contact(self, contact_id):
+        """软删除联系人，返回是否删除了联系人
+
+        被删除的联系人从所有读取中消失，保留期内可以用 restore_contact 恢复，
+        之后由 purge_deleted 真正删除（见 maintenance.py）
+        """
+        raise NotImplementedError
+
+    def restore_contact(self, contact_id):
+        """恢复软删除的联系人，返回是否恢复了"""
+        raise NotImplementedError
+
+    def purge_deleted(self, deleted_before, limit=500):
+        """彻底删除 deleted_before 之前软删除的联系人（最多 limit 个）
+
+        deleted_before 为 'YYYY-MM-DD HH:MM:SS'（UTC），返回删除的个数
+        """
+        raise NotImplementedError
+
+    def toggle_favorite(self, contact_id):
+        """切换收藏状态，返回 (name, is_favorite)，联系人不存在时返回 None"""
+        raise NotImplementedError
+
+    def list_favorites(self):
+        """所有收藏的联系人，按创建时间倒序"""
+        raise NotImplementedError
+
+    def search(self, keyword):
+        """按姓名或联系方式做子串搜索"""
+        raise NotImplementedError
+
+    def find_by_method_value(self, value):
+        """精确查找拥有某个联系方式的联系人id列表"""
+        raise NotImplementedError
+
+    def find_by_method_values(self, values):
+        """批量精确查找，返回 {值: [联系人id, ...]}，只包含有联系人的值"""
+        raise NotImplementedError
+
+    def stats(self, group_id=None):
+        """统计数据；group_id 不为空时只统计这个分组的成员，分组不存在时返回 None"""
+        raise NotImplementedError
+
+    def sections(self):
+        """按拼音分组字母的人数，[{'initial', 'count', 'offset'}, ...]
+
+        分组按 A-Z 顺序排列（# 在最前），offset 为该分组第一个联系人
+        在 list_contacts(sort=pinyin) 结果中的位置
+        """
+        raise NotImplementedError
+
+    def analytics(self, days, weeks, today=None):
+        """统计报表（日期按UTC，today 默认为今天）
+
+        {'total_contacts', 'favorite_contacts', 'favorite_share',
+         'daily': 最近 days 天每天的 {'date', 'created', 'favorites'},
+         'weekly': 最近 weeks 周（周一开始）每周的 {'week_start', 'created', 'favorites'},
+         'method_types': [{'type', 'methods', 'contacts', 'share'}, ...]}，
+        created 为当天创建、目前未删除的联系人数，favorites 为其中收藏的人数
+        """
+        raise NotImplementedError
+
+    def export_rows(self, query=None):
+        """导出用的行，列见 EXPORT_COLUMNS；query 同 list_contacts"""
+        raise NotImplementedError
+
+    def import_contacts(self, records):
+        """批量导入 [{'name', 'is_favorite', 'methods'}, ...]
+
+        返回 (成功条数, [(记录下标, 错误信息), ...])
+        """
+        raise NotImplementedError
+
+    def contacts_after(self, contact_id):
+        """id 大于给定值的联系人（按id升序），用于同步新导入的数据"""
+        raise NotImplementedError
+
+    def change_version(self):
+        """数据变更版本，任何写入后都会变大
+
+        调用之后读到的数据至少和返回的版本一样新
+        """
+        raise NotImplementedError
+
+    def local_version(self):
+        """不访问数据库就能取得的进程内数据版本，取不到时返回 None
+
+        用于合并相同的读请求；本进程的写入会让它变大，
+        其它进程的写入要等被发现（见 ChangeWatcher）之后才会反映出来
+        """
+        return None
+
+    def list_groups(self):
+        """所有分组，按名称排列
+
+        [{'id', 'name', 'member_count', 'created_time'}, ...]，
+        member_count 为未删除的成员数
+        """
+        raise NotImplementedError
+
+    def create_group(self, name):
+        """创建分组，返回新分组的id；同名分组已存在时返回 None"""
+        raise NotImplementedError
+
+    def delete_group(self, group_id):
+        """删除分组（成员联系人不受影响），返回是否删除了"""
+        raise NotImplementedError
+
+    def add_group_members(self, group_id, contact_ids):
+        """把联系人批量加入分组，返回新加入的人数
+
+        不存在、已删除或已经在分组里的联系人跳过；分组不存在时返回 None
+        """
+        raise NotImplementedError
+
+    def remove_group_members(self, group_id, contact_ids):
+        """把联系人批量移出分组，返回移出的人数；分组不存在时返回 None"""
+        raise NotImplementedError
+
+
+# ========== SQLite 实现 ==========
+
+class SQLiteRepository(ContactRepository):
+    """基于 SQLite 的实现，读走只读连接池，写走主库
+
+    fresh=True 时读操作也直接读主库（不走定期刷新的副本）。
+    observer 不为空时每个写事务以 BEGIN IMMEDIATE 开始，拿到写锁后调用
+    observer.begin(conn)，提交前调用 observer.commit(conn)（见 contact_index.py）；
+    database.write_observers 里的对象同样对待（见 suggest.py）
+    """
+
+    def __init__(self, database, fresh=False, observer=None):
+        self.database = database
+        self.fresh = fresh
+        self.observer = observer
+
+    def list_contacts(self, query=None):
+        query = query or ContactQuery()
+        where, params = query.where_sql()
+        order = query.order_sql(DEFAULT_ORDER_SQL)
+        page, page_params = query.page_sql()
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {CONTACT_COLUMNS}
+                FROM contacts c
+                {where}
+                ORDER BY {order}
+                {page}
+            ''', params + page_params)
+            contacts = cursor.fetchall()
+
+            # 分页时只取这一页的联系方式；有筛选条件时只取命中联系人的；
+            # 否则整表读取，已删除联系人的联系方式在组装时自然被丢弃
+            if query.paged:
+                contact_ids = [c[0] for c in contacts]
+                placeholders = ','.join(['?'] * len(contact_ids))
+                cursor.execute(f'''
+                    {METHOD_ROWS_SQL}
+                    WHERE m.contact_id IN ({placeholders})
+                    ORDER BY m.contact_id, m.seq
+                ''', contact_ids)
+            elif query.filtered:
+                cursor.execute(f'''
+                    {METHOD_ROWS_SQL}
+                    WHERE m.contact_id IN (SELECT c.id FROM contacts c {where})
+                    ORDER BY m.contact_id, m.seq
+                ''', params)
+            else:
+                cursor.execute(f'''
+                    {METHOD_ROWS_SQL}
+                    ORDER BY m.contact_id, m.seq
+                ''')
+            methods = cursor.fetchall()
+
+        return self._assemble(contacts, methods)
+
+    def get_contact(self, contact_id):
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'SELECT {CONTACT_COLUMNS} FROM contacts c '
+                'WHERE c.id=? AND c.deleted_at IS NULL',
+                (contact_id,)
+            )
+            contact = cursor.fetchone()
+            if not contact:
+                return None
+
+            cursor.execute(
+                f'{METHOD_ROWS_SQL} WHERE m.contact_id=? ORDER BY m.seq',
+                (contact_id,)
+            )
+            methods = cursor.fetchall()
+
+        return self._assemble([contact], methods)[0]
+
+    def add_contact(self, name, methods, is_favorite=False):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT INTO contacts (name, is_favorite, initial, sort_key) '
+                'VALUES (?, ?, ?, ?)',
+                (name, int(bool(is_favorite))) + collation_key(name)
+            )
+            contact_id = cursor.lastrowid
+            self._insert_methods(cursor, contact_id, methods)
+            self._commit(conn)
+            return contact_id
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def update_contact(self, contact_id, name, methods):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT 1 FROM contacts WHERE id=? AND deleted_at IS NULL',
+                (contact_id,)
+            )
+            if not cursor.fetchone():
+                return False
+            if name:
+                cursor.execute(
+                    'UPDATE contacts SET name=?, initial=?, sort_key=? '
+                    'WHERE id=?',
+                    (name,) + collation_key(name) + (contact_id,)
+                )
+            cursor.execute('DELETE FROM contact_methods WHERE contact_id=?',
+                           (contact_id,))
+            self._insert_methods(cursor, contact_id, methods)
+            self._commit(conn)
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def delete_contact(self, contact_id):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            # 只打删除标记，联系方式留到清理时随联系人一起级联删除
+            cursor.execute(
+                f'UPDATE contacts SET deleted_at={NOW_EPOCH_SQL} '
+                'WHERE id=? AND deleted_at IS NULL',
+                (contact_id,)
+            )
+            deleted = cursor.rowcount > 0
+            self._commit(conn)
+            return deleted
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def restore_contact(self, contact_id):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE contacts SET deleted_at=NULL '
+                'WHERE id=? AND deleted_at IS NOT NULL',
+                (contact_id,)
+            )
+            restored = cursor.rowcount > 0
+            self._commit(conn)
+            return restored
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def purge_deleted(self, deleted_before, limit=500):
+        # 分批删除，每批一个短事务，不长时间占着写锁；
+        # 联系方式由外键 ON DELETE CASCADE 一起删除
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM contacts WHERE id IN (
+                    SELECT id FROM contacts
+                    WHERE deleted_at IS NOT NULL AND deleted_at < ?
+                    LIMIT ?
+                )
+            ''', (to_epoch(deleted_before), limit))
+            purged = cursor.rowcount
+            self._commit(conn)
+            return purged
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def toggle_favorite(self, contact_id):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE contacts SET is_favorite = NOT is_favorite '
+                'WHERE id=? AND deleted_at IS NULL',
+                (contact_id,)
+            )
+            self._commit(conn)
+
+            cursor.execute(
+                'SELECT name, is_favorite FROM contacts '
+                'WHERE id=? AND deleted_at IS NULL',
+                (contact_id,)
+            )
+            result = cursor.fetchone()
+            if not result:
+                return None
+            return result[0], bool(result[1])
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def list_favorites(self):
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {CONTACT_COLUMNS}, t.name, cm.method_value
+                FROM contacts c
+                LEFT JOIN contact_methods cm ON c.id = cm.contact_id
+                LEFT JOIN method_types t ON t.id = cm.type_id
+                WHERE c.is_favorite = 1 AND c.deleted_at IS NULL
+                ORDER BY c.created_time DESC, c.id, cm.seq
+            ''')
+            results = cursor.fetchall()
+
+        favorites = {}
+        for row in results:
+            contact_id = row[0]
+            if contact_id not in favorites:
+                favorites[contact_id] = {
+                    'id': contact_id,
+                    'name': row[1],
+                    'is_favorite': bool(row[2]),
+                    'created_time': row[3],
+                    'methods': []
+                }
+            if row[4] and row[5]:  # 如果有联系方式
+                favorites[contact_id]['methods'].append({
+                    'type': row[4],
+                    'value': row[5]
+                })
+        return list(favorites.values())
+
+    def search(self, keyword):
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT DISTINCT {CONTACT_COLUMNS}
+                FROM contacts c
+                LEFT JOIN contact_methods cm ON c.id = cm.contact_id
+                WHERE (c.name LIKE ? OR cm.method_value LIKE ?)
+                  AND c.deleted_at IS NULL
+                ORDER BY {DEFAULT_ORDER_SQL}
+            ''', (f'%{keyword}%', f'%{keyword}%'))
+            contacts = cursor.fetchall()
+
+            # 获取这些联系人的所有联系方式
+            contact_ids = [c[0] for c in contacts]
+            if contact_ids:
+                placeholders = ','.join(['?'] * len(contact_ids))
+                cursor.execute(f'''
+                    {METHOD_ROWS_SQL}
+                    WHERE m.contact_id IN ({placeholders})
+                    ORDER BY m.contact_id, m.seq
+                ''', contact_ids)
+                methods = cursor.fetchall()
+            else:
+                methods = []
+
+        return self._assemble(contacts, methods)
+
+    def find_by_method_value(self, value):
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT DISTINCT cm.contact_id FROM contact_methods cm '
+                'JOIN contacts c ON c.id = cm.contact_id '
+                'WHERE cm.method_value=? AND c.deleted_at IS NULL',
+                (value,)
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def find_by_method_values(self, values):
+        values = list(dict.fromkeys(values))
+        found = {}
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            # 分段走 idx_contact_methods_value，每段一条语句
+            for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+                chunk = values[start:start + LOOKUP_CHUNK_SIZE]
+                cursor.execute(
+                    'SELECT DISTINCT cm.method_value, cm.contact_id '
+                    'FROM contact_methods cm '
+                    'JOIN contacts c ON c.id = cm.contact_id '
+                    f'WHERE cm.method_value IN ({",".join("?" * len(chunk))}) '
+                    'AND c.deleted_at IS NULL '
+                    'ORDER BY cm.method_value, cm.contact_id',
+                    chunk
+                )
+                for value, contact_id in cursor.fetchall():
+                    found.setdefault(value, []).append(contact_id)
+        return found
+
+    def stats(self, group_id=None):
+        if group_id is not None:
+            return self._group_stats(group_id)
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(
+                'SELECT COUNT(*) FROM contacts WHERE deleted_at IS NULL')
+            total = cursor.fetchone()[0]
+
+            cursor.execute(
+                'SELECT COUNT(*) FROM contacts '
+                'WHERE is_favorite = 1 AND deleted_at IS NULL')
+            favorites = cursor.fetchone()[0]
+
+            with_method = (
+                'SELECT COUNT(DISTINCT cm.contact_id) FROM contact_methods cm '
+                'JOIN contacts c ON c.id = cm.contact_id '
+                f'WHERE cm.type_id = {TYPE_ID_SQL} AND c.deleted_at IS NULL')
+            cursor.execute(with_method, ('phone',))
+            with_phone = cursor.fetchone()[0]
+
+            cursor.execute(with_method, ('email',))
+            with_email = cursor.fetchone()[0]
+
+        return {
+            "total_contacts": total,
+            "favorite_contacts": favorites,
+            "contacts_with_phone": with_phone,
+            "contacts_with_email": with_email
+        }
+
+    def sections(self):
+        # contact_sections 由 contacts 表上的触发器维护（见 schema_migrations.py）
+        with self.database.read(self.fresh) as conn:
+            rows = conn.execute(
+                'SELECT initial, count FROM contact_sections '
+                'WHERE count > 0 ORDER BY initial'
+            ).fetchall()
+        return _with_offsets(rows)
+
+    def analytics(self, days, weeks, today=None):
+        # 汇总表由 contacts / contact_methods 上的触发器维护（见 schema_migrations.py），
+        # 每天、每种类型一行，不用扫描联系人
+        with self.database.read(self.fresh) as conn:
+            day_counts = {
+                day: (created, favorites)
+                for day, created, favorites in conn.execute(
+                    'SELECT day, created, favorites FROM contact_daily_counts '
+                    'WHERE created > 0')
+            }
+            type_counts = conn.execute(
+                'SELECT t.name, mc.methods, mc.contacts '
+                'FROM method_type_counts mc '
+                'JOIN method_types t ON t.id = mc.type_id '
+                'WHERE mc.methods > 0'
+            ).fetchall()
+        return _analytics(day_counts, type_counts, days, weeks, today)
+
+    def export_rows(self, query=None):
+        query = query or ContactQuery()
+        where, params = query.where_sql()
+        page, page_params = query.page_sql()
+        sql = f'''
+            SELECT
+                c.id,
+                c.name,
+                c.is_favorite,
+                GROUP_CONCAT(
+                    CASE
+                        WHEN t.name = 'phone' THEN cm.method_value
+                        ELSE NULL
+                    END
+                ) as phones,
+                GROUP_CONCAT(
+                    CASE
+                        WHEN t.name = 'email' THEN cm.method_value
+                        ELSE NULL
+                    END
+                ) as emails,
+                GROUP_CONCAT(
+                    CASE
+                        WHEN t.name NOT IN ('phone', 'email')
+                        THEN t.name || ': ' || cm.method_value
+                        ELSE NULL
+                    END
+                ) as other_methods
+            FROM contacts c
+            LEFT JOIN contact_methods cm ON c.id = cm.contact_id
+            LEFT JOIN method_types t ON t.id = cm.type_id
+            {where}
+            GROUP BY c.id
+            ORDER BY {query.order_sql('c.id')}
+            {page}
+        '''
+        with self.database.read(self.fresh) as conn:
+            rows = conn.execute(sql, params + page_params).fetchall()
+
+        return [{
+            'id': row[0],
+            'name': row[1],
+            'is_favorite': row[2],
+            'phones': row[3].replace(',', ';') if row[3] else '',
+            'emails': row[4].replace(',', ';') if row[4] else '',
+            'other_methods': row[5]
+        } for row in rows]
+
+    def import_contacts(self, records):
+        conn = self._connect()
+        cursor = conn.cursor()
+        success_count = 0
+        errors = []
+        type_ids = {}
+        try:
+            for index, record in enumerate(records):
+                try:
+                    cursor.execute(
+                        'INSERT INTO contacts '
+                        '(name, is_favorite, initial, sort_key) '
+                        'VALUES (?, ?, ?, ?)',
+                        (record['name'], int(bool(record['is_favorite'])))
+                        + collation_key(record['name'])
+                    )
+                    self._insert_methods(cursor, cursor.lastrowid,
+                                         record['methods'], type_ids)
+                    success_count += 1
+                except Exception as e:
+                    errors.append((index, str(e)))
+            self._commit(conn)
+        finally:
+            conn.close()
+        return success_count, errors
+
+    def contacts_after(self, contact_id):
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'SELECT {CONTACT_COLUMNS} FROM contacts c '
+                'WHERE c.id>? AND c.deleted_at IS NULL ORDER BY c.id',
+                (contact_id,)
+            )
+            contacts = cursor.fetchall()
+
+            cursor.execute(
+                f'{METHOD_ROWS_SQL} WHERE m.contact_id>? '
+                'ORDER BY m.contact_id, m.seq',
+                (contact_id,)
+            )
+            methods = cursor.fetchall()
+
+        return self._assemble(contacts, methods)
+
+    def change_version(self):
+        # 由 change_version 表上的触发器维护（见 schema_migrations.py）
+        with self.database.read(self.fresh) as conn:
+            return conn.execute(
+                'SELECT version FROM change_version WHERE id = 1'
+            ).fetchone()[0]
+
+    def list_groups(self):
+        # member_count 由 group_members 和 contacts 上的触发器维护
+        # （见 schema_migrations.py）
+        with self.database.read(self.fresh) as conn:
+            rows = conn.execute('''
+                SELECT id, name, member_count,
+                       datetime(created_time, 'unixepoch')
+                FROM contact_groups
+                ORDER BY name, id
+            ''').fetchall()
+        return [{
+            'id': group_id,
+            'name': name,
+            'member_count': member_count,
+            'created_time': created_time
+        } for group_id, name, member_count, created_time in rows]
+
+    def create_group(self, name):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT OR IGNORE INTO contact_groups (name) VALUES (?)',
+                (name,)
+            )
+            group_id = cursor.lastrowid if cursor.rowcount else None
+            self._commit(conn)
+            return group_id
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def delete_group(self, group_id):
+        # 成员关系由外键 ON DELETE CASCADE 一起删除
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM contact_groups WHERE id=?',
+                           (group_id,))
+            deleted = cursor.rowcount > 0
+            self._commit(conn)
+            return deleted
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def add_group_members(self, group_id, contact_ids):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM contact_groups WHERE id=?',
+                           (group_id,))
+            if not cursor.fetchone():
+                return None
+            cursor.executemany(
+                'INSERT OR IGNORE INTO group_members (group_id, contact_id) '
+                'SELECT ?, id FROM contacts WHERE id=? AND deleted_at IS NULL',
+                [(group_id, contact_id) for contact_id in contact_ids]
+            )
+            added = cursor.rowcount
+            self._commit(conn)
+            return added
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def remove_group_members(self, group_id, contact_ids):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM contact_groups WHERE id=?',
+                           (group_id,))
+            if not cursor.fetchone():
+                return None
+            cursor.executemany(
+                'DELETE FROM group_members WHERE group_id=? AND contact_id=?',
+                [(group_id, contact_id) for contact_id in contact_ids]
+            )
+            removed = cursor.rowcount
+            self._commit(conn)
+            return removed
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # ========== 辅助方法 ==========
+
+    def _group_stats(self, group_id):
+        """分组内的统计：人数读增量维护的 member_count，
+        其余各项从成员表主键的范围扫描出发，只碰这个分组的联系人
+        """
+        with self.database.read(self.fresh) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT member_count FROM contact_groups WHERE id=?',
+                (group_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+
+            members = (
+                'SELECT COUNT(*) FROM group_members g '
+                'JOIN contacts c ON c.id = g.contact_id '
+                'WHERE g.group_id = ? AND c.deleted_at IS NULL')
+            cursor.execute(members + ' AND c.is_favorite = 1', (group_id,))
+            favorites = cursor.fetchone()[0]
+
+            with_method = members + (
+                ' AND EXISTS (SELECT 1 FROM contact_methods m '
+                f'WHERE m.contact_id = c.id AND m.type_id = {TYPE_ID_SQL})')
+            cursor.execute(with_method, (group_id, 'phone'))
+            with_phone = cursor.fetchone()[0]
+
+            cursor.execute(with_method, (group_id, 'email'))
+            with_email = cursor.fetchone()[0]
+
+        return {
+            "total_contacts": row[0],
+            "favorite_contacts": favorites,
+            "contacts_with_phone": with_phone,
+            "contacts_with_email": with_email
+        }
+
+    def _connect(self):
+        """写连接；有 observer 时立即开始写事务"""
+        conn = self.database.connect()
+        observers = self._observers()
+        if observers:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for observer in observers:
+                    observer.begin(conn)
+            except Exception:
+                conn.close()
+                raise
+        return conn
+
+    def _commit(self, conn):
+        if conn.in_transaction:
+            for observer in self._observers():
+                observer.commit(conn)
+        conn.commit()
+
+    def _observers(self):
+        observers = list(self.database.write_observers)
+        if self.observer is not None:
+            observers.insert(0, self.observer)
+        return observers
+
+    def _insert_methods(self, cursor, contact_id, methods, type_ids=None):
+        """写入联系方式，seq 保留提交时的顺序
+
+        type_ids 是本事务内 类型名 -> id 的缓存（批量导入时复用）；
+        不跨事务缓存，恢复备份后类型id可能变化
+        """
+        type_ids = {} if type_ids is None else type_ids
+        rows = []
+        for seq, (method_type, method_value) in enumerate(
+                clean_methods(methods)):
+            if method_type not in type_ids:
+                cursor.execute(
+                    'INSERT OR IGNORE INTO method_types (name) VALUES (?)',
+                    (method_type,))
+                type_ids[method_type] = cursor.execute(
+                    'SELECT id FROM method_types WHERE name = ?',
+                    (method_type,)).fetchone()[0]
+            rows.append((contact_id, seq, type_ids[method_type],
+                         method_value))
+        cursor.executemany(
+            'INSERT INTO contact_methods '
+            '(contact_id, seq, type_id, method_value) VALUES (?, ?, ?, ?)',
+            rows
+        )
+
+    def _assemble(self, contacts, methods):
+        """把联系人行和联系方式行组装成联系人字典列表"""
+        methods_by_contact = {}
+        for contact_id, method_type, method_value in methods:
+            methods_by_contact.setdefault(contact_id, []).append({
+                'type': method_type,
+                'value': method_value
+            })
+
+        return [{
+            'id': contact_id,
+            'name': name,
+            'is_favorite': bool(is_favorite),
+            'created_time': created_time,
+            'methods': methods_by_contact.get(contact_id, [])
+        } for contact_id, name, is_favorite, created_time in contacts]
+
+
+# ========== 内存实现 ==========
+
+class ContactRecord:
+    """内存中的一条联系人记录"""
+
+    __slots__ = ('id', 'name', 'is_favorite', 'created_time', 'methods')
+
+    def __init__(self, contact_id, name, is_favorite, created_time, methods):
+        self.id = contact_id
+        self.name = name
+        self.is_favorite = is_favorite
+        self.created_time = created_time
+        self.methods = methods  # [(type, value), ...]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'is_favorite': self.is_favorite,
+            'created_time': self.created_time,
+            'methods': [{'type': t, 'value': v} for t, v in self.methods]
+        }
+
+
+class GroupRecord:
+    """内存中的一个分组，members 包括已软删除的成员（恢复后仍在分组里）"""
+
+    __slots__ = ('id', 'name', 'created_time', 'members')
+
+    def __init__(self, group_id, name, created_time):
+        self.id = group_id
+        self.name = name
+        self.created_time = created_time
+        self.members = set()
+
+
+class MemoryRepository(ContactRepository):
+    """纯内存实现
+
+    索引：
+    - _contacts: id -> ContactRecord
+    - _order: 列表顺序的有序键 (是否非收藏, -创建时间, id)
+    - _favorite_order: 收藏列表的有序键 (-创建时间, id)
+    - _by_method_value: 联系方式的值 -> 联系人id集合
+    - _groups: 分组id -> GroupRecord
+    有序视图在写入时用二分插入维护，读取时不需要排序。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._contacts = {}
+        self._order = []
+        self._favorite_order = []
+        self._by_method_value = {}
+        self._next_id = 1
+        self._version = 0
+        # 软删除的联系人：id -> (联系人字典, 删除时间)
+        self._deleted = {}
+        self._groups = {}
+        self._next_group_id = 1
+
+    def list_contacts(self, query=None):
+        with self._lock:
+            members = self._members(query)
+            contacts = [self._contacts[key[-1]].to_dict()
+                        for key in self._order
+                        if members is None or key[-1] in members]
+        return query.apply(contacts) if query else contacts
+
+    def get_contact(self, contact_id):
+        with self._lock:
+            record = self._contacts.get(contact_id)
+            return record.to_dict() if record else None
+
+    def add_contact(self, name, methods, is_favorite=False):
+        with self._lock:
+            contact_id = self._next_id
+            self.upsert({
+                'id': contact_id,
+                'name': name,
+                'is_favorite': bool(is_favorite),
+                'created_time': now_timestamp(),
+                'methods': methods
+            })
+            return contact_id
+
+    def update_contact(self, contact_id, name, methods):
+        with self._lock:
+            record = self._contacts.get(contact_id)
+            if record is None:
+                return False
+            if name:
+                record.name = name
+            self._set_methods(record, clean_methods(methods))
+            self._version += 1
+            return True
+
+    def delete_contact(self, contact_id):
+        with self._lock:
+            record = self._contacts.get(contact_id)
+            if record is None:
+                return False
+            self._deleted[contact_id] = (record.to_dict(), now_timestamp())
+            return self.remove(contact_id)
+
+    def restore_contact(self, contact_id):
+        with self._lock:
+            entry = self._deleted.pop(contact_id, None)
+            if entry is None:
+                return False
+            self.upsert(entry[0])
+            return True
+
+    def purge_deleted(self, deleted_before, limit=500):
+        with self._lock:
+            expired = [contact_id
+                       for contact_id, (_, deleted_at) in self._deleted.items()
+                       if deleted_at < deleted_before][:limit]
+            for contact_id in expired:
+                del self._deleted[contact_id]
+                for group in self._groups.values():
+                    group.members.discard(contact_id)
+            return len(expired)
+
+    def toggle_favorite(self, contact_id):
+        with self._lock:
+            record = self._contacts.get(contact_id)
+            if record is None:
+                return None
+            self._unlink_order(record)
+            record.is_favorite = not record.is_favorite
+            self._link_order(record)
+            self._version += 1
+            return record.name, record.is_favorite
+
+    def list_favorites(self):
+        with self._lock:
+            return [self._contacts[key[-1]].to_dict()
+                    for key in self._favorite_order]
+
+    def search(self, keyword):
+        keyword = keyword.lower()
+        with self._lock:
+            results = []
+            for key in self._order:
+                record = self._contacts[key[-1]]
+                if (keyword in record.name.lower()
+                        or any(keyword in v.lower()
+                               for _, v in record.methods)):
+                    results.append(record.to_dict())
+            return results
+
+    def find_by_method_value(self, value):
+        with self._lock:
+            return sorted(self._by_method_value.get(value, ()))
+
+    def find_by_method_values(self, values):
+        with self._lock:
+            return {value: sorted(self._by_method_value[value])
+                    for value in values if self._by_method_value.get(value)}
+
+    def stats(self, group_id=None):
+        with self._lock:
+            if group_id is None:
+                records = list(self._contacts.values())
+            else:
+                group = self._groups.get(group_id)
+                if group is None:
+                    return None
+                records = [self._contacts[i] for i in group.members
+                           if i in self._contacts]
+            favorites = 0
+            with_phone = 0
+            with_email = 0
+            for record in records:
+                types = {t for t, _ in record.methods}
+                favorites += record.is_favorite
+                with_phone += 'phone' in types
+                with_email += 'email' in types
+            return {
+                "total_contacts": len(records),
+                "favorite_contacts": favorites,
+                "contacts_with_phone": with_phone,
+                "contacts_with_email": with_email
+            }
+
+    def sections(self):
+        counts = {}
+        with self._lock:
+            for record in self._contacts.values():
+                initial = collation_key(record.name)[0]
+                counts[initial] = counts.get(initial, 0) + 1
+        return _with_offsets(sorted(counts.items()))
+
+    def analytics(self, days, weeks, today=None):
+        day_counts = {}
+        type_counts = {}
+        with self._lock:
+            for record in self._contacts.values():
+                day = to_epoch(record.created_time) // 86400
+                created, favorites = day_counts.get(day, (0, 0))
+                day_counts[day] = (created + 1,
+                                   favorites + bool(record.is_favorite))
+                types = [t for t, _ in record.methods]
+                for method_type in set(types):
+                    methods, contacts = type_counts.get(method_type, (0, 0))
+                    type_counts[method_type] = (
+                        methods + types.count(method_type), contacts + 1)
+        return _analytics(day_counts,
+                          [(t,) + counts for t, counts in type_counts.items()],
+                          days, weeks, today)
+
+    def export_rows(self, query=None):
+        with self._lock:
+            members = self._members(query)
+            contacts = [self._contacts[i].to_dict()
+                        for i in sorted(self._contacts)
+                        if members is None or i in members]
+        if query:
+            contacts = query.apply(contacts)
+        return [export_row(contact) for contact in contacts]
+
+    def import_contacts(self, records):
+        success_count = 0
+        errors = []
+        with self._lock:
+            for index, record in enumerate(records):
+                try:
+                    self.add_contact(record['name'], record['methods'],
+                                     record['is_favorite'])
+                    success_count += 1
+                except Exception as e:
+                    errors.append((index, str(e)))
+        return success_count, errors
+
+    def contacts_after(self, contact_id):
+        with self._lock:
+            return [self._contacts[i].to_dict()
+                    for i in sorted(self._contacts) if i > contact_id]
+
+    def change_version(self):
+        with self._lock:
+            return self._version
+
+    def local_version(self):
+        return self.change_version()
+
+    def list_groups(self):
+        with self._lock:
+            groups = sorted(self._groups.values(),
+                            key=lambda group: (group.name, group.id))
+            return [{
+                'id': group.id,
+                'name': group.name,
+                'member_count': sum(1 for i in group.members
+                                    if i in self._contacts),
+                'created_time': group.created_time
+            } for group in groups]
+
+    def create_group(self, name):
+        with self._lock:
+            if any(group.name == name for group in self._groups.values()):
+                return None
+            group_id = self._next_group_id
+            self._next_group_id += 1
+            self._groups[group_id] = GroupRecord(group_id, name,
+                                                 now_timestamp())
+            self._version += 1
+            return group_id
+
+    def delete_group(self, group_id):
+        with self._lock:
+            if self._groups.pop(group_id, None) is None:
+                return False
+            self._version += 1
+            return True
+
+    def add_group_members(self, group_id, contact_ids):
+        with self._lock:
+            group = self._groups.get(group_id)
+            if group is None:
+                return None
+            added = {i for i in contact_ids
+                     if i in self._contacts and i not in group.members}
+            group.members |= added
+            self._version += 1
+            return len(added)
+
+    def remove_group_members(self, group_id, contact_ids):
+        with self._lock:
+            group = self._groups.get(group_id)
+            if group is None:
+                return None
+            removed = group.members & set(contact_ids)
+            group.members -= removed
+            self._version += 1
+            return len(removed)
+
+    # ========== 按完整联系人维护索引（供常驻索引同步使用） ==========
+
+    def upsert(self, contact):
+        """按联系人字典插入或整体替换一条记录（保留原id和创建时间）"""
+        with self._lock:
+            contact_id = contact['id']
+            record = self._contacts.get(contact_id)
+            if record is None:
+                record = ContactRecord(contact_id, contact['name'],
+                                       bool(contact['is_favorite']),
+                                       contact['created_time'], [])
+                self._contacts[contact_id] = record
+            else:
+                self._unlink_order(record)
+                record.name = contact['name']
+                record.is_favorite = bool(contact['is_favorite'])
+                record.created_time = contact['created_time']
+            self._link_order(record)
+            self._set_methods(record, clean_methods(contact['methods']))
+            self._next_id = max(self._next_id, contact_id + 1)
+            self._version += 1
+
+    def remove(self, contact_id):
+        """删除一条记录，返回记录是否存在"""
+        with self._lock:
+            record = self._contacts.pop(contact_id, None)
+            if record is None:
+                return False
+            self._unlink_order(record)
+            self._set_methods(record, [])
+            self._version += 1
+            return True
+
+    def load(self, contacts):
+        """清空后整体装载，一次性排序建立有序视图"""
+        with self._lock:
+            self._contacts = {}
+            self._by_method_value = {}
+            self._next_id = 1
+            for contact in contacts:
+                record = ContactRecord(contact['id'], contact['name'],
+                                       bool(contact['is_favorite']),
+                                       contact['created_time'], [])
+                self._contacts[record.id] = record
+                self._set_methods(record, clean_methods(contact['methods']))
+                self._next_id = max(self._next_id, record.id + 1)
+            records = self._contacts.values()
+            self._order = sorted(self._order_key(r) for r in records)
+            self._favorite_order = sorted(
+                self._favorite_key(r) for r in records if r.is_favorite
+            )
+            self._version += 1
+
+    def max_id(self):
+        """已分配过的最大联系人id"""
+        with self._lock:
+            return self._next_id - 1
+
+    # ========== 辅助方法 ==========
+
+    def _members(self, query):
+        """query 按分组筛选时返回分组成员id集合，否则返回 None"""
+        if query is None or query.group_id is None:
+            return None
+        group = self._groups.get(query.group_id)
+        return group.members if group else set()
+
+    @staticmethod
+    def _order_key(record):
+        # 收藏优先，其次创建时间倒序；同一时间按id升序保持插入顺序
+        return (not record.is_favorite, -time_key(record.created_time),
+                record.id)
+
+    @staticmethod
+    def _favorite_key(record):
+        return (-time_key(record.created_time), record.id)
+
+    def _link_order(self, record):
+        insort(self._order, self._order_key(record))
+        if record.is_favorite:
+            insort(self._favorite_order, self._favorite_key(record))
+
+    def _unlink_order(self, record):
+        _remove_sorted(self._order, self._order_key(record))
+        if record.is_favorite:
+            _remove_sorted(self._favorite_order, self._favorite_key(record))
+
+    def _set_methods(self, record, methods):
+        """替换联系方式，同时维护值索引"""
+        for _, value in record.methods:
+            ids = self._by_method_value.get(value)
+            if ids is not None:
+                ids.discard(record.id)
+                if not ids:
+                    del self._by_method_value[value]
+        record.methods = list(methods)
+        for _, value in record.methods:
+            self._by_method_value.setdefault(value, set()).add(record.id)
+
+
+def _with_offsets(counts):
+    """[(分组字母, 人数), ...] -> [{'initial', 'count', 'offset'}, ...]"""
+    sections = []
+    offset = 0
+    for initial, count in counts:
+        sections.append({'initial': initial, 'count': count,
+                         'offset': offset})
+        offset += count
+    return sections
+
+
+def _analytics(day_counts, type_counts, days, weeks, today):
+    """按 analytics() 的格式组装报表
+
+    day_counts: {UTC天数: (新增人数, 其中收藏的人数)}，包含所有日期；
+    type_counts: [(类型, 条数, 人数), ...]
+    """
+    if today is None:
+        today = datetime.now(timezone.utc).date()
+    today_number = (today - EPOCH_DATE).days
+    total = sum(created for created, _ in day_counts.values())
+    favorites = sum(favorite for _, favorite in day_counts.values())
+
+    def bucket(start, length):
+        created = favorite = 0
+        for number in range(start, start + length):
+            counts = day_counts.get(number)
+            if counts:
+                created += counts[0]
+                favorite += counts[1]
+        return {'created': created, 'favorites': favorite}
+
+    daily = [
+        dict(date=(EPOCH_DATE + timedelta(days=number)).isoformat(),
+             **bucket(number, 1))
+        for number in range(today_number - days + 1, today_number + 1)
+    ]
+    this_week = today_number - today.weekday()
+    weekly = [
+        dict(week_start=(EPOCH_DATE + timedelta(days=start)).isoformat(),
+             **bucket(start, 7))
+        for start in range(this_week - 7 * (weeks - 1), this_week + 1, 7)
+    ]
+
+    return {
+        'total_contacts': total,
+        'favorite_contacts': favorites,
+        'favorite_share': round(favorites / total, 4) if total else 0.0,
+        'daily': daily,
+        'weekly': weekly,
+        'method_types': [
+            {'type': method_type, 'methods': methods, 'contacts': contacts,
+             'share': round(contacts / total, 4) if total else 0.0}
+            for method_type, methods, contacts in sorted(
+                type_counts, key=lambda row: (-row[2], row[0]))
+        ]
+    }
+
+
+def time_key(created_time):
+    """把 'YYYY-MM-DD HH:MM:SS' 转成可比较的整数 YYYYMMDDHHMMSS"""
+    digits = ''.join(ch for ch in str(created_time or '') if ch.isdigit())
+    return int(digits[:14] or 0)
+
+
+def _remove_sorted(keys, key):
+    position = bisect_left(keys, key)
+    if position < len(keys) and keys[position] == key:
+        del keys[position]
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+并发压测 - 通讯录系统
+在进程内直接驱动 Flask 应用（每个线程一个 test_client，不经过网络），
+多个线程、多个进程同时读写同一个 SQLite 文件，复现 "database is locked" 和延迟尖刺：
+
+- 读写比例由 --mix 按权重配置，写操作覆盖 add_contact、toggle_favorite、update、import_contacts
+- 按操作统计错误率、p50/p95/p99/最大延迟，错误按原因分类（锁冲突、过载拒绝、查询超时等）
+- 后台探测线程定时用 BEGIN IMMEDIATE 抢一次写锁，记录写锁的等待时间
+
+    python stress_test.py --threads 8 --duration 10
+    python stress_test.py --processes 4 --threads 4 \\
+        --mix list=5,add=3,favorite=2,import=1
+    python stress_test.py --workdir stress --json report.json \\
+        --max-error-rate 0.01
+
+默认在临时目录里建一个新的数据库并写入 --seed 个联系人；
+应用配置（CONTACTS_* 环境变量）照常生效，可以对比不同配置下的结果。
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+
+import pandas as pd
+
+DATABASE = 'contacts.db'
+DEFAULT_MIX = ('list=40,search=10,stats=10,favorites=5,'
+               'add=15,favorite=10,update=7,import=3')
+READ_OPERATIONS = ('list', 'search', 'stats', 'favorites')
+WRITE_OPERATIONS = ('add', 'favorite', 'update', 'import')
+# 多进程时各进程导入应用后一起开始，留出导入 main 的时间（秒）
+PROCESS_START_DELAY = 3.0
+# 写锁探测的间隔和等待上限（秒）
+PROBE_INTERVAL = 0.05
+PROBE_TIMEOUT = 30
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(text):
+    """'list=40,add=15,...' -> {'list': 40.0, 'add': 15.0, ...}"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in READ_OPERATIONS + WRITE_OPERATIONS:
+            operations = ', '.join(READ_OPERATIONS + WRITE_OPERATIONS)
+            raise ValueError(f"未知操作: {name}（可选 {operations}）")
+        mix[name] = float(weight or 1)
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError("至少要有一个权重大于0的操作")
+    return mix
+
+
+def percentile(sorted_values, pct):
+    """最近秩百分位数，列表为空时返回 None"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def classify(status, body):
+    """按响应把失败归类，成功返回 None"""
+    if status < 400:
+        return None
+    text = body.decode('utf-8', 'replace')
+    if 'locked' in text or 'busy' in text:
+        return 'locked'
+    if status == 429 or '服务繁忙' in text:
+        return 'rejected'
+    if '缩小查询范围' in text:
+        return 'query_timeout'
+    return 'client_error' if status < 500 else 'server_error'
+
+
+def build_workbook(rows, tag):
+    """导入操作上传的工作簿（xlsx 字节串）"""
+    df = pd.DataFrame({
+        'name': [f'导入{tag}_{i}' for i in range(rows)],
+        'phone': [f'137{random.randrange(10 ** 8):08d}' for _ in range(rows)],
+        'email': [f'stress{tag}_{i}@example.com' for i in range(rows)]
+    })
+    output = BytesIO()
+    df.to_excel(output, index=False)
+    return output.getvalue()
+
+
+def seed_database(path, count):
+    """建表并写入 count 个联系人"""
+    import schema_migrations
+    from db import Database
+    from storage import SQLiteRepository
+
+    schema_migrations.upgrade(path, log=lambda line: None)
+    records = [{
+        'name': f'压测{i}',
+        'is_favorite': i % 10 == 0,
+        'methods': [{'type': 'phone', 'value': f'139{i:08d}'},
+                    {'type': 'email', 'value': f'seed{i}@example.com'}]
+    } for i in range(count)]
+    SQLiteRepository(Database(path)).import_contacts(records)
+
+
+class LockProbe:
+    """每隔 interval 秒用 BEGIN IMMEDIATE 抢一次写锁（拿到后立即回滚），记录等待时间
+
+    WAL 模式下读不阻塞写，这里测到的就是写请求排队等其它写事务的时间
+    """
+
+    def __init__(self, path, interval=PROBE_INTERVAL, timeout=PROBE_TIMEOUT):
+        self.interval = interval
+        self.waits = []
+        self.failures = 0
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._conn.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            started = time.perf_counter()
+            try:
+                self._conn.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError:
+                self.failures += 1
+                continue
+            self.waits.append(time.perf_counter() - started)
+            self._conn.execute('ROLLBACK')
+
+
+class Worker:
+    """一个压测线程：按权重随机选操作，用自己的 test_client 发请求"""
+
+    def __init__(self, client, mix, id_range, workbook, rng):
+        self.client = client
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.id_range = id_range
+        self.workbook = workbook
+        self.rng = rng
+
+    def request(self, operation):
+        """执行一次操作，返回响应"""
+        client = self.client
+        contact_id = self.rng.randint(*self.id_range)
+        if operation == 'list':
+            return client.get('/contacts', query_string={
+                'limit': 50, 'offset': self.rng.randrange(self.id_range[1])})
+        if operation == 'search':
+            return client.get(f'/contacts/search/{self.rng.randrange(1000)}')
+        if operation == 'stats':
+            return client.get('/contacts/stats')
+        if operation == 'favorites':
+            return client.get('/contacts/favorites')
+        if operation == 'add':
+            return client.post('/contacts', json={
+                'name': f'新增{self.rng.randrange(10 ** 6)}',
+                'methods': [{'type': 'phone',
+                             'value': f'135{self.rng.randrange(10 ** 8):08d}'}]
+            })
+        if operation == 'favorite':
+            return client.put(f'/contacts/{contact_id}/favorite')
+        if operation == 'update':
+            return client.put(f'/contacts/{contact_id}', json={
+                'methods': [{'type': 'phone',
+                             'value': f'136{self.rng.randrange(10 ** 8):08d}'}]
+            })
+        return client.post('/contacts/import', data={
+            'file': (BytesIO(self.workbook), 'stress.xlsx')
+        }, content_type='multipart/form-data')
+
+    def run(self, deadline, result):
+        while time.monotonic() < deadline:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            started = time.perf_counter()
+            try:
+                response = self.request(operation)
+                error = classify(response.status_code, response.get_data())
+            except Exception:
+                error = 'exception'
+            elapsed = time.perf_counter() - started
+            record = result.setdefault(operation, {'latencies': [],
+                                                   'errors': {}})
+            record['latencies'].append(elapsed)
+            if error:
+                record['errors'][error] = record['errors'].get(error, 0) + 1
+
+
+def run_worker(config, index):
+    """在当前进程里启动 config['threads'] 个压测线程，返回 {操作: {'latencies', 'errors'}}
+
+    多进程时在子进程里执行：先切换到数据目录再导入应用，应用按当前目录找数据库
+    """
+    os.chdir(config['workdir'])
+    import main
+
+    main.prepare_storage()
+    workbook = build_workbook(config['import_rows'], index)
+    delay = config['start_at'] - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+    deadline = time.monotonic() + config['duration']
+    results = []
+    threads = []
+    for thread_index in range(config['threads']):
+        result = {}
+        results.append(result)
+        worker = Worker(main.app.test_client(), config['mix'],
+                        (1, max(config['seed'], 1)), workbook,
+                        random.Random(f"{index}-{thread_index}"))
+        threads.append(threading.Thread(target=worker.run,
+                                        args=(deadline, result)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return merge(results)
+
+
+def merge(results):
+    merged = {}
+    for result in results:
+        for operation, record in result.items():
+            target = merged.setdefault(operation, {'latencies': [],
+                                                   'errors': {}})
+            target['latencies'].extend(record['latencies'])
+            for error, count in record['errors'].items():
+                errors = target['errors']
+                errors[error] = errors.get(error, 0) + count
+    return merged
+
+
+def summarize(merged, probe, config):
+    """汇总成报告字典（延迟单位为毫秒）"""
+    def latency_stats(values):
+        values = sorted(values)
+        stats = {f'p{pct}': _ms(percentile(values, pct))
+                 for pct in PERCENTILES}
+        stats['max'] = _ms(values[-1] if values else None)
+        return stats
+
+    operations = {}
+    all_latencies = []
+    errors = {}
+    for operation in sorted(merged, key=list(config['mix']).index):
+        record = merged[operation]
+        failed = sum(record['errors'].values())
+        operations[operation] = dict(
+            requests=len(record['latencies']),
+            error_rate=failed / len(record['latencies']),
+            errors=record['errors'],
+            **latency_stats(record['latencies']))
+        all_latencies.extend(record['latencies'])
+        for error, count in record['errors'].items():
+            errors[error] = errors.get(error, 0) + count
+
+    total = len(all_latencies)
+    reads = sum(operations[name]['requests'] for name in operations
+                if name in READ_OPERATIONS)
+    return {
+        'config': {key: config[key] for key in
+                   ('processes', 'threads', 'duration', 'seed', 'mix',
+                    'import_rows')},
+        'total': dict(
+            requests=total,
+            throughput=total / config['duration'],
+            read_ratio=reads / total if total else None,
+            error_rate=sum(errors.values()) / total if total else 0.0,
+            errors=errors,
+            **latency_stats(all_latencies)),
+        'operations': operations,
+        'lock_wait': dict(probes=len(probe.waits), failures=probe.failures,
+                          **latency_stats(probe.waits))
+    }
+
+
+def print_report(report):
+    config = report['config']
+    total = report['total']
+    print("\n" + "=" * 78)
+    print(f"📊 压测结果（{config['processes']} 进程 × {config['threads']} 线程，"
+          f"{config['duration']:g} 秒，读请求占 {_percent(total['read_ratio'])}）")
+    print(f"  {'操作':<10}{'请求数':>8}{'错误率':>9}"
+          f"{'p50':>9}{'p95':>9}{'p99':>9}{'最大':>9}  (毫秒)")
+    rows = list(report['operations'].items()) + [('合计', total)]
+    for name, stats in rows:
+        print(f"  {name:<10}{stats['requests']:>10,}"
+              f"{_percent(stats['error_rate']):>10}"
+              + ''.join(f"{_format_ms(stats[key]):>10}"
+                        for key in ('p50', 'p95', 'p99', 'max')))
+    print(f"🚀 吞吐: {total['throughput']:,.1f} 请求/秒")
+
+    if total['errors']:
+        print("❗ 错误分类: " + "，".join(
+            f"{error} {count}" for error, count in
+            sorted(total['errors'].items(), key=lambda item: -item[1])))
+    lock = report['lock_wait']
+    print(f"🔒 写锁等待（探测 {lock['probes']} 次）: "
+          + "，".join(f"{key} {_format_ms(lock[key])}ms"
+                      for key in ('p50', 'p95', 'p99', 'max'))
+          + (f"，{lock['failures']} 次超时" if lock['failures'] else ""))
+    print("=" * 78)
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _format_ms(value):
+    return '-' if value is None else f"{value:.1f}"
+
+
+def _percent(value):
+    return '-' if value is None else f"{value * 100:.1f}%"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='通讯录系统进程内并发压测')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='每个进程的压测线程数')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='进程数（大于1时各进程独立导入应用，共享同一个数据库文件）')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='压测时长（秒）')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='操作权重，可选 ' + ', '.join(
+                            READ_OPERATIONS + WRITE_OPERATIONS))
+    parser.add_argument('--seed', type=int, default=5000,
+                        help='新建数据库时预先写入的联系人数')
+    parser.add_argument('--import-rows', type=int, default=200,
+                        help='每次导入操作上传的行数')
+    parser.add_argument('--workdir',
+                        help='数据目录（默认用临时目录，结束后删除）')
+    parser.add_argument('--json', help='把报告另存为JSON文件')
+    parser.add_argument('--max-error-rate', type=float,
+                        help='总错误率超过这个值时以状态码1退出')
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # 压测时会切换到数据目录，输出路径先转成绝对路径
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = os.path.abspath(args.workdir or
+                              tempfile.mkdtemp(prefix='contacts_stress_'))
+    os.makedirs(workdir, exist_ok=True)
+    path = os.path.join(workdir, DATABASE)
+    try:
+        if not os.path.exists(path):
+            print(f"🌱 写入 {args.seed:,} 个联系人: {path}")
+            seed_database(path, args.seed)
+
+        config = {
+            'workdir': workdir,
+            'processes': args.processes,
+            'threads': args.threads,
+            'duration': args.duration,
+            'seed': args.seed,
+            'mix': mix,
+            'import_rows': args.import_rows,
+            'start_at': time.time() + (PROCESS_START_DELAY
+                                       if args.processes > 1 else 0)
+        }
+        print(f"⏱️  {args.processes} 进程 × {args.threads} 线程，"
+              f"压测 {args.duration:g} 秒...")
+        probe = LockProbe(path)
+        probe.start()
+        try:
+            if args.processes > 1:
+                # spawn：子进程重新导入应用，不继承父进程的线程和连接
+                with ProcessPoolExecutor(
+                        max_workers=args.processes,
+                        mp_context=get_context('spawn')) as pool:
+                    futures = [pool.submit(run_worker, config, index)
+                               for index in range(args.processes)]
+                    merged = merge([future.result() for future in futures])
+            else:
+                merged = run_worker(config, 0)
+        finally:
+            probe.stop()
+
+        report = summarize(merged, probe, config)
+        print_report(report)
+        if json_path:
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"💾 报告已保存: {json_path}")
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if (args.max_error_rate is not None
+            and report['total']['error_rate'] > args.max_error_rate):
+        print(f"❌ 错误率 {_percent(report['total']['error_rate'])} "
+              f"超过上限 {_percent(args.max_error_rate)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+输入联想索引 - 通讯录系统
+为 GET /contacts/suggest 提供按姓名、拼音、电话号码的前缀/子串匹配
+"""
+
+import threading
+from bisect import bisect_left, insort
+
+from pinyin_keys import normalize_phone, pinyin_full, pinyin_initials
+
+# 参与子串匹配的后缀最短长度
+MIN_INFIX_LENGTH = 1
+
+
+class SuggestIndex:
+    """联想索引
+
+    - 前缀键：姓名、姓名全拼、拼音首字母、电话号码的数字
+    - 子串键：姓名和电话号码的所有后缀，前缀命中某个后缀即子串命中
+    两类键都是 (键, 联系人id) 的有序数组，一次查询就是二分查找加顺序扫描。
+    前缀命中排在子串命中之前。
+
+    loader 返回全部联系人，用于首次建立和发现外部写入后重建；
+    watcher 为 db.ChangeWatcher，version_source 返回主库的 change_version，
+    memory 后端没有外部写入，两者都可以不传。
+
+    有 watcher 时索引要登记到 Database.write_observers：和
+    contact_index.WriteTracker 一样，本进程的写事务拿到写锁后（begin）和
+    提交前（commit）各读一次 change_version，记下索引对应的版本。
+    watcher 发现 data_version 变化时只比较版本，自己的写入（包括不影响
+    联想键的收藏、分组写入）不会触发重建；别人的写入不管落在本进程写入的
+    前后，都会让版本对不上而整体重建。
+    """
+
+    def __init__(self, loader, watcher=None, version_source=None):
+        self.loader = loader
+        self.watcher = watcher
+        self.version_source = version_source
+        self._lock = threading.RLock()
+        # 版本只在这个锁里读写，写事务的回调不等重建索引用的 _lock
+        self._version_lock = threading.Lock()
+        # 索引对应的 change_version，None 表示需要整体重建
+        self._version = None
+        # begin 发现别人写过的次数，重建期间变化时重建的结果不可信
+        self._conflicts = 0
+        self._loaded = False
+        self._prefix_keys = []
+        self._infix_keys = []
+        self._entries = {}  # id -> (姓名, 前缀键, 子串键)
+        self._max_id = 0
+
+    def suggest(self, query, limit=10):
+        """返回最多 limit 个 {'id', 'name'}"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+
+        with self._lock:
+            self._ensure_current()
+            found = []
+            seen = set()
+            for keys in (self._prefix_keys, self._infix_keys):
+                for term in terms:
+                    for contact_id in _scan(keys, term):
+                        if contact_id in seen:
+                            continue
+                        seen.add(contact_id)
+                        found.append({
+                            'id': contact_id,
+                            'name': self._entries[contact_id][0]
+                        })
+                        if len(found) >= limit:
+                            return found
+            return found
+
+    def apply_change(self, kind, contact_id, repository):
+        """按一次写操作原地更新索引
+
+        kind: upsert / delete / import；repository 需读到刚提交的数据
+        """
+        with self._lock:
+            if not self._loaded or not self._tracking():
+                return  # 还没建立过或需要重建，下一次查询时整体建立
+
+            try:
+                if kind == 'delete':
+                    self._remove(contact_id)
+                elif kind == 'import':
+                    for contact in repository.contacts_after(self._max_id):
+                        self._upsert(contact)
+                else:
+                    contact = repository.get_contact(contact_id)
+                    if contact is None:
+                        self._remove(contact_id)
+                    else:
+                        self._upsert(contact)
+            except Exception:
+                self._loaded = False
+                raise
+
+    def begin(self, conn):
+        """本进程的写事务拿到写锁后调用：版本对不上说明之前有别人写过"""
+        version = _change_version(conn)
+        with self._version_lock:
+            if version != self._version:
+                self._version = None
+                self._conflicts += 1
+
+    def commit(self, conn):
+        """写事务提交前调用：此时读到的版本就是提交后的版本"""
+        version = _change_version(conn)
+        with self._version_lock:
+            if self._version is not None:
+                self._version = version
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+
+    # ========== 辅助方法 ==========
+
+    def _tracking(self):
+        """索引是否还对应一个已知的版本（memory 后端不需要版本）"""
+        if self.watcher is None:
+            return True
+        with self._version_lock:
+            return self._version is not None
+
+    def _changed(self):
+        """上次同步之后是否有别人写过"""
+        if self.watcher is None:
+            return False
+        with self._version_lock:
+            version = self._version
+        if version is None:
+            return True
+        if not self.watcher.changed():
+            return False
+        # 先记下 data_version 再读版本，之后的写入下次检查一定能发现
+        self.watcher.acknowledge()
+        return self.version_source() != version
+
+    def _ensure_current(self):
+        if self._loaded and not self._changed():
+            return
+
+        if self.watcher:
+            self.watcher.acknowledge()
+            # 先读版本再读数据，数据不会比版本旧；重建期间本进程的写入照常
+            # 推进版本，它们的 apply_change 等重建完成后再执行
+            version = self.version_source()
+            with self._version_lock:
+                self._version = version
+                conflicts = self._conflicts
+        # 加载失败时不能留着旧数据配新版本
+        self._loaded = False
+        contacts = self.loader()
+
+        self._entries = {}
+        self._max_id = 0
+        prefix_keys = []
+        infix_keys = []
+        for contact in contacts:
+            name, prefixes, infixes = contact_keys(contact)
+            self._entries[contact['id']] = (name, prefixes, infixes)
+            self._max_id = max(self._max_id, contact['id'])
+            prefix_keys.extend((key, contact['id']) for key in prefixes)
+            infix_keys.extend((key, contact['id']) for key in infixes)
+        prefix_keys.sort()
+        infix_keys.sort()
+        self._prefix_keys = prefix_keys
+        self._infix_keys = infix_keys
+        self._loaded = True
+        if self.watcher:
+            with self._version_lock:
+                # 重建期间发现过别人的写入，读到的数据可能漏了，下次查询再重建
+                if self._conflicts != conflicts:
+                    self._version = None
+
+    def _upsert(self, contact):
+        self._remove(contact['id'])
+        name, prefixes, infixes = contact_keys(contact)
+        self._entries[contact['id']] = (name, prefixes, infixes)
+        self._max_id = max(self._max_id, contact['id'])
+        for key in prefixes:
+            insort(self._prefix_keys, (key, contact['id']))
+        for key in infixes:
+            insort(self._infix_keys, (key, contact['id']))
+
+    def _remove(self, contact_id):
+        entry = self._entries.pop(contact_id, None)
+        if entry is None:
+            return
+        _, prefixes, infixes = entry
+        for key in prefixes:
+            _remove_sorted(self._prefix_keys, (key, contact_id))
+        for key in infixes:
+            _remove_sorted(self._infix_keys, (key, contact_id))
+
+
+def _change_version(conn):
+    return conn.execute(
+        'SELECT version FROM change_version WHERE id = 1').fetchone()[0]
+
+
+def contact_keys(contact):
+    """联系人的 (显示名, 前缀键集合, 子串键集合)"""
+    name = contact['name']
+    folded = name.replace(' ', '').lower()
+    prefixes = {folded, pinyin_full(name), pinyin_initials(name)}
+    infixes = _suffixes(folded)
+
+    for method in contact['methods']:
+        if method['type'] != 'phone':
+            continue
+        digits = normalize_phone(method['value'])
+        if digits:
+            prefixes.add(digits)
+            infixes |= _suffixes(digits)
+
+    prefixes.discard('')
+    return name, prefixes, infixes - prefixes
+
+
+def query_terms(query):
+    """查询词：折叠后的原文，以及看起来像号码时的数字形式"""
+    folded = (query or '').replace(' ', '').lower()
+    if not folded:
+        return []
+    terms = [folded]
+    digits = normalize_phone(folded)
+    if digits and digits != folded and len(digits) * 2 >= len(folded):
+        terms.append(digits)
+    return terms
+
+
+def _suffixes(text):
+    return {text[i:] for i in range(1, len(text) - MIN_INFIX_LENGTH + 1)}
+
+
+def _scan(keys, term):
+    """按键顺序返回以 term 开头的键对应的联系人id"""
+    position = bisect_left(keys, (term,))
+    while position < len(keys):
+        key, contact_id = keys[position]
+        if not key.startswith(term):
+            break
+        yield contact_id
+        position += 1
+
+
+def _remove_sorted(keys, key):
+    position = bisect_left(keys, key)
+    if position < len(keys) and keys[position] == key:
+        del keys[position]
@@ -15,6 +15,8 @@ import sys
 # API基础地址 - 根据实际情况修改
 BASE_URL = "http://localhost:5000"  # 本地测试
 # BASE_URL = "https://你的项目名.railway.app"  # Railway部署
+# 管理接口（备份、复制）的令牌，与服务端的 CONTACTS_ADMIN_TOKEN 相同
+ADMIN_HEADERS = {"X-Admin-Token": os.environ.get("CONTACTS_ADMIN_TOKEN", "")}
 
 def print_section(title):
     """打印章节标题"""
@@ -376,6 +378,479 @@ def test_delete_contact():
         print(f"❌ 删除联系人测试失败: {e}")
         return False
 
+def test_suggest_contacts():
+    """测试输入联想"""
+    print_section("11. 输入联想测试")
+
+    try:
+        # 拼音首字母、姓名、号码片段
+        for keyword in ["csyh", "测试", "138"]:
+            response = requests.get(f"{BASE_URL}/contacts/suggest",
+                                    params={"q": keyword, "limit": 5})
+            print(f"✅ 联想 '{keyword}': 状态码 {response.status_code}")
+
+            if response.status_code != 200:
+                return False
+
+            for item in response.json():
+                print(f"    - {item.get('name')} (ID: {item.get('id')})")
+
+        return True
+
+    except Exception as e:
+        print(f"❌ 输入联想测试失败: {e}")
+        return False
+
+def test_backup():
+    """测试在线备份"""
+    print_section("12. 在线备份测试")
+
+    try:
+        # 连续备份两次，同一秒内的两份快照不能互相覆盖
+        names = []
+        for _ in range(2):
+            response = requests.post(f"{BASE_URL}/admin/backups",
+                                     headers=ADMIN_HEADERS)
+            print(f"✅ 开始备份: 状态码 {response.status_code}")
+            if response.status_code not in (202, 409):
+                return False
+
+            # 等待后台备份完成
+            for _ in range(50):
+                status = requests.get(f"{BASE_URL}/admin/backups",
+                                      headers=ADMIN_HEADERS).json()
+                if status.get("state") != "running":
+                    break
+                time.sleep(0.2)
+            names.append(status.get("last_snapshot"))
+
+        snapshots = [s['name'] for s in status.get('snapshots', [])]
+        print(f"✅ 备份状态: {status.get('state')}, 最新快照: {names}")
+        print(f"📊 快照数: {len(snapshots)}")
+        return (status.get("state") == "idle" and names[0] != names[1]
+                and all(name in snapshots for name in names))
+
+    except Exception as e:
+        print(f"❌ 在线备份测试失败: {e}")
+        return False
+
+def test_contact_events():
+    """测试变更事件推送（SSE）"""
+    print_section("13. 变更事件推送测试")
+
+    try:
+        stream = requests.get(f"{BASE_URL}/contacts/events", stream=True,
+                              timeout=10)
+        print(f"✅ 订阅事件: 状态码 {stream.status_code}")
+        if stream.status_code != 200:
+            return False
+
+        # 订阅后新增一个联系人，应收到 upsert 事件
+        response = requests.post(f"{BASE_URL}/contacts", json={
+            "name": "事件测试用户",
+            "methods": [{"type": "phone", "value": "13900009999"}]
+        })
+        contact_id = response.json().get("id")
+
+        received = None
+        for line in stream.iter_lines(decode_unicode=True):
+            if line.startswith("data:") and f'"id":{contact_id}' in line:
+                received = line
+                break
+        stream.close()
+        requests.delete(f"{BASE_URL}/contacts/{contact_id}")
+
+        print(f"✅ 收到事件: {received}")
+        return received is not None
+
+    except Exception as e:
+        print(f"❌ 变更事件推送测试失败: {e}")
+        return False
+
+def test_restore_contact():
+    """测试恢复删除的联系人"""
+    print_section("14. 恢复联系人测试")
+
+    try:
+        response = requests.post(f"{BASE_URL}/contacts", json={
+            "name": "恢复测试用户",
+            "methods": [{"type": "phone", "value": "13900008888"}]
+        })
+        contact_id = response.json().get("id")
+
+        response = requests.delete(f"{BASE_URL}/contacts/{contact_id}")
+        print(f"✅ 删除: 状态码 {response.status_code}")
+
+        response = requests.post(f"{BASE_URL}/contacts/{contact_id}/restore")
+        print(f"✅ 恢复: 状态码 {response.status_code}")
+        print(f"✅ 响应内容: {response.json()}")
+        if response.status_code != 200:
+            return False
+
+        # 恢复后联系人和联系方式都回到列表中
+        contacts = requests.get(f"{BASE_URL}/contacts").json()
+        restored = next((c for c in contacts if c['id'] == contact_id), None)
+        requests.delete(f"{BASE_URL}/contacts/{contact_id}")
+
+        print(f"✅ 恢复后的联系人: {restored}")
+        return restored is not None and len(restored['methods']) == 1
+
+    except Exception as e:
+        print(f"❌ 恢复联系人测试失败: {e}")
+        return False
+
+def test_contact_sections():
+    """测试A-Z分组索引"""
+    print_section("15. 字母分组测试")
+
+    try:
+        response = requests.get(f"{BASE_URL}/contacts/sections")
+        print(f"✅ 状态码: {response.status_code}")
+        if response.status_code != 200:
+            return False
+
+        result = response.json()
+        for section in result['sections']:
+            print(f"    {section['initial']}: {section['count']} 人 "
+                  f"(offset {section['offset']})")
+        if not result['sections']:
+            return True
+
+        # 按分组的偏移量取一页，第一个联系人应属于该分组
+        section = result['sections'][-1]
+        response = requests.get(f"{BASE_URL}/contacts", params={
+            "sort": "pinyin",
+            "offset": section['offset'],
+            "limit": section['count']
+        })
+        page = response.json()
+        print(f"✅ 分组 {section['initial']} 的联系人: {[c['name'] for c in page]}")
+
+        response = requests.get(f"{BASE_URL}/contacts", params={
+            "initial": section['initial']
+        })
+        return len(page) == section['count'] == len(response.json())
+
+    except Exception as e:
+        print(f"❌ 字母分组测试失败: {e}")
+        return False
+
+def test_replication_log():
+    """测试变更日志（跟随节点复制用）"""
+    print_section("16. 变更日志测试")
+
+    try:
+        response = requests.post(f"{BASE_URL}/contacts", json={
+            "name": "复制测试",
+            "methods": [{"type": "phone", "value": "13600136000"}]
+        })
+        seq = int(response.headers.get('X-Replication-Seq', 0))
+        print(f"✅ 写入后的日志位置: {seq}")
+
+        params = {"from": max(seq - 5, 0), "limit": 10}
+        # 不带管理令牌的请求一律拒绝
+        denied = requests.get(f"{BASE_URL}/replication/log", params=params)
+        print(f"✅ 不带令牌: 状态码 {denied.status_code}")
+        if denied.status_code != 403:
+            return False
+
+        response = requests.get(f"{BASE_URL}/replication/log", params=params,
+                                headers=ADMIN_HEADERS)
+        print(f"✅ 状态码: {response.status_code}")
+        if response.status_code != 200:
+            return False
+
+        log = response.json()
+        for entry in log['entries']:
+            print(f"    #{entry['seq']} {entry['entity']} {entry['op']} "
+                  f"{entry['data']}")
+        print(f"📊 最新位置 {log['last_seq']}，最早保留 {log['oldest_seq']}")
+        return log['last_seq'] >= seq and any(
+            entry['entity'] == 'contact'
+            and entry['data'].get('name') == "复制测试"
+            for entry in log['entries'])
+
+    except Exception as e:
+        print(f"❌ 变更日志测试失败: {e}")
+        return False
+
+def test_groups():
+    """测试联系人分组"""
+    print_section("17. 分组测试")
+
+    try:
+        response = requests.post(f"{BASE_URL}/groups",
+                                 json={"name": f"测试分组{int(time.time())}"})
+        print(f"✅ 创建分组状态码: {response.status_code}")
+        if response.status_code != 201:
+            return False
+        group_id = response.json()['id']
+
+        contacts = requests.get(f"{BASE_URL}/contacts").json()
+        contact_ids = [c['id'] for c in contacts[:3]]
+        response = requests.post(f"{BASE_URL}/groups/{group_id}/members",
+                                 json={"contact_ids": contact_ids + [999999]})
+        result = response.json()
+        print(f"✅ 加入分组: {result['added']} 个，跳过 {result['skipped']} 个")
+
+        params = {"group": group_id}
+        members = requests.get(f"{BASE_URL}/contacts", params=params).json()
+        stats = requests.get(f"{BASE_URL}/contacts/stats",
+                             params=params).json()
+        groups = {g['id']: g
+                  for g in requests.get(f"{BASE_URL}/groups").json()}
+        print(f"📊 分组成员 {len(members)} 个，统计人数 {stats['total_contacts']}，"
+              f"分组人数 {groups[group_id]['member_count']}")
+
+        response = requests.delete(f"{BASE_URL}/groups/{group_id}/members",
+                                   json={"contact_ids": contact_ids[:1]})
+        print(f"✅ 移出分组: {response.json()['removed']} 个")
+        count = requests.get(f"{BASE_URL}/contacts/stats",
+                             params=params).json()['total_contacts']
+
+        response = requests.delete(f"{BASE_URL}/groups/{group_id}")
+        print(f"✅ 删除分组状态码: {response.status_code}")
+        return (result['added'] == len(contact_ids)
+                and sorted(c['id'] for c in members) == sorted(contact_ids)
+                and stats['total_contacts'] == len(contact_ids)
+                and groups[group_id]['member_count'] == len(contact_ids)
+                and count == len(contact_ids) - 1
+                and response.status_code == 200)
+
+    except Exception as e:
+        print(f"❌ 分组测试失败: {e}")
+        return False
+
+def test_import_dry_run():
+    """测试导入预检"""
+    print_section("18. 导入预检测试")
+
+    try:
+        stamp = int(time.time()) % 10 ** 8
+        existing_phone = f"150{stamp:08d}"
+        new_phone = f"151{stamp:08d}"
+        requests.post(f"{BASE_URL}/contacts", json={
+            "name": "预检已有用户",
+            "methods": [{"type": "phone", "value": existing_phone}]
+        })
+
+        test_data = pd.DataFrame({
+            'name': ['预检用户1', '预检用户2', '预检用户3', '预检用户4', '预检用户5'],
+            'phones': [new_phone, 'abc123', '', existing_phone, new_phone],
+            'emails': ['dry1@example.com', '', 'not-an-email', '', '']
+        })
+        excel_file = "test_dry_run.xlsx"
+        test_data.to_excel(excel_file, index=False)
+
+        stats_url = f"{BASE_URL}/contacts/stats"
+        total_before = requests.get(stats_url).json()['total_contacts']
+        mimetype = ('application/vnd.openxmlformats-officedocument'
+                    '.spreadsheetml.sheet')
+        with open(excel_file, 'rb') as f:
+            files = {'file': (excel_file, f, mimetype)}
+            response = requests.post(f"{BASE_URL}/contacts/import",
+                                     params={"dry_run": 1}, files=files,
+                                     timeout=30)
+        os.remove(excel_file)
+
+        print(f"✅ 状态码: {response.status_code}")
+        result = response.json()
+        print(f"✅ 预检结果: {result.get('message')}")
+        for issue in result.get('issues', []):
+            print(f"   第{issue['row']}行 {issue['field']}={issue['value']}: "
+                  f"{issue['kind']} {issue['error']}")
+        total_after = requests.get(stats_url).json()['total_contacts']
+        print(f"📊 预检前后联系人总数: {total_before} -> {total_after}")
+
+        reports_url = f"{BASE_URL}/contacts/import/reports"
+        report_url = f"{reports_url}/{result['report_id']}"
+        page = requests.get(report_url,
+                            params={"offset": 1, "limit": 2}).json()
+        download = requests.get(report_url, params={"format": "csv"})
+        print(f"✅ 第二页问题 {len(page['issues'])} 条，"
+              f"下载报告 {len(download.content)} 字节")
+        missing = requests.get(f"{reports_url}/{'0' * 32}")
+
+        return (response.status_code == 200
+                and result['rows'] == 5 and result['importable'] == 3
+                and result['invalid'] == 2 and result['duplicates'] == 2
+                and result['clean'] == 1 and result['issue_count'] == 4
+                and total_before == total_after
+                and page['issues'] == result['issues'][1:3]
+                and download.status_code == 200
+                and download.text.count('\n') == 5
+                and missing.status_code == 404)
+
+    except Exception as e:
+        print(f"❌ 导入预检测试失败: {e}")
+        return False
+
+def test_analytics():
+    """测试统计报表"""
+    print_section("19. 统计报表测试")
+
+    try:
+        response = requests.get(f"{BASE_URL}/contacts/analytics",
+                                params={"days": 7, "weeks": 4})
+        print(f"✅ 状态码: {response.status_code}")
+        report = response.json()
+        etag = response.headers.get('ETag')
+        stats = requests.get(f"{BASE_URL}/contacts/stats").json()
+        print(f"📊 总人数 {report['total_contacts']}，"
+              f"收藏占比 {report['favorite_share']}，"
+              f"今天新增 {report['daily'][-1]['created']}，"
+              f"本周新增 {report['weekly'][-1]['created']}")
+        for item in report['method_types']:
+            print(f"   {item['type']}: {item['methods']} 条，"
+                  f"{item['contacts']} 人")
+
+        cached = requests.get(f"{BASE_URL}/contacts/analytics",
+                              params={"days": 7, "weeks": 4},
+                              headers={"If-None-Match": etag})
+        print(f"✅ 带 ETag 再次请求状态码: {cached.status_code}")
+
+        requests.post(f"{BASE_URL}/contacts", json={
+            "name": "报表新增用户",
+            "methods": [{"type": "phone", "value": "13600136000"}]
+        })
+        response = requests.get(f"{BASE_URL}/contacts/analytics",
+                                params={"days": 7, "weeks": 4},
+                                headers={"If-None-Match": etag})
+        updated = response.json()
+        print(f"✅ 新增联系人后状态码: {response.status_code}，"
+              f"今天新增 {updated['daily'][-1]['created']}")
+        phones = {item['type']: item['contacts']
+                  for item in report['method_types']}.get('phone', 0)
+        updated_phones = {item['type']: item['contacts']
+                          for item in updated['method_types']}['phone']
+
+        return (report['total_contacts'] == stats['total_contacts']
+                and report['favorite_contacts'] == stats['favorite_contacts']
+                and len(report['daily']) == 7 and len(report['weekly']) == 4
+                and cached.status_code == 304
+                and response.status_code == 200
+                and response.headers.get('ETag') != etag
+                and (updated['daily'][-1]['created']
+                     == report['daily'][-1]['created'] + 1)
+                and updated_phones == phones + 1)
+
+    except Exception as e:
+        print(f"❌ 统计报表测试失败: {e}")
+        return False
+
+def test_restore_resync():
+    """测试从快照恢复后跟随节点重新同步（在本地临时目录里直接调用备份和复制模块）"""
+    print_section("20. 恢复后重新同步测试")
+
+    try:
+        import sqlite3
+        import tempfile
+        import backup
+        import replication
+        import schema_migrations
+        from db import Database
+        from storage import SQLiteRepository
+
+        with tempfile.TemporaryDirectory() as directory:
+            primary_path = os.path.join(directory, 'primary.db')
+            follower_path = os.path.join(directory, 'follower.db')
+            snapshot_path = os.path.join(directory, 'snapshot.db')
+            for path in (primary_path, follower_path):
+                schema_migrations.upgrade(path, log=lambda line: None)
+            database = Database(primary_path)
+            primary = SQLiteRepository(database)
+
+            def pull():
+                """跟随节点拉取一次日志（与 /replication/log 和 Follower.poll_once 相同）"""
+                source = sqlite3.connect(primary_path)
+                target = replication.connect(follower_path)
+                try:
+                    current, _ = replication.applied_seq(target)
+                    log = replication.read_log(source, current or 0, 500)
+                    return replication.apply_entries(target, log['entries'])
+                finally:
+                    target.close()
+                    source.close()
+
+            first = primary.add_contact("恢复前", [])
+            pull()
+            backup.snapshot(primary_path, snapshot_path)
+            second = primary.add_contact("快照之后", [])
+            applied = pull()
+            print(f"✅ 恢复前跟随节点已应用到 {applied}")
+
+            backup.restore(primary_path, snapshot_path)
+            third = primary.add_contact("恢复之后", [])
+            database.close()
+            print(f"✅ 联系人id: {first}, {second}, 恢复后新增 {third}")
+
+            try:
+                pull()
+                resync = False
+            except replication.ResyncRequired as e:
+                print(f"✅ 跟随节点需要重新同步: {e}")
+                resync = True
+
+        return resync and third > second
+
+    except Exception as e:
+        print(f"❌ 恢复后重新同步测试失败: {e}")
+        return False
+
+def test_suggest_external_write():
+    """测试联想索引不漏掉夹在本进程写入和索引更新之间的外部写入（本地直接调用）"""
+    print_section("21. 联想索引外部写入测试")
+
+    try:
+        import tempfile
+        import schema_migrations
+        from db import ChangeWatcher, Database
+        from storage import SQLiteRepository
+        from suggest import SuggestIndex
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'book.db')
+            schema_migrations.upgrade(path, log=lambda line: None)
+            database = Database(path)
+            # 另一个 Database 对象相当于另一个工作进程，写入不会通知索引
+            other = Database(path)
+            repository = SQLiteRepository(database, fresh=True)
+            loads = []
+
+            def load():
+                loads.append(1)
+                return repository.list_contacts()
+
+            index = SuggestIndex(load, ChangeWatcher(path, 0),
+                                 repository.change_version)
+            database.write_observers.append(index)
+            first = repository.add_contact("本进程甲", [])
+            index.suggest("本进程")
+
+            # 本进程写入提交后、更新索引之前，另一个进程提交了写入
+            second = repository.add_contact("本进程乙", [])
+            SQLiteRepository(other).add_contact("外部写入", [])
+            index.apply_change('upsert', second, repository)
+            external = index.suggest("外部")
+            print(f"✅ 外部写入后的联想结果: {external}，建立索引 {len(loads)} 次")
+
+            # 自己的收藏切换不影响联想键，也不应该触发重建
+            repository.toggle_favorite(first)
+            loaded = len(loads)
+            own = index.suggest("本进程")
+            print(f"✅ 收藏切换后的联想结果: {own}，建立索引 {len(loads)} 次")
+
+            index.close()
+            database.close()
+            other.close()
+
+        return (len(external) == 1 and len(own) == 2
+                and len(loads) == loaded == 2)
+
+    except Exception as e:
+        print(f"❌ 联想索引外部写入测试失败: {e}")
+        return False
+
 def main():
     """主测试函数"""
     print("\n" + "🌟" * 60)
@@ -399,7 +874,18 @@ def main():
         ("导出功能", test_export_contacts),
         ("导入功能", test_import_contacts),
         ("统计信息", test_stats),
-        ("删除联系人", test_delete_contact)
+        ("删除联系人", test_delete_contact),
+        ("输入联想", test_suggest_contacts),
+        ("在线备份", test_backup),
+        ("变更事件", test_contact_events),
+        ("恢复联系人", test_restore_contact),
+        ("字母分组", test_contact_sections),
+        ("变更日志", test_replication_log),
+        ("分组功能", test_groups),
+        ("导入预检", test_import_dry_run),
+        ("统计报表", test_analytics),
+        ("恢复后重新同步", test_restore_resync),
+        ("联想外部写入", test_suggest_external_write)
     ]
     
     passed = 0